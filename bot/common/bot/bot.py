@@ -1,9 +1,23 @@
 import discord
 
+from bot.common.graphql import session_manager
+
+
+class KevinMalone(discord.Bot):
+    """Discord bot which manages the lifetime of the protocol api session"""
+
+    async def start(self, *args, **kwargs):
+        await session_manager.open()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        await session_manager.close()
+
 
 def get_bot() -> discord.Bot:
     intents = discord.Intents.all()
-    return discord.Bot(intents=intents)
+    return KevinMalone(intents=intents)
 
 
 bot: discord.Bot = get_bot()
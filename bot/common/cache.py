@@ -1,11 +1,36 @@
+import contextlib
+import logging
 from abc import ABC, abstractmethod
+
+from aioredis.exceptions import ResponseError
+
 from bot.config import Redis
 
+logger = logging.getLogger(__name__)
+
 
 def build_congrats_key(user_id):
     return f"{user_id}-congrats"
 
 
+class WrongTypeError(Exception):
+    """The key holds a different kind of value than the operation expects"""
+
+
+class ConflictError(Exception):
+    """The value changed since it was read, so the write was dropped"""
+
+
+@contextlib.contextmanager
+def raise_wrong_type():
+    try:
+        yield
+    except ResponseError as e:
+        if str(e).startswith("WRONGTYPE"):
+            raise WrongTypeError(str(e)) from e
+        raise
+
+
 # Abstract base class #
 
 
@@ -15,20 +40,409 @@ class Cache(ABC):
         pass
 
     @abstractmethod
-    async def set(self, key, value):
+    async def set(self, key, value, ex=None):
+        """Sets key to value, expiring after ex seconds if given"""
         pass
 
     @abstractmethod
     async def delete(self, key):
         pass
 
+    @abstractmethod
+    async def hget(self, key, field):
+        pass
+
+    @abstractmethod
+    async def hgetall(self, key):
+        pass
+
+    @abstractmethod
+    async def hset(self, key, mapping, ex=None):
+        """Sets the given fields of the hash at key, keeping the others
+
+        When ex is given the hash expires ex seconds after this write.
+        """
+        pass
+
+    @abstractmethod
+    async def set_hash(self, key, mapping, ex=None):
+        """Replaces the hash at key with the given fields"""
+        pass
+
+    @abstractmethod
+    async def expire(self, key, seconds):
+        """Expires key after seconds, returning whether it exists"""
+        pass
+
+    # The bulk operations fall back to one call per key, caches that can
+    # send several commands at once override them
+
+    async def get_many(self, keys):
+        """Gets the values of keys, in order, None for missing keys"""
+        return [await self.get(key) for key in keys]
+
+    async def set_many(self, mapping, ex=None):
+        for key, value in mapping.items():
+            await self.set(key, value, ex=ex)
+
+    async def delete_many(self, keys):
+        for key in keys:
+            await self.delete(key)
+
+    async def write_hash_if(
+        self, key, field, expected, mapping, replace=False, ex=None
+    ):
+        """Writes the hash at key if its field still holds expected
+
+        The fields in mapping are set, or replace the hash when replace is
+        set, in which case an empty mapping deletes it. An expected value
+        of None means the field must be missing. When ex is given the hash
+        expires ex seconds after the write.
+
+        Returns:
+          Whether the hash was written
+        """
+        if await self.hget(key, field) != expected:
+            return False
+        if replace and not mapping:
+            await self.delete(key)
+        elif replace:
+            await self.set_hash(key, mapping, ex=ex)
+        elif mapping:
+            await self.hset(key, mapping, ex=ex)
+        return True
+
+    def pipeline(self, transaction=True):
+        """Queues commands to be sent together by CachePipeline.execute
+
+        Without a transaction the commands may interleave with those of
+        other clients. A cache without pipelines runs them one by one.
+        """
+        return CachePipeline(self)
+
+
+class CachePipeline:
+    """Commands queued to be sent to a cache together
+
+    The command methods return the pipeline so they can be chained, and
+    execute returns the result of every queued command in order.
+
+    Example:
+      async with cache.pipeline() as pipe:
+          first, _ = await pipe.get("a").delete("b").execute()
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # commands left when the block fails are dropped
+        self.commands = []
+
+    def _queue(self, name, *args, **kwargs):
+        self.commands.append((name, args, kwargs))
+        return self
+
+    def get(self, key):
+        return self._queue("get", key)
+
+    def set(self, key, value, ex=None):
+        return self._queue("set", key, value, ex=ex)
+
+    def delete(self, key):
+        return self._queue("delete", key)
+
+    def hget(self, key, field):
+        return self._queue("hget", key, field)
+
+    def hgetall(self, key):
+        return self._queue("hgetall", key)
+
+    def hset(self, key, mapping):
+        return self._queue("hset", key, mapping)
+
+    def expire(self, key, seconds):
+        return self._queue("expire", key, seconds)
+
+    def _take(self):
+        commands, self.commands = self.commands, []
+        return commands
+
+    async def execute(self):
+        return [
+            await getattr(self.cache, name)(*args, **kwargs)
+            for name, args, kwargs in self._take()
+        ]
+
+
+class RedisPipeline(CachePipeline):
+    """Sends the queued commands to redis in a single round trip"""
+
+    def __init__(self, transaction=True):
+        super().__init__(None)
+        self.transaction = transaction
+
+    async def execute(self):
+        commands = self._take()
+        async with Redis.pipeline(transaction=self.transaction) as pipe:
+            for name, args, kwargs in commands:
+                if name == "hset":
+                    key, mapping = args
+                    pipe.hset(key, mapping=mapping)
+                else:
+                    getattr(pipe, name)(*args, **kwargs)
+            with raise_wrong_type():
+                return await pipe.execute()
+
+
+# KEYS[1] is the hash; ARGV holds the field to check, whether it must be
+# missing, the value it must hold, whether to replace the hash, the
+# seconds until it expires or 0, and then the field value pairs to write
+WRITE_HASH_IF_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if ARGV[2] == '1' then
+    if current then return 0 end
+elseif current ~= ARGV[3] then
+    return 0
+end
+if ARGV[4] == '1' then redis.call('DEL', KEYS[1]) end
+if #ARGV > 5 then redis.call('HSET', KEYS[1], unpack(ARGV, 6)) end
+if ARGV[5] ~= '0' then redis.call('EXPIRE', KEYS[1], ARGV[5]) end
+return 1
+"""
+
 
 class RedisCache(Cache):
+    write_hash_if_script = Redis.register_script(WRITE_HASH_IF_SCRIPT)
+
     async def get(self, key):
-        return await Redis.get(key)
+        with raise_wrong_type():
+            return await Redis.get(key)
 
-    async def set(self, key, value):
-        return await Redis.set(key, value)
+    async def set(self, key, value, ex=None):
+        return await Redis.set(key, value, ex=ex)
 
     async def delete(self, key):
         return await Redis.delete(key)
+
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        with raise_wrong_type():
+            return await Redis.mget(keys)
+
+    async def set_many(self, mapping, ex=None):
+        if not mapping:
+            return
+        if ex is None:
+            return await Redis.mset(mapping)
+        # MSET can't expire keys, so each is set in one pipeline
+        async with self.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, ex=ex)
+            await pipe.execute()
+
+    async def delete_many(self, keys):
+        if keys:
+            return await Redis.delete(*keys)
+
+    def pipeline(self, transaction=True):
+        return RedisPipeline(transaction)
+
+    async def write_hash_if(
+        self, key, field, expected, mapping, replace=False, ex=None
+    ):
+        # checked and written by a script, so no other client can change
+        # the hash in between
+        args = [field, int(expected is None), expected or "", int(replace), ex or 0]
+        for name, value in mapping.items():
+            args += [name, value]
+        with raise_wrong_type():
+            written = await self.write_hash_if_script(keys=[key], args=args)
+        return bool(written)
+
+    async def hget(self, key, field):
+        with raise_wrong_type():
+            return await Redis.hget(key, field)
+
+    async def hgetall(self, key):
+        with raise_wrong_type():
+            return await Redis.hgetall(key)
+
+    async def hset(self, key, mapping, ex=None):
+        if ex is None:
+            with raise_wrong_type():
+                return await Redis.hset(key, mapping=mapping)
+        async with self.pipeline() as pipe:
+            added, _ = await pipe.hset(key, mapping).expire(key, ex).execute()
+            return added
+
+    async def set_hash(self, key, mapping, ex=None):
+        # the previous value is dropped in the same transaction, so
+        # readers never see a mix of old and new fields
+        async with self.pipeline() as pipe:
+            pipe.delete(key).hset(key, mapping)
+            if ex is not None:
+                pipe.expire(key, ex)
+            return await pipe.execute()
+
+    async def expire(self, key, seconds):
+        return await Redis.expire(key, seconds)
+
+
+class UnitOfWork(Cache):
+    """Buffers the reads and writes of one hash for the length of an event
+
+    The hash at key is loaded once when the unit of work is entered.
+    Every read of it is then served from memory and every write only
+    changes the copy in memory, which is committed when the unit of work
+    is left in a single write: an HSET of the changed fields, or a DEL
+    and HSET in one transaction if the hash was replaced or deleted,
+    with the expiry of the last write that gave one. Other keys are
+    passed through to the underlying cache.
+
+    With a check_field the commit only goes through if that field of the
+    stored hash still holds the value that was loaded, checked and
+    written atomically; otherwise ConflictError is raised and nothing is
+    written, so two events that started from the same value can't both
+    move it on. Since the commit comes after the event has had its other
+    effects, check can be called before the first of them to drop the
+    event while that is still clean.
+
+    Args:
+      cache: the underlying cache
+      key: key of the hash
+      load: whether to load the hash, which can be skipped when the
+        event replaces it before reading it
+      check_field: field that must be unchanged for the commit to apply
+    """
+
+    def __init__(self, cache, key, load=True, check_field=None):
+        self.cache = cache
+        self.key = key
+        self.load = load
+        self.check_field = check_field
+        self.checked = False
+        self.expected = None
+        self.fields = {}
+        self.changed = set()
+        self.replaced = False
+        self.ex = None
+
+    def _is_own(self, key):
+        return str(key) == str(self.key)
+
+    async def __aenter__(self):
+        if self.load:
+            try:
+                fields = await self.cache.hgetall(self.key)
+            except WrongTypeError:
+                # not migrated yet, reads fall back to the underlying cache
+                fields = None
+                self.load = False
+            self.fields = {
+                _decode(name): value for name, value in (fields or {}).items()
+            }
+            if self.load and self.check_field is not None:
+                self.checked = True
+                self.expected = self.fields.get(self.check_field)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # committed even when the event failed, as the writes made before
+        # the failure would have been without the unit of work
+        try:
+            await self.commit()
+        except ConflictError as e:
+            if exc_type is None:
+                raise
+            # the failure of the event is what's raised
+            logger.warning(f"Dropped the writes of a failed event: {e}")
+
+    async def check(self):
+        """Raises ConflictError if the check_field changed since it was read"""
+        if not self.checked:
+            return
+        if await self.cache.hget(self.key, self.check_field) != self.expected:
+            raise ConflictError(
+                f"{self.check_field} of {self.key} changed since it was read"
+            )
+
+    async def commit(self):
+        if self.replaced:
+            mapping = self.fields
+        else:
+            mapping = {name: self.fields[name] for name in self.changed}
+        if self.checked and (self.replaced or mapping):
+            written = await self.cache.write_hash_if(
+                self.key,
+                self.check_field,
+                self.expected,
+                mapping,
+                replace=self.replaced,
+                ex=self.ex,
+            )
+            if not written:
+                raise ConflictError(
+                    f"{self.check_field} of {self.key} changed since it was read"
+                )
+            self.expected = self.fields.get(self.check_field)
+        elif self.replaced and mapping:
+            await self.cache.set_hash(self.key, mapping, ex=self.ex)
+        elif self.replaced:
+            await self.cache.delete(self.key)
+        elif mapping:
+            await self.cache.hset(self.key, mapping, ex=self.ex)
+        self.changed = set()
+        self.replaced = False
+
+    async def get(self, key):
+        return await self.cache.get(key)
+
+    async def set(self, key, value, ex=None):
+        return await self.cache.set(key, value, ex=ex)
+
+    async def delete(self, key):
+        if not self._is_own(key):
+            return await self.cache.delete(key)
+        self.fields = {}
+        self.changed = set()
+        self.replaced = True
+
+    async def hget(self, key, field):
+        if not self._is_own(key) or not self.load:
+            return await self.cache.hget(key, field)
+        return self.fields.get(field)
+
+    async def hgetall(self, key):
+        if not self._is_own(key) or not self.load:
+            return await self.cache.hgetall(key)
+        return dict(self.fields)
+
+    async def hset(self, key, mapping, ex=None):
+        if not self._is_own(key) or not self.load:
+            return await self.cache.hset(key, mapping, ex=ex)
+        self.fields.update(mapping)
+        self.changed.update(mapping)
+        self.ex = ex if ex is not None else self.ex
+
+    async def set_hash(self, key, mapping, ex=None):
+        if not self._is_own(key):
+            return await self.cache.set_hash(key, mapping, ex=ex)
+        self.fields = dict(mapping)
+        self.changed = set()
+        self.replaced = True
+        self.ex = ex
+        # the hash is now known in full, whether or not it was loaded
+        self.load = True
+
+    async def expire(self, key, seconds):
+        return await self.cache.expire(key, seconds)
+
+
+def _decode(name):
+    return name.decode("utf-8") if isinstance(name, bytes) else name
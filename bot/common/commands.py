@@ -1,15 +1,24 @@
 from discord.commands import Option
+import asyncio
 import logging
 import discord
 
+from bot import constants
 from bot.common.bot.bot import bot
 from bot.common.graphql import (
     get_user_by_discord_id,
     get_guild_by_id,
-    get_guild_by_discord_id,
+    get_user_guild_membership,
 )
+from bot.common.executor import UserEventExecutor
+from bot.common.local_cache import LocalCache
+from bot.common.resilience import set_deadline
+from bot.common.cache import ConflictError, RedisCache, UnitOfWork
 from bot.common.threads.thread_builder import (
-    build_cache_value,
+    STEP_FIELD,
+    build_thread_state,
+    get_thread_state,
+    write_thread_state,
     ThreadKeys,
 )
 from bot.common.threads.onboarding import Onboarding
@@ -31,6 +40,30 @@ from bot.exceptions import NotGuildException, ErrorHandler
 
 logger = logging.getLogger(__name__)
 
+# thread state of each user, stored as a redis hash
+thread_cache = RedisCache()
+if constants.BotCache.local_enable.lower() == "true":
+    thread_cache = LocalCache(
+        thread_cache,
+        redis=Redis,
+        max_entries=int(constants.BotCache.local_max_entries),
+        max_bytes=int(constants.BotCache.local_max_bytes),
+        ttl=float(constants.BotCache.local_ttl_seconds),
+    )
+
+# seconds each interaction may spend waiting on the protocol api
+INTERACTION_DEADLINE_SECONDS = float(constants.Protocol.interaction_deadline_seconds)
+
+# DM messages and reactions, run in order per user
+event_executor = UserEventExecutor(int(constants.BotEvents.concurrency))
+
+
+@bot.before_invoke
+async def start_interaction_deadline(ctx: discord.ApplicationContext):
+    # runs in the same task as the command, so the deadline is
+    # visible to every query the command makes
+    set_deadline(INTERACTION_DEADLINE_SECONDS)
+
 
 @bot.slash_command(
     guild_id=GUILD_IDS,
@@ -59,9 +92,10 @@ async def report(ctx: discord.ApplicationContext):
             "",
         )
         # TODO add thread and step
-        return await Redis.set(
+        return await write_thread_state(
             ctx.author.id,
-            build_cache_value(
+            thread_cache,
+            build_thread_state(
                 ThreadKeys.GUILD_SELECT.value,
                 thread.steps.hash_,
                 "",
@@ -86,14 +120,9 @@ async def join(ctx: discord.ApplicationContext):
 
     guild_discord_id = ctx.guild.id
 
-    # TODO: a single query could be written for this
-    user = await get_user_by_discord_id(ctx.author.id)
-    guild = await get_guild_by_discord_id(guild_discord_id)
-    guild_id = guild["id"]
+    _, _, is_member = await get_user_guild_membership(ctx.author.id, guild_discord_id)
 
-    if user is not None and any(
-        guild_user["guild_id"] == guild_id for guild_user in user["guild_users"]
-    ):
+    if is_member:
         # Send welcome message and
         # And ask what journey they are
         # on by sending all the commands
@@ -126,7 +155,7 @@ async def join(ctx: discord.ApplicationContext):
         colour=INFO_EMBED_COLOR, title="Welcome", description=welcome_content
     )
     logger.info(
-        f"Key: {build_cache_value(ThreadKeys.ONBOARDING.value, '', ctx.guild.id)}"
+        f"Key: {build_thread_state(ThreadKeys.ONBOARDING.value, '', ctx.guild.id)}"
     )
 
     try:
@@ -139,24 +168,28 @@ async def join(ctx: discord.ApplicationContext):
 
     await ctx.followup.send("Check your DM's to continue onboarding", ephemeral=True)
 
-    thread = await Onboarding(
-        ctx.author.id,
-        None,
-        message.id,
-        ctx.guild.id,
-    )
-    # Need to set the metadata here to provide the guild id
-    await Redis.set(
-        ctx.author.id,
-        build_cache_value(
-            thread=ThreadKeys.ONBOARDING.value,
-            step=thread.steps.hash_,
-            guild_id=ctx.guild.id,
-            message_id=message.id,
-            metadata={"guild_name": ctx.guild.name},
-        ),
-    )
-    await thread.send(message)
+    # the state is replaced before it is read, so there's nothing to load
+    async with UnitOfWork(thread_cache, ctx.author.id, load=False) as cache:
+        thread = await Onboarding(
+            ctx.author.id,
+            None,
+            message.id,
+            ctx.guild.id,
+            cache,
+        )
+        # Need to set the metadata here to provide the guild id
+        await write_thread_state(
+            ctx.author.id,
+            cache,
+            build_thread_state(
+                thread=ThreadKeys.ONBOARDING.value,
+                step=thread.steps.hash_,
+                guild_id=ctx.guild.id,
+                message_id=message.id,
+                metadata={"guild_name": ctx.guild.name},
+            ),
+        )
+        await thread.send(message)
 
 
 @bot.slash_command(
@@ -189,9 +222,10 @@ async def update(ctx: discord.ApplicationContext):
             message.id,
             "",
         )
-        await Redis.set(
+        await write_thread_state(
             ctx.author.id,
-            build_cache_value(
+            thread_cache,
+            build_thread_state(
                 ThreadKeys.UPDATE_PROFILE.value,
                 thread.steps.hash_,
                 "",
@@ -232,13 +266,14 @@ async def history(
             None,
             message.id,
             "",
-            cache=Redis,
+            cache=thread_cache,
             discord_bot=bot,
             context=ctx,
         )
-        return await Redis.set(
+        return await write_thread_state(
             ctx.author.id,
-            build_cache_value(
+            thread_cache,
+            build_thread_state(
                 ThreadKeys.GUILD_SELECT.value,
                 thread.steps.hash_,
                 "",
@@ -251,28 +286,30 @@ async def history(
             ),
         )
 
-    thread = await History(
-        ctx.author.id,
-        None,
-        None,
-        ctx.guild.id,
-        cache=Redis,
-        discord_bot=bot,
-        context=ctx,
-    )
-    await Redis.set(
-        ctx.author.id,
-        build_cache_value(
-            ThreadKeys.POINTS.value,
-            thread.steps.hash_,
+    async with UnitOfWork(thread_cache, ctx.author.id, load=False) as cache:
+        thread = await History(
+            ctx.author.id,
+            None,
+            None,
             ctx.guild.id,
-            metadata={
-                "thread_name": ThreadKeys.POINTS.value,
-                "days": days,
-            },
-        ),
-    )
-    await thread.send(None)
+            cache=cache,
+            discord_bot=bot,
+            context=ctx,
+        )
+        await write_thread_state(
+            ctx.author.id,
+            cache,
+            build_thread_state(
+                ThreadKeys.POINTS.value,
+                thread.steps.hash_,
+                ctx.guild.id,
+                metadata={
+                    "thread_name": ThreadKeys.POINTS.value,
+                    "days": days,
+                },
+            ),
+        )
+        await thread.send(None)
 
 
 @bot.slash_command(
@@ -296,20 +333,21 @@ async def add_dao(ctx: discord.ApplicationContext):
     )
     sent_message = await ctx.response.send_message(embed=embed)
 
-    thread = await AddDao(
-        ctx.author.id,
-        None,
-        sent_message.id,
-        None,
-        cache=Redis,
-        discord_bot=bot,
-        context=ctx,
-    )
-    cache_value = build_cache_value(ThreadKeys.ADD_DAO.value, thread.steps.hash_, "")
+    async with UnitOfWork(thread_cache, ctx.author.id, load=False) as cache:
+        thread = await AddDao(
+            ctx.author.id,
+            None,
+            sent_message.id,
+            None,
+            cache=cache,
+            discord_bot=bot,
+            context=ctx,
+        )
+        state = build_thread_state(ThreadKeys.ADD_DAO.value, thread.steps.hash_, "")
 
-    logger.info(f"Key: {cache_value}")
-    await Redis.set(ctx.author.id, cache_value)
-    await thread.send(sent_message)
+        logger.info(f"Key: {state}")
+        await write_thread_state(ctx.author.id, cache, state)
+        await thread.send(sent_message)
 
 
 # if bool(strtobool(constants.Bot.is_dev)):
@@ -344,9 +382,10 @@ async def add_dao(ctx: discord.ApplicationContext):
 #                message.id,
 #                "",
 #            )
-#            await Redis.set(
+#            await write_thread_state(
 #                ctx.author.id,
-#                build_cache_value(
+#                thread_cache,
+#                build_thread_state(
 #                    ThreadKeys.GUILD_SELECT.value,
 #                    thread.steps.hash_,
 #                    "",
@@ -369,8 +408,13 @@ async def select_guild(ctx: discord.ApplicationContext, response_embed, error_em
         return None, None
 
     guild_metadata = []
-    for record_id in guild_ids:
-        g = await get_guild_by_id(record_id.get("guild_id"))
+    # lookups are batched into a single query by the guild loader
+    guilds = await asyncio.gather(
+        *[get_guild_by_id(record_id.get("guild_id")) for record_id in guild_ids]
+    )
+    for g in guilds:
+        if not g:
+            continue
         guild_id = g.get("id")
         guild_discord_id = g.get("discord_id")
         guild_name = g.get("name")
@@ -408,6 +452,24 @@ nonexistant_thread_message = (
     " my slash commands! Just type a `/` to see a list of them."
 )
 
+conflicting_event_message = (
+    "Looks like your last %s arrived while I was still handling another one,"
+    " so I skipped it. Please try it again!"
+)
+
+
+async def handle_conflict(channel, user_id, event, error, replied):
+    if replied:
+        # the user has already seen the replies to the event, so it can't
+        # be called skipped; the state the other event wrote is kept
+        logger.warning(
+            f"Dropped the thread state written by the {event} of user "
+            f"{user_id} after replying to it: {error}"
+        )
+        return
+    logger.info(f"Dropped {event} of user {user_id}: {error}")
+    await channel.send(conflicting_event_message % event)
+
 
 @bot.event
 async def on_message(message):
@@ -418,23 +480,52 @@ async def on_message(message):
     if not isinstance(message.channel, discord.DMChannel):
         return
 
-    # Check if user has open thread
-    thread_key = await Redis.get(message.author.id)
-    if not thread_key:
-        msg = nonexistant_thread_message % "message"
-        await send_message_if_not_on_cooldown(message.channel, message.author.id, msg)
-        return
+    await event_executor.run(message.author.id, handle_message, message)
+
 
-    thread = await get_thread(message.author.id, thread_key)
+async def handle_message(message):
+    # the deadline starts once the message is out of the queue
+    set_deadline(INTERACTION_DEADLINE_SECONDS)
 
+    # the thread state is read once and written once for the whole message,
+    # and only if no other event moved the thread on in the meantime
+    replied = False
     try:
-        await thread.send(message)
-    except errors.ApplicationCommandError as e:
-        await message.channel.send(str(e))
+        async with UnitOfWork(
+            thread_cache, message.author.id, check_field=STEP_FIELD
+        ) as cache:
+            # Check if user has open thread
+            state = await get_thread_state(message.author.id, cache)
+            if not state:
+                msg = nonexistant_thread_message % "message"
+                await send_message_if_not_on_cooldown(
+                    message.channel, message.author.id, msg
+                )
+                return
+
+            thread = await get_thread(message.author.id, state, cache)
+
+            # nothing has been sent or saved for the message yet, so it can
+            # still be skipped cleanly if another event moved the thread on
+            await cache.check()
+            replied = True
+            try:
+                await thread.send(message)
+            except errors.ApplicationCommandError as e:
+                await message.channel.send(str(e))
+    except ConflictError as e:
+        await handle_conflict(message.channel, message.author.id, "message", e, replied)
 
 
 @bot.event
 async def on_raw_reaction_add(payload):
+    # queued before the user is fetched, so the messages and reactions of
+    # a user are handled in the order they arrived
+    await event_executor.run(int(payload.user_id), handle_reaction, payload)
+
+
+async def handle_reaction(payload):
+    set_deadline(INTERACTION_DEADLINE_SECONDS)
     reaction = payload
     user = await bot.fetch_user(int(payload.user_id))
     channel = await bot.fetch_channel(int(reaction.channel_id))
@@ -445,15 +536,22 @@ async def on_raw_reaction_add(payload):
     if not isinstance(channel, discord.DMChannel):
         return
 
-    # Check if user has open thread
-    thread_key = await Redis.get(user.id)
-    if not thread_key:
-        msg = nonexistant_thread_message % "reaction"
-        await send_message_if_not_on_cooldown(channel, user.id, msg)
-        return
-
-    thread = await get_thread(user.id, thread_key)
-    await thread.handle_reaction(reaction, user)
+    replied = False
+    try:
+        async with UnitOfWork(thread_cache, user.id, check_field=STEP_FIELD) as cache:
+            # Check if user has open thread
+            state = await get_thread_state(user.id, cache)
+            if not state:
+                msg = nonexistant_thread_message % "reaction"
+                await send_message_if_not_on_cooldown(channel, user.id, msg)
+                return
+
+            thread = await get_thread(user.id, state, cache)
+            await cache.check()
+            replied = True
+            await thread.handle_reaction(reaction, user)
+    except ConflictError as e:
+        await handle_conflict(channel, user.id, "reaction", e, replied)
 
 
 # Storing as a separate key to prevent conflict with existing metadata
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DataLoader:
+    """Batches lookups requested in the same event loop tick
+
+    Every key passed to load is queued, and once the current tick has
+    run the queued keys are resolved together with a single call to
+    the batch function. Loads for the same key within a tick share
+    the same result.
+
+    Args:
+      batch_load_fn: A coroutine function which accepts a list of keys
+        and returns a list of values in the same order, using None
+        for keys which were not found.
+    """
+
+    def __init__(self, batch_load_fn):
+        self.batch_load_fn = batch_load_fn
+        self._queue = {}
+        # the event loop only keeps weak references to tasks, so one is
+        # kept to every batch until it is done
+        self._batches = set()
+
+    def load(self, key):
+        """Queues a key to be resolved in the next batch
+
+        Args:
+          key: A hashable key to load
+
+        Returns:
+          An awaitable which resolves to the value for the key
+        """
+        future = self._queue.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            future = loop.create_future()
+            self._queue[key] = future
+        # shield so a cancelled caller doesn't cancel the shared result
+        return asyncio.shield(future)
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def _dispatch(self):
+        batch = self._queue
+        self._queue = {}
+        task = asyncio.ensure_future(self._load_batch(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _load_batch(self, batch):
+        keys = list(batch.keys())
+        try:
+            values = await self.batch_load_fn(keys)
+            if len(values) != len(keys):
+                raise ValueError(
+                    f"Batch function returned {len(values)} values "
+                    f"for {len(keys)} keys"
+                )
+        except Exception as e:
+            logger.exception(f"Failed to load batch {keys}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, value in zip(batch.values(), values):
+            if not future.done():
+                future.set_result(value)
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _UserQueue:
+    def __init__(self):
+        # asyncio locks are granted in the order they were waited on
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class UserEventExecutor:
+    """Runs the events of each user in order, and of different users at once
+
+    The events of one user are handled one at a time, in the order they
+    arrived, so they never race each other over the user's thread state.
+    Events of different users run in parallel, at most concurrency at
+    once. A user's queue is dropped as soon as it's empty.
+
+    Args:
+      concurrency: maximum events handled at once across all users
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.queues = {}
+        self.active = 0
+        self.handled = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._slots = None
+
+    def _get_slots(self):
+        # created on first use, so it belongs to the loop running the bot
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    async def run(self, user_id, handler, *args):
+        """Waits for the user's earlier events, then awaits handler(*args)"""
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = _UserQueue()
+        queue.depth += 1
+        started = time.monotonic()
+        try:
+            async with queue.lock, self._get_slots():
+                waited = time.monotonic() - started
+                self.handled += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                self.active += 1
+                try:
+                    return await handler(*args)
+                finally:
+                    self.active -= 1
+        finally:
+            queue.depth -= 1
+            if not queue.depth:
+                del self.queues[user_id]
+
+    def stats(self):
+        depths = [queue.depth for queue in self.queues.values()]
+        return {
+            "active": self.active,
+            "users": len(depths),
+            "queued": sum(depths) - self.active,
+            "max_depth": max(depths, default=0),
+            "handled": self.handled,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
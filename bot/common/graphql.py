@@ -1,11 +1,44 @@
+import asyncio
+import copy
+import json
 import logging
+import time
 
+import aiohttp
 from bot import constants
+from bot.common.dataloader import DataLoader
+from bot.common.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    clear_deadline,
+    remaining_budget,
+)
+from bot.common.scheduler import BATCH, INTERACTIVE, PriorityScheduler, use_lane
+from bot.common.transport import ProtocolTransport
+from bot.common.ttl_cache import TTLCache
+from bot.config import Redis
 from gql import Client, gql
-from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.exceptions import TransportQueryError
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    FragmentDefinitionNode,
+    NameNode,
+    OperationDefinitionNode,
+    OperationType,
+    SelectionSetNode,
+    VariableNode,
+    Visitor,
+    visit,
+)
+from gql.transport.exceptions import (
+    TransportProtocolError,
+    TransportQueryError,
+    TransportServerError,
+)
 
 from bot.exceptions import (
+    DeadlineExceededException,
+    ProtocolUnavailableException,
     UserWithAddressAlreadyExists,
     UserWithTwitterHandleAlreadyExists,
 )
@@ -13,26 +46,634 @@ from bot.exceptions import (
 logger = logging.getLogger(__name__)
 
 
-def get_async_transport(url):
-    return AIOHTTPTransport(
-        url=url, headers={"Authorization": constants.Bot.protocol_token}
+def get_async_transport(url, connector=None):
+    client_session_args = None
+    if connector is not None:
+        client_session_args = {"connector": connector}
+    headers = {}
+    # the offline stand-in for the protocol api doesn't need a token
+    if constants.Bot.protocol_token:
+        headers["Authorization"] = constants.Bot.protocol_token
+    return ProtocolTransport(
+        url=url,
+        headers=headers,
+        client_session_args=client_session_args,
+        persisted_queries=constants.Protocol.persisted_queries_enable.lower() == "true",
+    )
+
+
+class GqlSessionManager:
+    """Owns the connection pool used to talk to the protocol api
+
+    A single gql client session is kept open for the lifetime of the
+    bot so queries reuse keep-alive connections instead of paying a
+    new TCP + TLS handshake on every request. The session is opened
+    when the bot starts, or lazily on the first query when used
+    outside of the bot (e.g. generating reports locally).
+
+    Args:
+      url: url of the protocol api, defaults to the configured url
+      pool_size: maximum number of open connections
+      pool_size_per_host: maximum number of open connections per host
+      keepalive_timeout: seconds an idle connection is kept open
+      execute_timeout: seconds before a query is cancelled
+    """
+
+    def __init__(
+        self,
+        url=None,
+        pool_size=None,
+        pool_size_per_host=None,
+        keepalive_timeout=None,
+        execute_timeout=30,
+    ):
+        self.url = url
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.execute_timeout = execute_timeout
+        self._client = None
+        self._session = None
+        self._lock = None
+
+    @property
+    def is_open(self):
+        return self._session is not None
+
+    def _get_connector(self):
+        pool_size = self.pool_size or constants.Protocol.pool_size
+        per_host = self.pool_size_per_host or constants.Protocol.pool_size_per_host
+        keepalive = (
+            self.keepalive_timeout or constants.Protocol.keepalive_timeout_seconds
+        )
+        return aiohttp.TCPConnector(
+            limit=int(pool_size),
+            limit_per_host=int(per_host),
+            keepalive_timeout=float(keepalive),
+        )
+
+    async def open(self):
+        """Opens the client session if it is not already open
+
+        Returns:
+          The open gql client session
+        """
+        if self._session is not None:
+            return self._session
+        # The lock is created lazily so it is bound to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._session is None:
+                transport = get_async_transport(
+                    self.url or constants.Bot.protocol_url, self._get_connector()
+                )
+                client = Client(
+                    transport=transport,
+                    fetch_schema_from_transport=False,
+                    execute_timeout=self.execute_timeout,
+                )
+                self._session = await client.__aenter__()
+                self._client = client
+                logger.info("Opened protocol api session")
+        return self._session
+
+    async def close(self):
+        """Closes the client session and the underlying connection pool"""
+        if self._client is None:
+            return
+        client = self._client
+        self._client = None
+        self._session = None
+        self._lock = None
+        await client.__aexit__(None, None, None)
+        logger.info("Closed protocol api session")
+
+    async def execute(self, query, values):
+        session = await self.open()
+        return await session.execute(query, variable_values=values)
+
+    async def stream(self, query, values, path, extra_args=None):
+        session = await self.open()
+        async for item in session.transport.stream(
+            query, path, variable_values=values, extra_args=extra_args
+        ):
+            yield item
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+session_manager = GqlSessionManager()
+
+
+class RequestCoalescer:
+    """Shares a single in-flight request between identical callers
+
+    While a read is in flight, any other caller asking for the same
+    operation and variables awaits the result of that request rather
+    than sending a duplicate. Hits count the requests which were
+    saved this way.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build_key(operation_name, values):
+        return (operation_name, json.dumps(values, sort_keys=True, default=str))
+
+    async def do(self, key, fn):
+        """Awaits fn, or the in-flight request with the same key
+
+        Args:
+          key: A hashable key identifying the request
+          fn: A coroutine function performing the request
+
+        Returns:
+          A copy of the result of the request for every caller, so none
+          of them can change the result another one receives
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            logger.debug(f"Coalesced request {key[0]} ({self.hits} hits)")
+            result = await asyncio.shield(future)
+            return copy.deepcopy(result)
+
+        self.misses += 1
+        future = asyncio.ensure_future(fn())
+        self._inflight[key] = future
+
+        def _remove(_):
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+        future.add_done_callback(_remove)
+        result = await asyncio.shield(future)
+        return copy.deepcopy(result)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "inflight": len(self._inflight),
+        }
+
+
+coalescer = RequestCoalescer()
+
+
+def get_operation_definition(document):
+    for definition in document.definitions:
+        if isinstance(definition, OperationDefinitionNode):
+            return definition
+    return None
+
+
+# errors which mean the request didn't get a graphql response; graphql
+# errors (TransportQueryError) mean the api is up and are never retried
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+    TransportProtocolError,
+    TransportServerError,
+)
+
+read_timeout = float(constants.Protocol.read_timeout_seconds)
+mutation_timeout = float(constants.Protocol.mutation_timeout_seconds)
+read_retry_policy = RetryPolicy(
+    attempts=int(constants.Protocol.read_retry_attempts),
+    base=float(constants.Protocol.retry_backoff_base_seconds),
+    cap=float(constants.Protocol.retry_backoff_max_seconds),
+)
+circuit_breaker = CircuitBreaker(
+    failure_rate=float(constants.Protocol.breaker_failure_rate),
+    window_size=int(constants.Protocol.breaker_window_size),
+    min_requests=int(constants.Protocol.breaker_min_requests),
+    reset_timeout=float(constants.Protocol.breaker_reset_timeout_seconds),
+)
+
+# interactive requests always go first, so background reports can't
+# add to the latency of commands. Together the lanes never use more
+# connections than the pool has for the protocol api
+scheduler = PriorityScheduler(
+    {
+        INTERACTIVE: int(constants.Protocol.interactive_concurrency),
+        BATCH: int(constants.Protocol.batch_concurrency),
+    },
+    total=min(
+        int(constants.Protocol.pool_size), int(constants.Protocol.pool_size_per_host)
+    ),
+)
+
+
+def get_timeout(operation):
+    is_read = operation is None or operation.operation == OperationType.QUERY
+    timeout = None
+    if operation is not None and operation.name is not None:
+        timeout = operations.timeout(operation.name.value)
+    if timeout is None:
+        timeout = read_timeout if is_read else mutation_timeout
+    return timeout
+
+
+def get_attempt_timeout(operation):
+    """Returns the timeout and circuit breaker permit of the next attempt
+
+    Raises:
+      DeadlineExceededException: if the interaction is out of time
+      ProtocolUnavailableException: if the circuit breaker is open
+    """
+    timeout = get_timeout(operation)
+    budget = remaining_budget()
+    if budget is not None:
+        if budget <= 0:
+            raise DeadlineExceededException(
+                "Govrn took too long to respond, please try again in a bit!"
+            )
+        timeout = min(timeout, budget)
+    permit = circuit_breaker.allow_request()
+    if permit is None:
+        raise ProtocolUnavailableException(
+            "Govrn is having trouble right now, please try again in a bit!"
+        )
+    return timeout, permit
+
+
+async def backoff_or_raise(error, name, attempt, attempts, started):
+    """Waits before retrying a failed attempt, or raises its error"""
+    circuit_breaker.record_failure()
+    elapsed = time.monotonic() - started
+    delay = read_retry_policy.backoff(attempt)
+    budget = remaining_budget()
+    out_of_budget = budget is not None and budget <= delay
+    if attempt + 1 >= attempts or out_of_budget:
+        raise error
+    logger.warning(
+        f"Retrying {name} in {delay:.2f}s after "
+        f"{type(error).__name__} ({elapsed:.2f}s), attempt {attempt + 1}"
     )
+    await asyncio.sleep(delay)
+
+
+async def execute_with_policy(query, values, operation):
+    """Sends a query with a timeout, retrying idempotent reads
+
+    Each attempt waits for a slot in the lane of the current task, and
+    is then limited by the operation's timeout and by the deadline of
+    the current interaction, if one was set. Reads are
+    retried with a jittered backoff when the request fails without a
+    graphql response; mutations are only sent once. Every attempt is
+    rejected straight away while the circuit breaker is open.
+    """
+    is_read = operation is not None and operation.operation == OperationType.QUERY
+    attempts = read_retry_policy.attempts if is_read else 1
+    name = operation.name.value if operation and operation.name else "anonymous"
+
+    for attempt in range(attempts):
+        started = time.monotonic()
+        permit = None
+        try:
+            async with scheduler.slot():
+                timeout, permit = get_attempt_timeout(operation)
+                result = await asyncio.wait_for(
+                    session_manager.execute(query, values), timeout
+                )
+        except TransportQueryError:
+            circuit_breaker.record_success()
+            raise
+        except RETRYABLE_ERRORS as e:
+            await backoff_or_raise(e, name, attempt, attempts, started)
+            continue
+        except BaseException:
+            # cancelled or failed without an outcome for the breaker,
+            # which mustn't be left waiting on a trial that never ends
+            if permit is not None:
+                circuit_breaker.record_abandoned(permit)
+            raise
+        circuit_breaker.record_success()
+        return result
+
+
+async def stream_query(query, values, path):
+    """Executes a read and yields the items of a list as they are decoded
+
+    Used for the largest results, so decoding overlaps the download and
+    only one item is held in memory at a time rather than the whole
+    response. The same timeout, deadline and circuit breaker policy as
+    execute_query applies, with the timeout covering the whole download.
+    A failed read is only retried if no item was yielded yet.
+
+    Args:
+      query: a registered query document
+      values: variables of the query
+      path: keys leading to the list in the result data, e.g. ("result",)
+
+    Yields:
+      Each item of the list
+    """
+    operation = get_operation_definition(query)
+    name = operation.name.value if operation and operation.name else "anonymous"
+    attempts = read_retry_policy.attempts
+
+    for attempt in range(attempts):
+        started = time.monotonic()
+        yielded = False
+        permit = None
+        try:
+            async with scheduler.slot():
+                timeout, permit = get_attempt_timeout(operation)
+                async for item in session_manager.stream(
+                    query,
+                    values,
+                    path,
+                    extra_args={"timeout": aiohttp.ClientTimeout(total=timeout)},
+                ):
+                    yielded = True
+                    yield item
+        except TransportQueryError:
+            circuit_breaker.record_success()
+            raise
+        except RETRYABLE_ERRORS as e:
+            if yielded:
+                circuit_breaker.record_failure()
+                raise
+            await backoff_or_raise(e, name, attempt, attempts, started)
+            continue
+        except BaseException:
+            # also reached when the caller stops iterating early
+            if permit is not None:
+                circuit_breaker.record_abandoned(permit)
+            raise
+        circuit_breaker.record_success()
+        return
 
 
 async def execute_query(query, values):
-    transport = get_async_transport(constants.Bot.protocol_url)
     try:
-        async with Client(
-            transport=transport, fetch_schema_from_transport=False, execute_timeout=30
-        ) as session:
+        # raw query strings are still accepted, but are parsed on every call.
+        # prefer registering the operation and passing its document
+        if isinstance(query, str):
             query = gql(query)
-            resp = await session.execute(query, variable_values=values)
-            return resp
+        operation = get_operation_definition(query)
+        # identical reads which are in flight at the same time are only
+        # sent once; mutations are always sent
+        if (
+            operation is not None
+            and operation.operation == OperationType.QUERY
+            and operation.name is not None
+        ):
+            key = coalescer.build_key(operation.name.value, values)
+            return await coalescer.do(
+                key, lambda: execute_with_policy(query, values, operation)
+            )
+        return await execute_with_policy(query, values, operation)
     except Exception:
         logger.exception(f"Failed to execute query {query} {values}")
         raise
 
 
+class OperationRegistry:
+    """A registry of named graphql operations
+
+    Operations are registered with their query text and the fragments
+    they depend on, and are parsed into a DocumentNode the first time
+    they are requested. Every following request reuses the parsed
+    document rather than parsing the query again.
+
+    An operation can be registered with its own timeout in seconds,
+    otherwise the default read or mutation timeout is used.
+    """
+
+    def __init__(self):
+        self._sources = {}
+        self._documents = {}
+        self._timeouts = {}
+
+    def register(self, name, query, *fragments, timeout=None):
+        if name in self._sources:
+            raise KeyError(f"Operation {name} is already registered")
+        self._sources[name] = "".join((*fragments, query))
+        if timeout is not None:
+            self._timeouts[name] = timeout
+
+    def source(self, name):
+        return self._sources[name]
+
+    def timeout(self, name):
+        return self._timeouts.get(name)
+
+    def get(self, name):
+        """Gets the parsed document of a registered operation
+
+        Args:
+          name: name the operation was registered under
+
+        Returns:
+          The DocumentNode for the operation
+        """
+        document = self._documents.get(name)
+        if document is None:
+            document = gql(self._sources[name])
+            self._documents[name] = document
+        return document
+
+    def names(self):
+        return list(self._sources)
+
+    def compile_all(self):
+        for name in self.names():
+            self.get(name)
+
+
+operations = OperationRegistry()
+
+
+class _PrefixVariables(Visitor):
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def enter_variable(self, node, *_):
+        return VariableNode(name=NameNode(value=self.prefix + node.name.value))
+
+
+class OperationBatch:
+    """Sends several registered operations as one aliased document
+
+    Every operation added to the batch has its variables and root fields
+    prefixed with its position in the batch, so any operations, the
+    same one more than once included, can be merged into a single
+    document and sent in one http request. Mutation roots are run in
+    the order they were added. Reads and mutations can't be mixed.
+
+    The merged document is built once for each sequence of operation
+    names and reused afterwards.
+
+    Args:
+      registry: the registry the operations are registered in
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or operations
+        self._requests = []
+
+    def add(self, name, values=None):
+        """Adds an operation to the batch
+
+        Args:
+          name: name the operation was registered under
+          values: variables of the operation
+
+        Returns:
+          The position of the operation's result in the batch
+        """
+        self._requests.append((name, values or {}))
+        return len(self._requests) - 1
+
+    def __len__(self):
+        return len(self._requests)
+
+    @staticmethod
+    def prefix(index):
+        return f"b{index}_"
+
+    def build_document(self):
+        names = tuple(name for name, _ in self._requests)
+        document = _batch_documents.get((id(self.registry), names))
+        if document is not None:
+            return document
+
+        operation_type = None
+        variable_definitions = []
+        selections = []
+        fragments = {}
+        for index, name in enumerate(names):
+            prefix = OperationBatch.prefix(index)
+            source = visit(self.registry.get(name), _PrefixVariables(prefix))
+            for definition in source.definitions:
+                if isinstance(definition, FragmentDefinitionNode):
+                    fragments[definition.name.value] = definition
+                    continue
+                if operation_type is None:
+                    operation_type = definition.operation
+                elif definition.operation != operation_type:
+                    raise ValueError("Reads and mutations can't be batched together")
+                variable_definitions.extend(definition.variable_definitions)
+                for selection in definition.selection_set.selections:
+                    if not isinstance(selection, FieldNode):
+                        raise ValueError(f"{name} has a root which isn't a field")
+                    alias = (selection.alias or selection.name).value
+                    field = copy.copy(selection)
+                    field.alias = NameNode(value=prefix + alias)
+                    selections.append(field)
+
+        operation = OperationDefinitionNode(
+            operation=operation_type,
+            name=NameNode(value="batch_" + "_".join(names)),
+            variable_definitions=tuple(variable_definitions),
+            directives=(),
+            selection_set=SelectionSetNode(selections=tuple(selections)),
+        )
+        document = DocumentNode(definitions=(*fragments.values(), operation))
+        _batch_documents[(id(self.registry), names)] = document
+        return document
+
+    def build_values(self):
+        values = {}
+        for index, (_, request_values) in enumerate(self._requests):
+            prefix = OperationBatch.prefix(index)
+            for key, value in request_values.items():
+                values[prefix + key] = value
+        return values
+
+    def split_result(self, data, errors):
+        """Maps the merged response back to each operation
+
+        Returns:
+          A list with, for each operation, its result keyed by its own
+          root field names, or a TransportQueryError with its errors
+        """
+        results = []
+        for index, (name, _) in enumerate(self._requests):
+            prefix = OperationBatch.prefix(index)
+            result = {
+                key[len(prefix) :]: value
+                for key, value in (data or {}).items()
+                if key.startswith(prefix)
+            }
+            # errors without a path apply to the whole document
+            request_errors = [
+                error
+                for error in errors
+                if not error.get("path") or str(error["path"][0]).startswith(prefix)
+            ]
+            if request_errors:
+                results.append(
+                    TransportQueryError(
+                        request_errors[0].get("message", f"{name} failed"),
+                        errors=request_errors,
+                        data=result,
+                    )
+                )
+            else:
+                results.append(result)
+        return results
+
+    async def execute(self, return_exceptions=False):
+        """Sends every operation in the batch with a single request
+
+        Args:
+          return_exceptions: return the error of an operation which
+            failed in its place, rather than raising the first error
+
+        Returns:
+          The result of every operation, in the order they were added
+        """
+        if not self._requests:
+            return []
+        try:
+            data = await execute_query(self.build_document(), self.build_values())
+            errors = []
+        except TransportQueryError as e:
+            data = e.data
+            errors = e.errors or []
+
+        results = self.split_result(data, errors)
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+# merged documents keyed by registry and sequence of operation names
+_batch_documents = {}
+
+
+async def execute_batch(requests, return_exceptions=False):
+    """Sends several registered operations in one request
+
+    Args:
+      requests: (operation name, variables) pairs
+      return_exceptions: see OperationBatch.execute
+
+    Returns:
+      The result of every operation, in the order they were given
+    """
+    batch = OperationBatch()
+    for name, values in requests:
+        batch.add(name, values)
+    return await batch.execute(return_exceptions=return_exceptions)
+
+
 class GqlFragments:
     USER_FRAGMENT = """
 fragment UserFragment on User {
@@ -53,6 +694,9 @@ fragment UserFragment on User {
     id
     guild_id
   }
+  discord_users {
+    discord_id
+  }
   twitter_user {
     id
     username
@@ -103,6 +747,46 @@ fragment ContributionFragment on Contribution {
     updatedAt
   }
 }
+"""
+
+    # Slimmer contribution projections, selected per call site so only
+    # the fields a feature renders are sent back
+    CONTRIBUTION_HISTORY_ROW_FRAGMENT = """
+fragment ContributionHistoryRowFragment on Contribution {
+  id
+  name
+  date_of_engagement
+  date_of_submission
+  status {
+    name
+  }
+}
+"""
+
+    CONTRIBUTION_REPORT_ROW_FRAGMENT = """
+fragment ContributionReportRowFragment on Contribution {
+  id
+  activity_type {
+    name
+  }
+  date_of_engagement
+  date_of_submission
+  details
+  guilds {
+    guild {
+        name
+    }
+  }
+  status {
+    name
+  }
+  user {
+    display_name
+    discord_users {
+        discord_id
+    }
+  }
+}
 """
 
     GUILD_FRAGMENT = """
@@ -120,21 +804,106 @@ fragment GuildFragment on Guild {
 """
 
 
-async def get_user_by_discord_id(discord_id):
-    query = (
-        GqlFragments.USER_FRAGMENT
-        + """
-query getUser($where: UserWhereInput!,) {
+operations.register(
+    "getUser",
+    """
+query getUser($where: UserWhereInput!) {
     result: users(
         where: $where,
     ) {
       ...UserFragment
     }
 }
+""",
+    GqlFragments.USER_FRAGMENT,
+)
+
+
+def parse_operation_seconds(value):
+    """Parses settings given per operation as "getUser=600,listGuilds=60" """
+    seconds = {}
+    for setting in (value or "").split(","):
+        if not setting.strip():
+            continue
+        name, _, amount = setting.partition("=")
+        seconds[name.strip()] = float(amount)
+    return seconds
+
+
+# seconds a cached record of each read operation may be served after it
+# expired, while it is refreshed in the background
+stale_ttls = parse_operation_seconds(constants.Protocol.stale_while_revalidate_seconds)
+
+
+def in_background(load):
+    """Wraps a load so it can run after the interaction which started it
+
+    The refresh isn't bound by the interaction's deadline and is sent
+    through the batch lane, so it never competes with interactions.
     """
+
+    async def refresh():
+        clear_deadline()
+        with use_lane(BATCH):
+            return await load()
+
+    return refresh
+
+
+def get_cache_redis():
+    if constants.Protocol.cache_redis_enable.lower() == "true":
+        return Redis
+    return None
+
+
+# users are cached under their discord id, and are refreshed from the
+# returned UserFragment whenever the bot creates or updates a user
+user_cache = TTLCache(
+    "user",
+    ttl=int(constants.Protocol.user_cache_ttl_seconds),
+    redis=get_cache_redis(),
+    stale_ttl=stale_ttls.get("getUser", 0),
+    max_entries=int(constants.Protocol.record_cache_max_entries),
+)
+
+
+async def cache_user(user):
+    if user is None:
+        return
+    for discord_user in user.get("discord_users") or []:
+        await user_cache.set(discord_user["discord_id"], user)
+
+
+async def invalidate_user(discord_id):
+    await user_cache.delete(str(discord_id))
+
+
+async def invalidate_users_with_address(address):
+    """Drops the cached users with an address, after it was set in bulk
+
+    A bulk update only returns the number of users it changed, so they
+    are looked up by the address they were given.
+    """
+    result = await execute_query(
+        operations.get("getUser"), {"where": {"address": {"equals": address}}}
     )
+    for user in (result or {}).get("result") or []:
+        for discord_user in user.get("discord_users") or []:
+            await invalidate_user(discord_user["discord_id"])
+
+
+async def get_user_by_discord_id(discord_id):
+    async def load():
+        return await fetch_user_by_discord_id(discord_id)
+
+    return await user_cache.get_or_refresh(
+        str(discord_id), load, store=cache_user, refresh=in_background(load)
+    )
+
+
+async def fetch_user_by_discord_id(discord_id):
     result = await execute_query(
-        query,
+        operations.get("getUser"),
         {
             "where": {
                 "discord_users": {"some": {"discord_id": {"equals": str(discord_id)}}}
@@ -150,19 +919,9 @@ query getUser($where: UserWhereInput!,) {
 
 
 async def get_user_by_wallet(wallet):
-    query = (
-        GqlFragments.USER_FRAGMENT
-        + """
-query getUser($where: UserWhereInput!) {
-    result: users(
-        where: $where
-    ) {
-        ...UserFragment
-    }
-}
-        """
+    result = await execute_query(
+        operations.get("getUser"), {"where": {"address": {"equals": wallet}}}
     )
-    result = await execute_query(query, {"where": {"address": {"equals": wallet}}})
     if result:
         res = result.get("result")
         if len(res):
@@ -171,24 +930,55 @@ query getUser($where: UserWhereInput!) {
     return result
 
 
-async def get_contributions(guild_id, user_discord_id, after_date):
-    query = (
-        GqlFragments.CONTRIBUTION_FRAGMENT
-        + """
-query listContributions($where: ContributionWhereInput! = {},
-                        $skip: Int! = 0,
-                        $orderBy: [ContributionOrderByWithRelationInput!]) {
+LIST_CONTRIBUTIONS_QUERY = """
+query %s($where: ContributionWhereInput! = {},
+         $skip: Int! = 0,
+         $take: Int,
+         $cursor: ContributionWhereUniqueInput,
+         $orderBy: [ContributionOrderByWithRelationInput!]) {
     result: contributions(
         where: $where,
         skip: $skip,
+        take: $take,
+        cursor: $cursor,
         orderBy: $orderBy,
     ) {
-      ...ContributionFragment
+      ...%s
     }
 }
+"""
 
-    """
+# maps a projection name to the list operation which selects its fields.
+# callers which only need a count should use count_contributions instead
+CONTRIBUTION_PROJECTIONS = {
+    "full": "listContributions",
+    "history-row": "listContributionHistoryRows",
+    "report-row": "listContributionReportRows",
+}
+
+for operation_name, fragment_name, fragment in (
+    ("listContributions", "ContributionFragment", GqlFragments.CONTRIBUTION_FRAGMENT),
+    (
+        "listContributionHistoryRows",
+        "ContributionHistoryRowFragment",
+        GqlFragments.CONTRIBUTION_HISTORY_ROW_FRAGMENT,
+    ),
+    (
+        "listContributionReportRows",
+        "ContributionReportRowFragment",
+        GqlFragments.CONTRIBUTION_REPORT_ROW_FRAGMENT,
+    ),
+):
+    operations.register(
+        operation_name,
+        LIST_CONTRIBUTIONS_QUERY % (operation_name, fragment_name),
+        fragment,
+        # pages of contributions take longer to build than single records
+        timeout=15,
     )
+
+
+def build_contributions_where(guild_id, user_discord_id, after_date):
     guild_clause = {
         "guilds": {"some": {"guild_id": {"equals": guild_id}}},
     }
@@ -204,7 +994,6 @@ query listContributions($where: ContributionWhereInput! = {},
     }
 
     clauses = []
-    data = {}
     if guild_id is not None:
         clauses.append(guild_clause)
     if after_date is not None:
@@ -212,67 +1001,114 @@ query listContributions($where: ContributionWhereInput! = {},
     if user_discord_id is not None:
         clauses.append(user_clause)
 
-    data = {"where": clauses[0]}
+    if not clauses:
+        return {}
     if len(clauses) > 1:
-        data = {"where": {"AND": clauses}}
+        return {"AND": clauses}
+    return clauses[0]
 
-    result = await execute_query(
-        query,
-        data,
-    )
-    if result:
-        res = result.get("result")
-        if len(res):
-            return res
-    return None
 
+async def iter_page(page):
+    for item in page or []:
+        yield item
 
-async def get_guild_by_discord_id(id):
-    query = (
-        GqlFragments.GUILD_FRAGMENT
-        + """
-query getGuild($where: GuildWhereUniqueInput!) {
-    result: guild(
-        where: $where,
-    ) {
-      ...GuildFragment
-    }
-}
+
+async def iter_contributions(
+    guild_id=None,
+    user_discord_id=None,
+    after_date=None,
+    page_size=None,
+    projection="full",
+    stream=False,
+):
+    """Iterates over contributions one page at a time
+
+    Pages are walked with a keyset cursor on the contribution id, so at
+    most one page of contributions is held in memory by the iterator.
+
+    Args:
+      guild_id: db id of the guild the contributions were reported to
+      user_discord_id: discord id of the user who made the contributions
+      after_date: only contributions submitted after this iso date
+      page_size: number of contributions fetched per request, defaults
+        to the configured page size
+      projection: name of the fields selected for each contribution,
+        one of CONTRIBUTION_PROJECTIONS
+      stream: decode each page while it is downloaded rather than once
+        it has been received, for large pages
+
+    Yields:
+      Each contribution matching the filters, ordered by id
     """
-    )
-    result = await execute_query(query, {"where": {"discord_id": str(id)}})
-    print("Get guild")
-    print(result)
-    if result:
-        return result.get("result")
-    return result
+    if page_size is None:
+        page_size = constants.Protocol.contributions_page_size
+    page_size = int(page_size)
+    query = operations.get(CONTRIBUTION_PROJECTIONS[projection])
+    values = {
+        "where": build_contributions_where(guild_id, user_discord_id, after_date),
+        "orderBy": [{"id": "asc"}],
+        "take": page_size,
+    }
+    while True:
+        if stream:
+            page = stream_query(query, values, ("result",))
+        else:
+            result = await execute_query(query, values)
+            page = iter_page(result.get("result") if result else None)
+        count = 0
+        last = None
+        async for contribution in page:
+            count += 1
+            last = contribution
+            yield contribution
+        if count < page_size:
+            return
+        # continue after the last contribution of this page
+        values = {**values, "cursor": {"id": last["id"]}, "skip": 1}
 
 
-async def get_guild_by_id(id):
-    query = (
-        GqlFragments.GUILD_FRAGMENT
-        + """
-query getGuild($where: GuildWhereUniqueInput!) {
-    result: guild(
-        where: $where,
-    ) {
-      ...GuildFragment
+async def get_contributions(guild_id, user_discord_id, after_date, projection="full"):
+    res = [
+        contribution
+        async for contribution in iter_contributions(
+            guild_id, user_discord_id, after_date, projection=projection
+        )
+    ]
+    if len(res):
+        return res
+    return None
+
+
+operations.register(
+    "countContributions",
+    """
+query countContributions($where: ContributionWhereInput! = {}) {
+    result: aggregateContribution(where: $where) {
+      _count {
+        _all
+      }
     }
 }
+""",
+)
+
+
+async def count_contributions(guild_id, user_discord_id, after_date) -> int:
+    """Returns the number of contributions matching the filters
+
+    The count is aggregated by the protocol api, so no contribution
+    records are sent back.
     """
-    )
-    result = await execute_query(query, {"where": {"id": id}})
-    print("Get guild")
-    print(result)
-    if result:
-        return result.get("result")
-    return result
+    values = {"where": build_contributions_where(guild_id, user_discord_id, after_date)}
+    result = await execute_query(operations.get("countContributions"), values)
+    if not result:
+        return 0
+    return result["result"]["_count"]["_all"]
 
 
-async def get_guilds():
-    query = (
-        GqlFragments.GUILD_FRAGMENT
-        + """
+operations.register(
+    "listGuilds",
+    """
 query listGuilds(
   $where: GuildWhereInput! = {}
   $skip: Int! = 0
@@ -282,27 +1118,202 @@ query listGuilds(
     ...GuildFragment
   }
 }
+""",
+    GqlFragments.GUILD_FRAGMENT,
+)
+
+
+async def get_guilds_by_ids(ids):
+    result = await execute_query(
+        operations.get("listGuilds"), {"where": {"id": {"in": list(ids)}}}
+    )
+    guilds = {}
+    if result:
+        guilds = {str(guild["id"]): guild for guild in result.get("result")}
+    return [guilds.get(str(id)) for id in ids]
+
+
+async def get_guilds_by_discord_ids(discord_ids):
+    discord_ids = [str(id) for id in discord_ids]
+    result = await execute_query(
+        operations.get("listGuilds"), {"where": {"discord_id": {"in": discord_ids}}}
+    )
+    guilds = {}
+    if result:
+        guilds = {guild["discord_id"]: guild for guild in result.get("result")}
+    return [guilds.get(id) for id in discord_ids]
+
+
+# guild lookups made in the same event loop tick are resolved with a
+# single listGuilds query
+guild_loader = DataLoader(get_guilds_by_ids)
+guild_discord_id_loader = DataLoader(get_guilds_by_discord_ids)
+
+
+# guilds are cached under both their discord id and db id, and are
+# invalidated whenever the bot creates or updates a guild
+guild_cache = TTLCache(
+    "guild",
+    ttl=int(constants.Protocol.guild_cache_ttl_seconds),
+    redis=get_cache_redis(),
+    stale_ttl=stale_ttls.get("listGuilds", 0),
+    max_entries=int(constants.Protocol.record_cache_max_entries),
+)
+
+
+async def cache_guild(guild):
+    if guild is None:
+        return
+    await guild_cache.set(f"discord_id:{guild['discord_id']}", guild)
+    await guild_cache.set(f"id:{guild['id']}", guild)
+
+
+async def invalidate_guild(guild_discord_id=None, guild_db_id=None):
+    keys = []
+    if guild_discord_id is not None:
+        keys.append(f"discord_id:{guild_discord_id}")
+    if guild_db_id is not None:
+        keys.append(f"id:{guild_db_id}")
+    # any change to a guild also changes the list of guilds
+    keys.append("list")
+    await guild_cache.delete(*keys)
+
+
+async def get_guild_by_discord_id(id):
+    async def load():
+        return await guild_discord_id_loader.load(str(id))
+
+    return await guild_cache.get_or_refresh(
+        f"discord_id:{id}", load, store=cache_guild, refresh=in_background(load)
+    )
+
+
+async def get_guild_by_id(id):
+    async def load():
+        return await guild_loader.load(id)
+
+    return await guild_cache.get_or_refresh(
+        f"id:{id}", load, store=cache_guild, refresh=in_background(load)
+    )
+
+
+operations.register(
+    "getUserGuildMembership",
+    """
+query getUserGuildMembership(
+  $userWhere: UserWhereInput!
+  $guildWhere: GuildWhereInput!
+  $membershipWhere: GuildUserWhereInput!
+) {
+  users(where: $userWhere, take: 1) {
+    ...UserFragment
+  }
+  guilds(where: $guildWhere, take: 1) {
+    ...GuildFragment
+  }
+  membership: guildUsers(where: $membershipWhere, take: 1) {
+    id
+  }
+}
+""",
+    GqlFragments.USER_FRAGMENT,
+    GqlFragments.GUILD_FRAGMENT,
+)
+
+
+def is_guild_member(user, guild):
+    if user is None or guild is None:
+        return False
+    return any(
+        guild_user.get("guild_id") == guild.get("id")
+        for guild_user in user.get("guild_users") or []
+    )
+
+
+async def get_user_guild_membership(user_discord_id, guild_discord_id):
+    """Resolves a user, a guild and whether the user is a member of it
+
+    The user and guild are read from the cache when both are cached,
+    otherwise all three are resolved with a single request.
+
+    Args:
+      user_discord_id: discord id of the user
+      guild_discord_id: discord id of the guild
+
+    Returns:
+      A (user, guild, is_member) tuple; user and guild are None if
+      they don't exist
     """
+    user_discord_id = str(user_discord_id)
+    guild_discord_id = str(guild_discord_id)
+    user = await user_cache.get(user_discord_id)
+    guild = await guild_cache.get(f"discord_id:{guild_discord_id}")
+    if user is not None and guild is not None:
+        return user, guild, is_guild_member(user, guild)
+
+    discord_user_where = {
+        "discord_users": {"some": {"discord_id": {"equals": user_discord_id}}}
+    }
+    guild_where = {"discord_id": {"equals": guild_discord_id}}
+    result = await execute_query(
+        operations.get("getUserGuildMembership"),
+        {
+            "userWhere": discord_user_where,
+            "guildWhere": guild_where,
+            "membershipWhere": {
+                "user": {"is": discord_user_where},
+                "guild": {"is": guild_where},
+            },
+        },
     )
-    result = await execute_query(query, None)
-    print("list guilds")
-    print(result)
+    if not result:
+        return None, None, False
+
+    user = next(iter(result.get("users") or []), None)
+    guild = next(iter(result.get("guilds") or []), None)
+    await cache_user(user)
+    await cache_guild(guild)
+    return user, guild, bool(result.get("membership"))
+
+
+async def fetch_guilds():
+    result = await execute_query(operations.get("listGuilds"), None)
     if result:
         return result.get("result")
     return result
 
 
-async def create_guild_user(user_id: str, guild_db_id: str):
-    query = """
+async def get_guilds():
+    return await guild_cache.get_or_refresh(
+        "list", fetch_guilds, refresh=in_background(fetch_guilds)
+    )
+
+
+def get_cache_stats():
+    """Returns the hit, miss and refresh counts of the record caches"""
+    return {"user": user_cache.stats(), "guild": guild_cache.stats()}
+
+
+operations.register(
+    "createGuildUser",
+    """
 mutation createGuildUser($data: GuildUserCreateInput!) {
   createOneGuildUser(data: $data) {
     guild_id
     user_id
+    user {
+      ...UserFragment
+    }
   }
 }
-    """
+""",
+    GqlFragments.USER_FRAGMENT,
+)
+
+
+async def create_guild_user(user_id: str, guild_db_id: str):
     result = await execute_query(
-        query,
+        operations.get("createGuildUser"),
         {
             "data": {
                 "guild": {"connect": {"id": guild_db_id}},
@@ -310,41 +1321,54 @@ mutation createGuildUser($data: GuildUserCreateInput!) {
             }
         },
     )
-    if result:
-        return result.get("createGuildUser")
-    return result
+    guild_user = result.get("createOneGuildUser") if result else None
+    if guild_user:
+        await cache_user(guild_user.get("user"))
+    return guild_user
 
 
-async def create_guild(guild_id):
-    query = """
+operations.register(
+    "createGuild",
+    """
 mutation createGuild($data: GuildCreateInput!) {
   createOneGuild(data: $data) {
     id
     discord_id
   }
 }
-    """
+""",
+)
+
+
+async def create_guild(guild_id):
     result = await execute_query(
-        query,
+        operations.get("createGuild"),
         {
             "data": {
                 "discord_id": str(guild_id),
             }
         },
     )
+    await invalidate_guild(guild_discord_id=guild_id)
     if result:
-        return result.get("createGuild")
+        return result.get("createOneGuild")
     return result
 
 
-async def create_user(discord_id, discord_name, wallet):
-    query = """
+operations.register(
+    "createUser",
+    """
 mutation createUser($data: UserCreateInput!) {
   createOneUser(data: $data) {
-    id
+    ...UserFragment
   }
 }
-    """
+""",
+    GqlFragments.USER_FRAGMENT,
+)
+
+
+async def create_user(discord_id, discord_name, wallet):
     data = {
         "data": {
             "address": wallet,
@@ -365,7 +1389,7 @@ mutation createUser($data: UserCreateInput!) {
     result = None
     try:
         result = await execute_query(
-            query,
+            operations.get("createUser"),
             data,
         )
     except TransportQueryError as e:
@@ -377,10 +1401,117 @@ mutation createUser($data: UserCreateInput!) {
             )
             raise UserWithAddressAlreadyExists(err)
 
-    if result:
-        print(result)
-        return result.get("createUser")
-    return result
+    user = result.get("createOneUser") if result else None
+    if user:
+        await cache_user(user)
+    else:
+        await invalidate_user(discord_id)
+    return user
+
+
+operations.register(
+    "createOnboardedUser",
+    """
+mutation createOnboardedUser(
+  $data: UserCreateInput!
+  $wallet: String!
+  $releasedWallet: String!
+) {
+  released: updateManyUser(
+    where: { address: { equals: $wallet } }
+    data: { address: { set: $releasedWallet } }
+  ) {
+    count
+  }
+  user: createOneUser(data: $data) {
+    ...UserFragment
+  }
+}
+""",
+    GqlFragments.USER_FRAGMENT,
+)
+
+
+async def create_onboarded_user(
+    discord_id, discord_name, display_name, wallet, guild_discord_id, released_wallet
+):
+    """Creates a user and their membership of a guild in one request
+
+    The user is created with their display name, discord user and guild
+    membership nested in a single create. Any other user with the same
+    wallet is first pointed at released_wallet instead; mutation roots
+    run in order, so this happens before the user is created. Users
+    whose wallet was released are then dropped from the user cache,
+    which takes one more request only if there were any.
+
+    Args:
+      discord_id: discord id of the user
+      discord_name: discord display name of the user
+      display_name: display name the user chose for their profile
+      wallet: verified wallet address of the user
+      guild_discord_id: discord id of the guild the user joined
+      released_wallet: address set on other users with the same wallet
+
+    Returns:
+      The created user
+    """
+    data = {
+        "address": wallet,
+        "chain_type": {"connect": {"name": "ETH"}},
+        "display_name": display_name,
+        "name": display_name,
+        "discord_users": {
+            "connectOrCreate": [
+                {
+                    "create": {
+                        "discord_id": str(discord_id),
+                        "display_name": discord_name,
+                    },
+                    "where": {"discord_id": str(discord_id)},
+                }
+            ]
+        },
+        "guild_users": {
+            "create": [{"guild": {"connect": {"discord_id": str(guild_discord_id)}}}]
+        },
+    }
+    try:
+        result = await execute_query(
+            operations.get("createOnboardedUser"),
+            {"data": data, "wallet": wallet, "releasedWallet": released_wallet},
+        )
+    except TransportQueryError as e:
+        if is_unique_constraint_failure(e):
+            err = (
+                f"A user with wallet address {wallet} already exists! "
+                "Please use a different wallet address to setup your "
+                "profile."
+            )
+            raise UserWithAddressAlreadyExists(err)
+        raise
+
+    user = result.get("user") if result else None
+    if user:
+        await cache_user(user)
+    else:
+        await invalidate_user(discord_id)
+    released = (result or {}).get("released") or {}
+    if released.get("count"):
+        await invalidate_users_with_address(released_wallet)
+    return user
+
+
+operations.register(
+    "updateUser",
+    """
+mutation updateUser($data: UserUpdateInput!, $where: UserWhereUniqueInput!) {
+  updateOneUser(data: $data, where: $where) {
+    ...UserFragment
+  }
+}
+""",
+    GqlFragments.USER_FRAGMENT,
+)
 
 
 # have a different update query for each field
@@ -389,24 +1520,13 @@ mutation createUser($data: UserCreateInput!) {
 # twitter
 # discourse
 async def update_user(data, where):
-    query = (
-        GqlFragments.USER_FRAGMENT
-        + """
-mutation updateUser($data: UserUpdateInput!, $where: UserWhereUniqueInput!) {
-  updateOneUser(data: $data, where: $where) {
-    ...UserFragment
-  }
-}
-    """
-    )
     result = await execute_query(
-        query,
+        operations.get("updateUser"),
         {"data": data, "where": where},
     )
-    if result:
-        print(result)
-        return result.get("updateUser")
-    return result
+    user = result.get("updateOneUser") if result else None
+    await cache_user(user)
+    return user
 
 
 async def update_user_display_name(id, display_name):
@@ -435,25 +1555,64 @@ async def update_user_wallet(id, wallet):
     return await update_user({"address": {"set": wallet}}, {"id": id})
 
 
-async def update_guild_name(guild_discord_id, guild_name):
-    query = """
+async def transfer_user_wallet(id, wallet, previous_id, released_wallet):
+    """Moves a wallet to a user from the user who was using it
+
+    Both updates are sent in one request. The previous user is updated
+    first, so the wallet is free by the time it is set on the user.
+
+    Args:
+      id: db id of the user the wallet is moved to
+      wallet: the wallet address
+      previous_id: db id of the user currently using the wallet
+      released_wallet: address set on the previous user
+
+    Returns:
+      The updated user
+    """
+    previous_user, user = await execute_batch(
+        [
+            (
+                "updateUser",
+                {
+                    "data": {"address": {"set": released_wallet}},
+                    "where": {"id": previous_id},
+                },
+            ),
+            ("updateUser", {"data": {"address": {"set": wallet}}, "where": {"id": id}}),
+        ]
+    )
+    await cache_user(previous_user.get("updateOneUser"))
+    await cache_user(user.get("updateOneUser"))
+    return user.get("updateOneUser")
+
+
+operations.register(
+    "updateGuild",
+    """
 mutation updateGuild($data: GuildUpdateInput!, $where: GuildWhereUniqueInput!) {
   updateOneGuild(data: $data, where: $where) {
     id
+    discord_id
   }
 }
-"""
+""",
+)
+
+
+async def update_guild_name(guild_discord_id, guild_name):
     result = await execute_query(
-        query,
+        operations.get("updateGuild"),
         {
             "data": {"name": {"set": str(guild_name)}},
             "where": {"discord_id": str(guild_discord_id)},
         },
     )
-    if result:
-        print(result)
-        return result.get("updateGuild")
-    return result
+    guild = result.get("updateOneGuild") if result else None
+    await invalidate_guild(
+        guild_discord_id=guild_discord_id, guild_db_id=guild and guild.get("id")
+    )
+    return guild
 
 
 def is_unique_constraint_failure(err: TransportQueryError):
@@ -0,0 +1,134 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+class _Buffer:
+    """Text decoded from a stream of bytes which is consumed as it is read
+
+    Only the part of the document which hasn't been consumed yet is kept,
+    so memory is bounded by the largest single value rather than by the
+    size of the document.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    async def fill(self):
+        if self.eof:
+            raise JsonStreamError("Unexpected end of json document")
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self.eof = True
+            text = self._utf8.decode(b"", final=True)
+        else:
+            text = self._utf8.decode(chunk)
+        self.text = self.text[self.pos :] + text
+        self.pos = 0
+
+    async def peek(self):
+        """Skips whitespace and returns the next character"""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            await self.fill()
+
+    async def expect(self, chars):
+        char = await self.peek()
+        if char not in chars:
+            raise JsonStreamError(
+                f"Expected {' or '.join(chars)} but found {char!r} in json document"
+            )
+        self.pos += 1
+        return char
+
+    async def value(self):
+        """Decodes the next complete json value"""
+        await self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            await self.fill()
+
+
+class JsonArrayStream:
+    """Decodes the items of an array nested in a json document as it arrives
+
+    Iterating yields each item of the array found at path as soon as its
+    bytes have been read, so decoding overlaps the download and only one
+    item is held at a time. The rest of the document is decoded as usual
+    and is available in document once iteration is over, with the array
+    left empty.
+
+    Args:
+      chunks: async iterable of the bytes of the document
+      path: keys of the objects leading to the array, e.g.
+        ("data", "result")
+    """
+
+    def __init__(self, chunks, path):
+        self.chunks = chunks
+        self.path = tuple(path)
+        self.document = {}
+        self.found = False
+
+    async def __aiter__(self):
+        buffer = _Buffer(self.chunks)
+        async for item in self._walk_object(buffer, self.path, self.document):
+            yield item
+
+    async def _walk_object(self, buffer, path, container):
+        await buffer.expect("{")
+        if await buffer.peek() == "}":
+            buffer.pos += 1
+            return
+        while True:
+            key = await buffer.value()
+            if not isinstance(key, str):
+                raise JsonStreamError(f"Expected an object key but found {key!r}")
+            await buffer.expect(":")
+            char = await buffer.peek()
+            if key == path[0] and len(path) == 1 and char == "[":
+                container[key] = []
+                self.found = True
+                async for item in self._walk_array(buffer):
+                    yield item
+            elif key == path[0] and len(path) > 1 and char == "{":
+                container[key] = {}
+                async for item in self._walk_object(buffer, path[1:], container[key]):
+                    yield item
+            else:
+                container[key] = await buffer.value()
+            if await buffer.expect(",}") == "}":
+                return
+
+    async def _walk_array(self, buffer):
+        await buffer.expect("[")
+        if await buffer.peek() == "]":
+            buffer.pos += 1
+            return
+        while True:
+            yield await buffer.value()
+            if await buffer.expect(",]") == "]":
+                return
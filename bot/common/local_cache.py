@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+
+from bot.common.cache import Cache, CachePipeline
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "cache-invalidations"
+
+# pipeline commands which change the key they're given
+WRITE_COMMANDS = {"set", "delete", "hset"}
+
+
+def _get_field(fields, field):
+    # the redis client returns the field names of a hash as bytes
+    if field in fields:
+        return fields[field]
+    if isinstance(field, str):
+        return fields.get(field.encode("utf-8"))
+    return None
+
+
+def _size(value):
+    if isinstance(value, dict):
+        return sum(_size(name) + _size(field) for name, field in value.items())
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LocalCache(Cache):
+    """Keeps recently read values of a cache in process
+
+    Values read with get and hashes read with hgetall are kept for ttl
+    seconds, dropping the least recently used ones beyond max_entries or
+    max_bytes. Every write drops the key here and, when a redis client
+    is given, publishes it so the other replicas drop it as well. Local
+    values are only served while subscribed to those invalidations, and
+    everything is dropped if the subscription is lost, since messages
+    may have been missed.
+
+    Args:
+      cache: the underlying cache, written to and read from on misses
+      redis: optional aioredis client for the invalidation channel
+      max_entries: maximum values kept
+      max_bytes: maximum approximate size of the values kept
+      ttl: seconds a value is kept, bounding how stale it can be
+      channel: pub/sub channel of the invalidations
+      retry_seconds: longest wait before subscribing again after the
+        subscription failed, doubling from a second after each failure
+    """
+
+    def __init__(
+        self,
+        cache,
+        redis=None,
+        max_entries=1000,
+        max_bytes=1 << 20,
+        ttl=30,
+        channel=INVALIDATION_CHANNEL,
+        retry_seconds=60,
+    ):
+        self.cache = cache
+        self.redis = redis
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.channel = channel
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.subscribed = redis is None
+        # bumped by every invalidation, so a read that raced one isn't kept
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.retry_seconds = retry_seconds
+        self._listener = None
+        self._retry_delay = 0
+        self._failed_at = None
+
+    # Entries #
+
+    def _lookup(self, kind, key):
+        if self.redis is not None:
+            self._listen_in_background()
+        if not self.subscribed:
+            return False, None
+        entry = self.entries.get(str(key))
+        if entry is None or entry[0] != kind or entry[1] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(str(key))
+        self.hits += 1
+        return True, entry[3]
+
+    def _store(self, kind, key, value, generation):
+        if generation != self.generation or not self.subscribed:
+            return
+        key = str(key)
+        self._drop_entry(key)
+        size = _size(key) + _size(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (kind, time.monotonic() + self.ttl, size, value)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, _, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def _drop_entry(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def drop(self, keys):
+        """Drops keys here only, e.g. when another replica changed them"""
+        self.generation += 1
+        for key in keys:
+            self._drop_entry(str(key))
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.bytes = 0
+
+    async def invalidate(self, keys):
+        """Drops keys here and in every other replica"""
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        self.drop(keys)
+        if self.redis is not None:
+            await self.redis.publish(self.channel, json.dumps(keys))
+
+    # Invalidation channel #
+
+    def _listen_in_background(self):
+        if self._listener is not None and not self._listener.done():
+            return
+        if (
+            self._failed_at is not None
+            and time.monotonic() - self._failed_at < self._retry_delay
+        ):
+            # reads go to the underlying cache until it's time to retry
+            return
+        self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub()
+        try:
+            await pubsub.subscribe(self.channel)
+            self.subscribed = True
+            self._retry_delay = 0
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.drop(json.loads(message["data"]))
+        except Exception:
+            self._retry_delay = min(self.retry_seconds, max(1, self._retry_delay * 2))
+            logger.exception(
+                "Stopped listening for cache invalidations, "
+                f"retrying in {self._retry_delay}s"
+            )
+        finally:
+            self._failed_at = time.monotonic()
+            self.subscribed = False
+            self.clear()
+            await pubsub.reset()
+
+    # Cache #
+
+    async def get(self, key):
+        found, value = self._lookup("value", key)
+        if found:
+            return value
+        generation = self.generation
+        value = await self.cache.get(key)
+        self._store("value", key, value, generation)
+        return value
+
+    async def hgetall(self, key):
+        found, value = self._lookup("hash", key)
+        if found:
+            return dict(value)
+        generation = self.generation
+        value = await self.cache.hgetall(key)
+        self._store("hash", key, dict(value), generation)
+        return value
+
+    async def hget(self, key, field):
+        found, value = self._lookup("hash", key)
+        if found:
+            return _get_field(value, field)
+        return await self.cache.hget(key, field)
+
+    async def get_many(self, keys):
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None):
+        try:
+            return await self.cache.set(key, value, ex=ex)
+        finally:
+            await self.invalidate([key])
+
+    async def delete(self, key):
+        try:
+            return await self.cache.delete(key)
+        finally:
+            await self.invalidate([key])
+
+    async def hset(self, key, mapping, ex=None):
+        try:
+            return await self.cache.hset(key, mapping, ex=ex)
+        finally:
+            await self.invalidate([key])
+
+    async def set_hash(self, key, mapping, ex=None):
+        try:
+            return await self.cache.set_hash(key, mapping, ex=ex)
+        finally:
+            await self.invalidate([key])
+
+    async def expire(self, key, seconds):
+        # local values are kept for at most ttl, so they aren't dropped
+        return await self.cache.expire(key, seconds)
+
+    async def set_many(self, mapping, ex=None):
+        try:
+            return await self.cache.set_many(mapping, ex=ex)
+        finally:
+            await self.invalidate(list(mapping))
+
+    async def delete_many(self, keys):
+        try:
+            return await self.cache.delete_many(keys)
+        finally:
+            await self.invalidate(keys)
+
+    async def write_hash_if(
+        self, key, field, expected, mapping, replace=False, ex=None
+    ):
+        # the check is made against the underlying cache, never a local copy
+        try:
+            return await self.cache.write_hash_if(
+                key, field, expected, mapping, replace=replace, ex=ex
+            )
+        finally:
+            await self.invalidate([key])
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self, transaction)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+class LocalPipeline(CachePipeline):
+    """Sends the queued commands through the underlying cache's pipeline"""
+
+    def __init__(self, local, transaction=True):
+        super().__init__(local)
+        self.transaction = transaction
+
+    async def execute(self):
+        commands = self._take()
+        written = [args[0] for name, args, _ in commands if name in WRITE_COMMANDS]
+        try:
+            async with self.cache.cache.pipeline(self.transaction) as pipe:
+                pipe.commands = commands
+                return await pipe.execute()
+        finally:
+            await self.cache.invalidate(written)
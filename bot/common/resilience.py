@@ -0,0 +1,157 @@
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# monotonic time by which the current interaction must be done talking
+# to the protocol api. Every event is handled in its own task, so the
+# deadline only applies to the interaction which set it
+_deadline = contextvars.ContextVar("protocol_deadline", default=None)
+
+
+def set_deadline(seconds):
+    """Starts a deadline budget for the current interaction
+
+    Args:
+      seconds: seconds the interaction may spend on protocol api calls
+
+    Returns:
+      A token which can be passed to reset_deadline
+    """
+    return _deadline.set(time.monotonic() + float(seconds))
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def clear_deadline():
+    """Lifts the deadline for the rest of the current task
+
+    Used by background work started during an interaction, which
+    inherits the interaction's deadline but outlives it.
+    """
+    _deadline.set(None)
+
+
+def remaining_budget():
+    """Returns the seconds left before the deadline, or None if unset"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter
+
+    Args:
+      attempts: total number of attempts, including the first one
+      base: backoff in seconds before the first retry
+      cap: maximum backoff in seconds
+    """
+
+    def __init__(self, attempts=3, base=0.1, cap=1.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+
+class CircuitBreaker:
+    """Fails fast while the protocol api is erroring
+
+    The outcome of the last window_size requests is tracked. Once at
+    least min_requests have been made and the share of failures reaches
+    failure_rate the breaker opens, and requests are rejected without
+    being sent. After reset_timeout seconds a single trial request is
+    let through (half open); its outcome closes or reopens the breaker.
+    allow_request returns a permit for every request it lets through. A
+    trial which ends without an outcome, e.g. because it was cancelled,
+    is released by passing its permit to record_abandoned, and a trial
+    which has run for reset_timeout seconds is given up on so another
+    can be made.
+
+    Args:
+      failure_rate: share of failed requests which opens the breaker
+      window_size: number of recent requests which are tracked
+      min_requests: requests needed in the window before opening
+      reset_timeout: seconds the breaker stays open
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_rate=0.5, window_size=20, min_requests=10, reset_timeout=30
+    ):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at = None
+        # permit of the half open trial in flight
+        self._trial = None
+        self._trial_started_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return CircuitBreaker.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return CircuitBreaker.HALF_OPEN
+        return CircuitBreaker.OPEN
+
+    def allow_request(self):
+        """Returns a permit for the request, or None if it is rejected"""
+        state = self.state
+        if state == CircuitBreaker.CLOSED:
+            return True
+        if state != CircuitBreaker.HALF_OPEN:
+            return None
+        now = time.monotonic()
+        if (
+            self._trial is not None
+            and now - self._trial_started_at < self.reset_timeout
+        ):
+            return None
+        self._trial = object()
+        self._trial_started_at = now
+        return self._trial
+
+    def record_abandoned(self, permit):
+        """Releases the half open trial if it's the request with no outcome"""
+        if permit is self._trial:
+            self._trial = None
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info("Protocol api circuit breaker closed")
+            self._opened_at = None
+            self._outcomes.clear()
+        self._trial = None
+        self._outcomes.append(True)
+
+    def record_failure(self):
+        self._trial = None
+        if self._opened_at is not None:
+            # the half open trial failed
+            self._opened_at = time.monotonic()
+            return
+        self._outcomes.append(False)
+        failures = self._outcomes.count(False)
+        if (
+            len(self._outcomes) >= self.min_requests
+            and failures / len(self._outcomes) >= self.failure_rate
+        ):
+            logger.warning(
+                f"Protocol api circuit breaker opened after {failures} "
+                f"failures in {len(self._outcomes)} requests"
+            )
+            self._opened_at = time.monotonic()
@@ -0,0 +1,127 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# lane of the protocol api requests made by the current task. Requests
+# are interactive unless a background job says otherwise
+_lane = contextvars.ContextVar("protocol_lane", default=INTERACTIVE)
+
+
+def get_lane():
+    return _lane.get()
+
+
+@contextlib.contextmanager
+def use_lane(lane):
+    """Sends the protocol api requests made in the block through a lane"""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class PriorityScheduler:
+    """Limits concurrent requests per lane, serving lanes by priority
+
+    Each lane may run at most its own limit of requests at once, and all
+    lanes together at most total. When a slot frees up the waiting
+    requests of the first lane are let through before those of any
+    later lane, and a request never starts while a higher priority one
+    is waiting, so queued batch work can't delay interactive requests.
+
+    Args:
+      limits: maximum concurrent requests of each lane, in priority order
+      total: maximum concurrent requests across all lanes
+    """
+
+    def __init__(self, limits, total=None):
+        self.lanes = list(limits)
+        self.limits = dict(limits)
+        self.total = total or sum(self.limits.values())
+        self.active = {lane: 0 for lane in self.lanes}
+        self.waited = {lane: 0 for lane in self.lanes}
+        self.wait_seconds = {lane: 0.0 for lane in self.lanes}
+        self._waiters = {lane: deque() for lane in self.lanes}
+
+    def _has_room(self, lane):
+        return (
+            self.active[lane] < self.limits[lane]
+            and sum(self.active.values()) < self.total
+        )
+
+    def _is_first(self, lane):
+        # no request of this lane or of a higher priority one is waiting
+        for other in self.lanes:
+            if self._waiters[other]:
+                return False
+            if other == lane:
+                return True
+
+    async def acquire(self, lane):
+        if self._is_first(lane) and self._has_room(lane):
+            self.active[lane] += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the request was cancelled
+                self.release(lane)
+            elif waiter in self._waiters[lane]:
+                self._waiters[lane].remove(waiter)
+                self._wake()
+            raise
+        self.waited[lane] += 1
+        self.wait_seconds[lane] += time.monotonic() - started
+
+    def release(self, lane):
+        self.active[lane] -= 1
+        self._wake()
+
+    def _wake(self):
+        for lane in self.lanes:
+            waiters = self._waiters[lane]
+            while waiters and self._has_room(lane):
+                waiter = waiters.popleft()
+                if waiter.done():
+                    # cancelled before it could be removed
+                    continue
+                self.active[lane] += 1
+                waiter.set_result(None)
+            if waiters:
+                # lower priority lanes wait until this one is served
+                return
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane=None):
+        """Holds a slot of a lane, by default the lane of the current task"""
+        lane = lane or get_lane()
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def stats(self):
+        return {
+            lane: {
+                "active": self.active[lane],
+                "waiting": len(self._waiters[lane]),
+                "waited": self.waited[lane],
+                "wait_seconds": self.wait_seconds[lane],
+            }
+            for lane in self.lanes
+        }
@@ -0,0 +1,22 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def log_stats(sources):
+    """Logs the counters of the bot's caches and queues
+
+    Args:
+      sources: names mapped to functions which return a dict of counters
+
+    Returns:
+      The counters of every source, under its name
+    """
+    stats = {}
+    for name, get_stats in sources.items():
+        try:
+            stats[name] = get_stats()
+        except Exception:
+            logger.exception(f"Failed to read the {name} stats")
+    logger.info(f"Stats: {stats}")
+    return stats
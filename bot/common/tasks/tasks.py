@@ -7,7 +7,13 @@ from datetime import timedelta, datetime, time
 from discord.ext import tasks, commands
 
 from bot.common.tasks.weekly_contributions import send_weekly_contribution_reports
+from bot.common.tasks.thread_states import sweep_thread_states
+from bot.common.tasks.stats import log_stats
+from bot.common.graphql import get_cache_stats
+from bot.common.commands import event_executor
 from bot.common.cache import Cache
+from bot.common.scheduler import BATCH, use_lane
+from bot.constants import BotCache as CacheConstants
 from bot.constants import BotTasks as TaskConstants
 
 logger = logging.getLogger(__name__)
@@ -228,7 +234,10 @@ class ReportingTask(commands.Cog):
             )
             return
 
-        await send_weekly_contribution_reports(self.bot)
+        # the reports are sent through the batch lane, so they never hold
+        # up the protocol api requests of interactions
+        with use_lane(BATCH):
+            await send_weekly_contribution_reports(self.bot)
 
         # update cache
         await self.cache.set(
@@ -243,8 +252,89 @@ class ReportingTask(commands.Cog):
         logger.error(f"Unhandled error in reporting: {ex}")
 
 
+class ThreadStateSweepTask(commands.Cog):
+    """Periodically expires the thread states left without an expiry"""
+
+    def __init__(self, bot: discord.Bot, cache: Cache, loop_settings):
+        self.bot = bot
+        self.cache = cache
+        self.idle_seconds: int = loop_settings["idle_seconds"]
+        self.last_report = None
+        self.init_loop(loop_settings)
+
+    def init_loop(self, loop_settings):
+        if not loop_settings.get("enable"):
+            logger.info("thread state sweep disabled, skipping...")
+            return
+
+        m = loop_settings["sweep_period_minutes"]
+        self.sweep: tasks.Loop = tasks.loop(minutes=m)(self.sweep)
+        self.sweep.before_loop(self.wait_until_ready)
+        self.sweep.start()
+        self.sweep.error(self.handle_error)
+
+    async def sweep(self):
+        self.last_report = await sweep_thread_states(self.cache, self.idle_seconds)
+
+    async def wait_until_ready(self):
+        await self.bot.wait_until_ready()
+
+    async def handle_error(self, ex):
+        logger.error(f"Unhandled error in thread state sweep: {ex}")
+
+
+class StatsTask(commands.Cog):
+    """Periodically logs the counters of the bot's caches and queues"""
+
+    def __init__(self, bot: discord.Bot, sources, loop_settings):
+        self.bot = bot
+        self.sources = sources
+        self.last_stats = None
+        self.init_loop(loop_settings)
+
+    def init_loop(self, loop_settings):
+        if not loop_settings.get("enable"):
+            logger.info("stats logging disabled, skipping...")
+            return
+
+        m = loop_settings["log_period_minutes"]
+        self.log: tasks.Loop = tasks.loop(minutes=m)(self.log)
+        self.log.before_loop(self.wait_until_ready)
+        self.log.start()
+        self.log.error(self.handle_error)
+
+    async def log(self):
+        self.last_stats = log_stats(self.sources)
+
+    async def wait_until_ready(self):
+        await self.bot.wait_until_ready()
+
+    async def handle_error(self, ex):
+        logger.error(f"Unhandled error in stats logging: {ex}")
+
+
 def init_bot_tasks(bot: discord.Bot, cache: Cache):
     bot.add_cog(get_reporting_task(bot, cache))
+    bot.add_cog(get_thread_state_sweep_task(bot, cache))
+    bot.add_cog(get_stats_task(bot))
+
+
+def get_stats_task(bot: discord.Bot) -> discord.Cog:
+    minutes = int(TaskConstants.stats_log_minutes)
+    settings = {"enable": minutes > 0, "log_period_minutes": minutes}
+    sources = {"protocol_cache": get_cache_stats, "events": event_executor.stats}
+    return StatsTask(bot, sources, settings)
+
+
+def get_thread_state_sweep_task(bot: discord.Bot, cache: Cache) -> discord.Cog:
+    idle_seconds = int(CacheConstants.thread_state_idle_seconds)
+    settings = {
+        # without an idle expiry there's nothing to sweep
+        "enable": idle_seconds > 0,
+        "idle_seconds": idle_seconds,
+        "sweep_period_minutes": int(CacheConstants.thread_state_sweep_minutes),
+    }
+    return ThreadStateSweepTask(bot, cache, settings)
 
 
 def get_reporting_task(bot: discord.Bot, cache: Cache) -> discord.Cog:
@@ -0,0 +1,69 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# thread states are stored under the bare user id
+THREAD_STATE_MATCH = "[0-9]*"
+
+
+def _is_thread_state_key(key):
+    key = key.decode("utf-8") if isinstance(key, bytes) else key
+    return key.isdigit()
+
+
+async def sweep_thread_states(redis, idle_seconds, count=500):
+    """Expires the thread states which were written without an expiry
+
+    Thread states expire after idle_seconds without a step, but states
+    written before that expiry was introduced never do. Those idle for
+    longer than idle_seconds are deleted, the others are given the rest
+    of their idle time to live.
+
+    Args:
+      redis: aioredis client
+      idle_seconds: seconds a conversation may sit idle
+      count: keys scanned per round trip
+
+    Returns:
+      A report of the states scanned, those still active, those given an
+      expiry and those deleted as expired
+    """
+    report = {"scanned": 0, "active": 0, "expiry_added": 0, "expired": 0}
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match=THREAD_STATE_MATCH, count=count)
+        keys = [key for key in keys if _is_thread_state_key(key)]
+        if keys:
+            await _sweep_keys(redis, keys, idle_seconds, report)
+        if not cursor:
+            break
+    logger.info(f"Swept thread states: {report}")
+    return report
+
+
+async def _sweep_keys(redis, keys, idle_seconds, report):
+    # neither command counts as an access, so idle times are left as they are
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.ttl(key)
+            pipe.object("idletime", key)
+        # idle times aren't kept under an lfu eviction policy
+        results = await pipe.execute(raise_on_error=False)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for key, ttl, idle in zip(keys, results[::2], results[1::2]):
+            if ttl == -2:
+                # gone since it was scanned
+                continue
+            report["scanned"] += 1
+            if ttl >= 0:
+                report["active"] += 1
+                continue
+            idle = idle if isinstance(idle, int) else 0
+            if idle >= idle_seconds:
+                pipe.delete(key)
+                report["expired"] += 1
+            else:
+                pipe.expire(key, idle_seconds - idle)
+                report["expiry_added"] += 1
+        await pipe.execute()
@@ -8,9 +8,10 @@ from datetime import datetime, timedelta
 from discord import EmbedField, File, Embed, Bot
 
 from bot.common.graphql import (
-    get_contributions,
+    iter_contributions,
     get_guild_by_discord_id,
     get_guilds,
+    session_manager,
 )
 
 from bot import constants
@@ -51,7 +52,10 @@ async def send_weekly_contribution_reports(bot: Bot):
     if govrn_guild_discord_id is None:
         warn_msg = "No discord id specified for govrn"
 
-    govrn_guild = await get_guild_by_discord_id(govrn_guild_discord_id)
+    # get the govrn guild and the guilds for reporting together
+    govrn_guild, guilds_to_report = await asyncio.gather(
+        get_guild_by_discord_id(govrn_guild_discord_id), get_guilds_to_report()
+    )
     if govrn_guild is None:
         warn_msg = f"No guild found for govrn discord id {govrn_guild_discord_id}"
 
@@ -71,9 +75,6 @@ async def send_weekly_contribution_reports(bot: Bot):
             "reporting channels since no default is specified."
         )
 
-    # get guilds for reporting
-    guilds_to_report = await get_guilds_to_report()
-
     reports = await generate_guild_contribution_reports(guilds_to_report)
 
     await send_reports(bot, default_reporting_channel_id, guilds_to_report, reports)
@@ -232,24 +233,22 @@ async def generate_guild_contribution_reports(
 async def create_all_contributions_dataframe() -> pd.DataFrame:
     """Returns a dataframe as below, but with every contribution"""
     beginning_of_time = datetime.now() - timedelta(weeks=52 * 20)
-    records = await get_contributions(
-        guild_id=None, user_discord_id=None, after_date=beginning_of_time.isoformat()
-    )
+    logger.info("constructing dataframe for all contributions")
 
-    # convert records from json to df
+    # contributions are flattened into rows page by page, so the full
+    # contribution records are never held in memory at once
     df_rows = []
     df_index = []
+    async for rec in iter_contributions(
+        after_date=beginning_of_time.isoformat(), projection="report-row", stream=True
+    ):
+        df_rows.append({**get_contribution_row(rec), "guilds": get_guild_name(rec)})
+        df_index.append(rec["id"])
 
-    logger.info("constructing dataframe for all contributions")
-
-    if not records:
+    if not df_rows:
         logger.info("No contributions reported")
         return None
 
-    for rec in records:  # this part can be optimized for speed later
-        df_rows.append(rec)
-        df_index.append(rec["id"])
-
     df = pd.DataFrame(df_rows, index=df_index)
 
     df = df[
@@ -261,15 +260,10 @@ async def create_all_contributions_dataframe() -> pd.DataFrame:
             "guilds",
             "date_of_engagement",
             "date_of_submission",
+            "discord_id",
         ]
     ]
 
-    df["activity_type"] = df.apply(lambda x: x["activity_type"]["name"], axis=1)
-    df["discord_id"] = df.apply(lambda x: get_user_discord_id(x), axis=1)
-    df["user"] = df.apply(lambda x: x["user"]["display_name"], axis=1)
-    df["status"] = df.apply(lambda x: x["status"]["name"], axis=1)
-    df["guilds"] = df.apply(lambda x: get_guild_name(x), axis=1)
-
     # rename columns
     df = df.rename(
         columns={
@@ -296,24 +290,22 @@ async def create_guild_dataframe(guild_id: int) -> pd.DataFrame:
     """Returns the community's weekly csv given the guild name."""
     logger.info(f"retrieving contributions for guild {guild_id}...")
 
-    records = await get_contributions(guild_id, user_discord_id=None, after_date=None)
-
-    logger.info(f"done retrieving contributions for guild {guild_id}")
-
-    # convert records from json to df
     df_rows = []
     df_index = []
+    async for rec in iter_contributions(
+        guild_id=guild_id, projection="report-row", stream=True
+    ):
+        df_rows.append(get_contribution_row(rec))
+        df_index.append(rec["id"])
+
+    logger.info(f"done retrieving contributions for guild {guild_id}")
 
     logger.info(f"constructing dataframe for guild {guild_id}...")
 
-    if not records:
+    if not df_rows:
         logger.info(f"No contributions reported for {guild_id}")
         return None
 
-    for rec in records:  # this part can be optimized for speed later
-        df_rows.append(rec)
-        df_index.append(rec["id"])
-
     df = pd.DataFrame(df_rows, index=df_index)
 
     df = df[
@@ -324,14 +316,10 @@ async def create_guild_dataframe(guild_id: int) -> pd.DataFrame:
             "user",
             "date_of_engagement",
             "date_of_submission",
+            "discord_id",
         ]
     ]
 
-    df["activity_type"] = df.apply(lambda x: x["activity_type"]["name"], axis=1)
-    df["discord_id"] = df.apply(lambda x: get_user_discord_id(x), axis=1)
-    df["user"] = df.apply(lambda x: x["user"]["display_name"], axis=1)
-    df["status"] = df.apply(lambda x: x["status"]["name"], axis=1)
-
     # rename columns
     df = df.rename(
         columns={
@@ -353,6 +341,18 @@ async def create_guild_dataframe(guild_id: int) -> pd.DataFrame:
     return df
 
 
+def get_contribution_row(record):
+    return {
+        "activity_type": record["activity_type"]["name"],
+        "details": record["details"],
+        "status": record["status"]["name"],
+        "user": record["user"]["display_name"],
+        "date_of_engagement": record["date_of_engagement"],
+        "date_of_submission": record["date_of_submission"],
+        "discord_id": get_user_discord_id(record),
+    }
+
+
 def get_user_discord_id(record):
     discord_users = record["user"]["discord_users"]
     if len(discord_users) == 0:
@@ -380,7 +380,13 @@ def get_formatted_date():
     return date_reformat
 
 
+async def save_weekly_contribution_reports_locally():
+    # the bot normally owns the protocol session, so close it ourselves
+    async with session_manager:
+        await save_weekly_contribution_reports()
+
+
 if __name__ == "__main__":
     logger.info("file directly invoked. saving weekly contributions locally...")
-    asyncio.run(save_weekly_contribution_reports())
+    asyncio.run(save_weekly_contribution_reports_locally())
     logger.info("done saving weekly contribution reports locally!")
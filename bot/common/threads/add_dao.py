@@ -75,16 +75,11 @@ class AddDaoGetOrCreate(BaseStep):
     async def control_hook(self, message, user_id):
         dao_id = str(int(message.content.strip()))
         self.parent_thread.guild_id = dao_id
-        guild = await gql.get_guild_by_discord_id(dao_id)
+        _, guild, is_member = await gql.get_user_guild_membership(user_id, dao_id)
         if guild:
-            # Check if user is a member
-            user = await gql.get_user_by_discord_id(user_id)
             guild_name = guild.get("name")
 
-            if user is not None and any(
-                guild_user.get("guild_id") == guild.get("id")
-                for guild_user in user.get("guild_users")
-            ):
+            if is_member:
                 message = AddDaoGetOrCreate.previously_added_msg % (dao_id, guild_name)
                 raise ThreadTerminatingException(message)
 
@@ -1,15 +1,14 @@
-import json
 from bot.common.threads.thread_builder import (
     BaseThread,
     BaseStep,
     StepKeys,
     ThreadKeys,
     Step,
+    get_cache_metadata_key,
 )
 
 # from bot.common.threads.utils import get_jump_thread
 from bot.common.threads.shared_steps import SelectGuildEmojiStep
-from bot.config import Redis
 
 
 class OverrideThreadStep(BaseStep):
@@ -42,11 +41,11 @@ class GuildSelect(BaseThread):
     def __await__(self):
         async def init(self):
             await self._init_steps()
-            key_vals = await Redis.get(self.user_id)
-            if key_vals:
-                self.command_name = (
-                    json.loads(key_vals).get("metadata").get("thread_name")
-                )
+            thread_name = await get_cache_metadata_key(
+                self.user_id, self.cache, "thread_name"
+            )
+            if thread_name:
+                self.command_name = thread_name
             return self
 
         return init(self).__await__()
@@ -13,7 +13,9 @@ from bot.common.threads.thread_builder import (
     BaseStep,
     StepKeys,
     Step,
-    build_cache_value,
+    get_cache_metadata,
+    get_cache_metadata_key,
+    write_cache_metadata,
 )
 import bot.common.graphql as gql
 from bot.config import (
@@ -129,11 +131,7 @@ class DisplayHistoryStep(BaseStep):
                     None,
                 )
 
-        cache_entry = await self.cache.get(user_id)
-        metadata = None
-        if cache_entry:
-            cache_values = json.loads(cache_entry)
-            metadata = cache_values.get("metadata")
+        metadata = await get_cache_metadata(user_id, self.cache)
 
         contributions = await get_contributions(
             metadata, user_id, self.guild_id, self.days
@@ -183,8 +181,9 @@ class DisplayHistoryStep(BaseStep):
             return sent_message, metadata
 
         metadata["contribution_rows"] = contribution_rows
-        cache_values["metadata"] = metadata
-        await self.cache.set(user_id, build_cache_value(**cache_values))
+        await write_cache_metadata(
+            user_id, self.cache, "contribution_rows", contribution_rows
+        )
 
         return sent_message, metadata
 
@@ -237,9 +236,9 @@ class GetContributionsCsvPromptStepAccept(BaseStep):
         self.cache = cache
 
     async def send(self, message, user_id):
-        cache_entry = await self.cache.get(user_id)
-        cache_values = json.loads(cache_entry)
-        contributions = cache_values.get("metadata").get("contribution_rows")
+        contributions = await get_cache_metadata_key(
+            user_id, self.cache, "contribution_rows"
+        )
 
         csv_file = build_csv_file(contributions[0], contributions[1], user_id)
 
@@ -283,5 +282,7 @@ async def get_contributions(metadata, user_id, guild_id, days):
     date = date.isoformat()
     guild = await gql.get_guild_by_discord_id(guild_id)
     # todo: truncate
-    contributions = await gql.get_contributions(guild.get("id"), user_id, date)
+    contributions = await gql.get_contributions(
+        guild.get("id"), user_id, date, projection="history-row"
+    )
     return contributions
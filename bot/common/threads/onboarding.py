@@ -46,15 +46,17 @@ class CheckIfUserExists(BaseStep):
 
     name = StepKeys.CHECK_USER_EXISTS.value
 
-    def __init__(self, cache):
+    def __init__(self, cache, guild_id):
         super().__init__()
         self.cache = cache
+        self.guild_id = guild_id
 
     async def send(self, message, user_id):
         return None, None
 
     async def control_hook(self, message, user_id):
-        user = await gql.get_user_by_discord_id(user_id)
+        # also caches the guild for the association step
+        user, _, _ = await gql.get_user_guild_membership(user_id, self.guild_id)
         if user:
             # Cache for the message send in the next step rather than retrieving
             # from the database
@@ -325,7 +327,9 @@ class Onboarding(BaseThread):
             .build()
         )
 
-        profile_setup_steps = Step(current=CheckIfUserExists(cache=self.cache)).fork(
+        profile_setup_steps = Step(
+            current=CheckIfUserExists(cache=self.cache, guild_id=self.guild_id)
+        ).fork(
             (
                 AssociateExistingUserWithGuild(
                     cache=self.cache, guild_id=self.guild_id
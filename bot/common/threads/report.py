@@ -56,15 +56,15 @@ class ReportStep(BaseStep):
             user = self.bot.get_user(user_id)
             # get count of uses
             one_week = datetime.datetime.now() - datetime.timedelta(weeks=1)
-            contributions = await gql.get_contributions(
+            contribution_count = await gql.count_contributions(
                 guild_id=guild.get("id"),
                 user_discord_id=user_id,
                 after_date=one_week.isoformat(),
             )
-            if len(contributions) > 0:
+            if contribution_count > 0:
                 await channel.send(
                     ReportStep.congrats_message
-                    % (user.display_name, len(contributions))
+                    % (user.display_name, contribution_count)
                 )
                 await self.cache.set(
                     congrats_key, "True", ex=60 * 60
@@ -1,6 +1,5 @@
 import asyncio
 import discord
-import json
 import logging
 import random
 import re
@@ -9,7 +8,6 @@ import string
 import eth_account
 
 from bot.config import (
-    Redis,
     REQUESTED_TWEET_FMT,
     INFO_EMBED_COLOR,
     TWEET_NONCE_LEGNTH,
@@ -56,10 +54,11 @@ class SelectGuildEmojiStep(BaseStep):
     async def handle_emoji(self, raw_reaction):
         channel = await bot.fetch_channel(raw_reaction.channel_id)
         message = await channel.fetch_message(raw_reaction.message_id)
-        key_vals = await Redis.get(raw_reaction.user_id)
-        if not key_vals:
+        daos = await get_cache_metadata_key(
+            raw_reaction.user_id, self.cls.cache, "daos"
+        )
+        if not daos:
             return None, None
-        daos = json.loads(key_vals).get("metadata").get("daos")
         selected_guild_reaction = None
         for reaction in message.reactions:
             if reaction.count >= 2:
@@ -117,10 +116,10 @@ class VerifyUserWalletStep(BaseStep):
 
     async def save(self, message, guild_id, user_id):
         verified_wallet = await self.verify_message(user_id, message)
-        await self.remove_existing_wallet_usage(user_id, verified_wallet)
         if self.update:
             await self.update_existing_user_with_wallet(user_id, verified_wallet)
         else:
+            # existing wallet usage is removed as part of the create
             await self.create_user_with_wallet(user_id, guild_id, verified_wallet)
 
     async def verify_message(self, user_id, message):
@@ -150,46 +149,47 @@ class VerifyUserWalletStep(BaseStep):
             )
         return address
 
-    async def remove_existing_wallet_usage(self, user_id, verified_wallet):
-        user = await gql.get_user_by_wallet(verified_wallet)
-
-        # no users are using the supplied wallet
-        if user is None:
-            return
-
-        # udpate the conflicting user with a "pointer" to the profile which is using the
-        # verified address
-        err_address_marker = VerifyUserWalletStep.unverified_address_fmt % user_id
-        await gql.update_user_wallet(user.get("id"), err_address_marker)
-
     async def create_user_with_wallet(self, user_id, guild_id, wallet):
         # Create a new user row with the supplied display name, wallet, etc.
         display_name = await get_cache_metadata_key(user_id, self.cache, "display_name")
         discord_display_name = await get_cache_metadata_key(
             user_id, self.cache, DISCORD_DISPLAY_NAME_CACHE_KEY
         )
-        # Assumption: user is in a discord server/not in DMs
-        guild = await gql.get_guild_by_discord_id(guild_id)
-
         # user creation is performed when supplying wallet address since this
-        # is a mandatory field for the user record
-        # TODO: wrap into a single CRUD
-        user = await self.create_user(
-            user_id, discord_display_name, guild.get("id"), wallet
+        # is a mandatory field for the user record. The user, their discord
+        # user and guild membership are created with a single mutation.
+        # Assumption: user is in a discord server/not in DMs
+        user = await gql.create_onboarded_user(
+            user_id,
+            discord_display_name,
+            display_name,
+            wallet,
+            guild_id,
+            VerifyUserWalletStep.unverified_address_fmt % user_id,
         )
-        user_db_id = user.get("id")
-        await gql.update_user_display_name(user_db_id, display_name)
-        await write_cache_metadata(user_id, self.cache, "user_db_id", user_db_id)
+        await write_cache_metadata(user_id, self.cache, "user_db_id", user.get("id"))
 
     async def update_existing_user_with_wallet(self, user_id, verified_wallet):
-        user = await gql.get_user_by_discord_id(user_id)
-        # Update the user's profile with the verified wallet address
-        await gql.update_user_wallet(user.get("id"), verified_wallet)
-
-    async def create_user(self, discord_id, discord_name, guild_id, wallet):
-        user = await gql.create_user(discord_id, discord_name, wallet)
-        await gql.create_guild_user(user.get("id"), guild_id)
-        return user
+        user, existing_user = await asyncio.gather(
+            gql.get_user_by_discord_id(user_id),
+            gql.get_user_by_wallet(verified_wallet),
+        )
+
+        # no other users are using the supplied wallet
+        if existing_user is None or existing_user.get("id") == user.get("id"):
+            await gql.update_user_wallet(user.get("id"), verified_wallet)
+            return
+
+        # update the conflicting user with a "pointer" to the profile which is
+        # using the verified address, and update the user's profile with the
+        # verified wallet address in the same request
+        err_address_marker = VerifyUserWalletStep.unverified_address_fmt % user_id
+        await gql.transfer_user_wallet(
+            user.get("id"),
+            verified_wallet,
+            existing_user.get("id"),
+            err_address_marker,
+        )
 
 
 class VerifyUserTwitterStep(BaseStep):
@@ -3,8 +3,9 @@ import json
 import hashlib
 import logging
 
+from bot import constants
 from bot.common.bot.bot import bot
-from bot.common.cache import RedisCache
+from bot.common.cache import RedisCache, WrongTypeError
 from bot.exceptions import ThreadTerminatingException
 from enum import Enum
 from typing import Dict, Optional
@@ -14,41 +15,120 @@ from dataclasses import dataclass, field
 logger = logging.getLogger(__name__)
 
 
-def build_cache_value(thread, step, guild_id, message_id="", **kwargs):
-    return json.dumps(
-        {
-            "thread": thread,
-            "step": step,
-            "guild_id": guild_id,
-            "message_id": message_id,
-            **kwargs,
-        }
+# metadata is stored as one field of the thread state hash per key,
+# so a single key can be read or written without touching the others
+METADATA_FIELD_PREFIX = "metadata:"
+
+# hash of the current step, which every step transition moves on
+STEP_FIELD = "step"
+
+# seconds a conversation may sit idle before its state expires. Each
+# write of the state restarts the countdown
+THREAD_STATE_IDLE_SECONDS = int(constants.BotCache.thread_state_idle_seconds) or None
+
+
+def build_thread_state(thread, step, guild_id, message_id="", **kwargs):
+    return {
+        "thread": thread,
+        "step": step,
+        "guild_id": guild_id,
+        "message_id": message_id,
+        **kwargs,
+    }
+
+
+def encode_thread_state(state):
+    """Returns the hash fields of a thread state, each encoded as json"""
+    fields = {}
+    for key, value in state.items():
+        if key == "metadata":
+            for metadata_key, metadata_value in (value or {}).items():
+                fields[f"{METADATA_FIELD_PREFIX}{metadata_key}"] = json.dumps(
+                    metadata_value
+                )
+        else:
+            fields[key] = json.dumps(value)
+    return fields
+
+
+def decode_thread_state(fields):
+    state = {"metadata": {}}
+    for name, value in fields.items():
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        if name.startswith(METADATA_FIELD_PREFIX):
+            state["metadata"][name[len(METADATA_FIELD_PREFIX) :]] = json.loads(value)
+        else:
+            state[name] = json.loads(value)
+    return state
+
+
+async def migrate_thread_state(user_id, cache):
+    """Converts a thread state stored as a single json value to a hash
+
+    Returns:
+      The thread state, or None if the user has no thread
+    """
+    value = await cache.get(user_id)
+    if value is None:
+        return None
+    state = json.loads(value)
+    state["metadata"] = state.get("metadata") or {}
+    await cache.set_hash(
+        user_id, encode_thread_state(state), ex=THREAD_STATE_IDLE_SECONDS
     )
+    logger.info(f"Migrated the thread state of {user_id} to a hash")
+    return state
 
 
-async def write_cache_metadata(user_id, cache, key, value):
-    cache_entry = await cache.get(user_id)
-    cache_values = json.loads(cache_entry)
-    metadata = cache_values.get("metadata")
+async def get_thread_state(user_id, cache):
+    """Returns the thread state of a user, or None if there is none"""
+    try:
+        fields = await cache.hgetall(user_id)
+    except WrongTypeError:
+        return await migrate_thread_state(user_id, cache)
+    if not fields:
+        return None
+    return decode_thread_state(fields)
 
-    if metadata is None:
-        metadata = {}
 
-    metadata[key] = value
-    cache_values["metadata"] = metadata
-    await cache.set(user_id, build_cache_value(**cache_values))
+async def write_thread_state(user_id, cache, state):
+    """Replaces the thread state of a user, metadata included"""
+    await cache.set_hash(
+        user_id, encode_thread_state(state), ex=THREAD_STATE_IDLE_SECONDS
+    )
+
+
+async def update_thread_state(user_id, cache, state):
+    """Writes the given fields of a thread state, keeping the others"""
+    fields = encode_thread_state(state)
+    try:
+        await cache.hset(user_id, fields, ex=THREAD_STATE_IDLE_SECONDS)
+    except WrongTypeError:
+        await migrate_thread_state(user_id, cache)
+        await cache.hset(user_id, fields, ex=THREAD_STATE_IDLE_SECONDS)
+
+
+async def write_cache_metadata(user_id, cache, key, value):
+    await update_thread_state(user_id, cache, {"metadata": {key: value}})
 
 
 async def get_cache_metadata(user_id, cache):
-    cache_entry = await cache.get(user_id)
-    cache_values = json.loads(cache_entry)
-    metadata = cache_values.get("metadata")
-    return metadata
+    state = await get_thread_state(user_id, cache)
+    if state is None:
+        return None
+    return state["metadata"]
 
 
 async def get_cache_metadata_key(user_id, cache, key):
-    metadata = await get_cache_metadata(user_id, cache)
-    return metadata.get(key)
+    try:
+        value = await cache.hget(user_id, f"{METADATA_FIELD_PREFIX}{key}")
+    except WrongTypeError:
+        state = await migrate_thread_state(user_id, cache)
+        return state["metadata"].get(key) if state else None
+    if value is None:
+        return None
+    return json.loads(value)
 
 
 class ThreadKeys(Enum):
@@ -251,10 +331,6 @@ class BaseThread:
             await self.cache.delete(self.user_id)
             raise e
 
-        if not metadata:
-            u = await self.cache.get(self.user_id)
-            if u:
-                metadata = json.loads(u).get("metadata")
         if not self.step.next_steps:
             return await self.cache.delete(self.user_id)
         step = list(self.step.next_steps.values())[0]
@@ -280,16 +356,14 @@ class BaseThread:
             self.step = step
             return await self.send(msg)
 
-        return await self.cache.set(
-            self.user_id,
-            build_cache_value(
-                self.name,
-                step.hash_,
-                self.guild_id,
-                msg.id,
-                metadata=metadata,
-            ),
-        )
+        state = build_thread_state(self.name, step.hash_, self.guild_id, msg.id)
+        if metadata:
+            # metadata returned by the step replaces the stored metadata
+            return await write_thread_state(
+                self.user_id, self.cache, {**state, "metadata": metadata}
+            )
+        # only the position in the thread moves on, the metadata is kept
+        return await update_thread_state(self.user_id, self.cache, state)
 
     async def _save_previous_step(self, message):
         return await self.step.previous_step.current.save(
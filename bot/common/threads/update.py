@@ -1,5 +1,4 @@
 import discord
-import json
 
 import bot.common.graphql as gql
 from bot.common.threads.onboarding import TWITTER_HANDLE_CACHE_KEY
@@ -13,9 +12,10 @@ from bot.common.threads.thread_builder import (
     Step,
     ThreadKeys,
     BaseThread,
-    build_cache_value,
     get_cache_metadata_key,
+    get_thread_state,
     write_cache_metadata,
+    write_thread_state,
 )
 from bot.common.threads.shared_steps import (
     SelectGuildEmojiStep,
@@ -82,17 +82,11 @@ class UpdateProfileFieldEmojiStep(BaseStep):
         self.cache = cache
 
     async def handle_emoji(self, raw_reaction):
-        key_vals = await self.cache.get(raw_reaction.user_id)
-        if not key_vals:
+        state = await get_thread_state(raw_reaction.user_id, self.cache)
+        if not state:
             return None, None
-        values = json.loads(key_vals)
-        values["metadata"] = {
-            "field": values.get("metadata").get(raw_reaction.emoji.name)
-        }
-        await self.cache.set(
-            raw_reaction.user_id,
-            build_cache_value(**values),
-        )
+        state["metadata"] = {"field": state["metadata"].get(raw_reaction.emoji.name)}
+        await write_thread_state(raw_reaction.user_id, self.cache, state)
         return None, None
 
 
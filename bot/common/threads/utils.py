@@ -1,5 +1,4 @@
-import json
-from bot.common.threads.thread_builder import ThreadKeys, build_cache_value
+from bot.common.threads.thread_builder import ThreadKeys, build_thread_state
 from bot.common.threads.onboarding import Onboarding  # noqa: E402
 from bot.common.threads.update import UpdateProfile  # noqa: E402
 from bot.common.threads.initial_contribution import InitialContributions
@@ -11,7 +10,7 @@ from bot.common.threads.add_dao import AddDao
 async def get_jump_thread(parent_thread, message, user_id):
     thread = await get_thread(
         user_id,
-        build_cache_value(
+        build_thread_state(
             parent_thread.command_name,
             None,
             parent_thread.guild_id,
@@ -44,12 +43,11 @@ async def set_thread_and_send(
     return await jump_thread.step.current.send(message, user_id)
 
 
-async def get_thread(user_id, key, cache=None):
-    val = json.loads(key)
-    thread = val.get("thread")
-    step = val.get("step")
-    message_id = val.get("message_id")
-    guild_id = val.get("guild_id")
+async def get_thread(user_id, state, cache=None):
+    thread = state.get("thread")
+    step = state.get("step")
+    message_id = state.get("message_id")
+    guild_id = state.get("guild_id")
     if thread == ThreadKeys.ONBOARDING.value:
         return await Onboarding(user_id, step, message_id, guild_id, cache)
     elif thread == ThreadKeys.UPDATE_PROFILE.value:
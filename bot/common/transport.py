@@ -0,0 +1,249 @@
+import hashlib
+import json
+import logging
+import weakref
+
+import aiohttp
+from aiohttp.http_parser import HAS_BROTLI
+from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import (
+    TransportClosed,
+    TransportProtocolError,
+    TransportQueryError,
+    TransportServerError,
+)
+from graphql import ExecutionResult, print_ast
+
+from bot.common.json_stream import JsonArrayStream, JsonStreamError
+
+logger = logging.getLogger(__name__)
+
+PERSISTED_QUERY_NOT_FOUND = "PERSISTED_QUERY_NOT_FOUND"
+PERSISTED_QUERY_NOT_SUPPORTED = "PERSISTED_QUERY_NOT_SUPPORTED"
+
+
+def has_error_code(errors, code):
+    for error in errors or []:
+        extensions = error.get("extensions") or {}
+        if extensions.get("code") == code:
+            return True
+    return False
+
+
+def raise_query_errors(errors, data):
+    if errors:
+        raise TransportQueryError(str(errors[0]), errors=errors, data=data)
+
+
+def get_accept_encoding():
+    # aiohttp only decodes brotli responses when the brotli package is
+    # installed, so br is only asked for then
+    if HAS_BROTLI:
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+
+class ProtocolTransport(AIOHTTPTransport):
+    """Transport used to talk to the protocol api
+
+    Queries are printed and hashed once per document rather than on
+    every request. With persisted_queries enabled, requests follow the
+    automatic persisted queries protocol: only the SHA-256 hash of the
+    query is sent, and the full query is sent again only when the
+    server reports the hash as unknown. If the server doesn't support
+    persisted queries they are turned off for the transport.
+
+    Compressed responses are asked for, and the items of large lists can
+    be streamed while the response is still being downloaded.
+
+    Args:
+      persisted_queries: send query hashes instead of the query text
+      **kwargs: arguments of AIOHTTPTransport
+    """
+
+    def __init__(self, persisted_queries=False, **kwargs):
+        super().__init__(**kwargs)
+        self.headers = {
+            "Accept-Encoding": get_accept_encoding(),
+            **(self.headers or {}),
+        }
+        self.persisted_queries = persisted_queries
+        self._queries = weakref.WeakKeyDictionary()
+
+    def get_query(self, document):
+        """Returns the printed query of a document and its SHA-256 hash"""
+        query = self._queries.get(document)
+        if query is None:
+            query_str = print_ast(document)
+            query_hash = hashlib.sha256(query_str.encode("utf-8")).hexdigest()
+            query = (query_str, query_hash)
+            self._queries[document] = query
+        return query
+
+    async def execute(
+        self,
+        document,
+        variable_values=None,
+        operation_name=None,
+        extra_args=None,
+        upload_files=False,
+    ):
+        if upload_files:
+            return await super().execute(
+                document, variable_values, operation_name, extra_args, upload_files
+            )
+
+        query_str, query_hash = self.get_query(document)
+        payload = self.build_payload(variable_values, operation_name)
+        if not self.persisted_queries:
+            return await self.post({**payload, "query": query_str}, extra_args)
+
+        payload["extensions"] = self.build_extensions(query_hash)
+        result = await self.post(payload, extra_args)
+        if not self.is_unknown_query(result.errors):
+            return result
+        return await self.post(self.with_query(payload, query_str), extra_args)
+
+    async def stream(
+        self, document, path, variable_values=None, operation_name=None, extra_args=None
+    ):
+        """Executes a query and yields the items of a list as they arrive
+
+        Args:
+          document: the query to execute
+          path: keys leading to the list in the result data, e.g.
+            ("result",)
+          variable_values: variables of the query
+          operation_name: name of the operation to execute
+          extra_args: extra arguments of the aiohttp request
+
+        Yields:
+          Each item of the list, as soon as it has been downloaded
+
+        Raises:
+          TransportQueryError: if the result has graphql errors, once
+            the items which were returned have been yielded
+        """
+        query_str, query_hash = self.get_query(document)
+        payload = self.build_payload(variable_values, operation_name)
+        path = ("data", *path)
+        if self.persisted_queries:
+            payload["extensions"] = self.build_extensions(query_hash)
+            try:
+                async for item in self.post_stream(payload, path, extra_args):
+                    yield item
+                return
+            except TransportQueryError as e:
+                if not self.is_unknown_query(e.errors):
+                    raise
+            payload = self.with_query(payload, query_str)
+        else:
+            payload = {**payload, "query": query_str}
+        async for item in self.post_stream(payload, path, extra_args):
+            yield item
+
+    @staticmethod
+    def build_payload(variable_values, operation_name):
+        payload = {}
+        if operation_name:
+            payload["operationName"] = operation_name
+        if variable_values:
+            payload["variables"] = variable_values
+        return payload
+
+    @staticmethod
+    def build_extensions(query_hash):
+        return {"persistedQuery": {"version": 1, "sha256Hash": query_hash}}
+
+    def with_query(self, payload, query_str):
+        # the query is registered with the server by sending it in full
+        # along with its hash, unless persisted queries were turned off
+        payload = {**payload, "query": query_str}
+        if not self.persisted_queries:
+            payload.pop("extensions", None)
+        return payload
+
+    def is_unknown_query(self, errors):
+        """Whether the query has to be sent again in full"""
+        if has_error_code(errors, PERSISTED_QUERY_NOT_SUPPORTED):
+            logger.warning("Persisted queries aren't supported, turning them off")
+            self.persisted_queries = False
+            return True
+        return has_error_code(errors, PERSISTED_QUERY_NOT_FOUND)
+
+    def get_post_args(self, payload, extra_args):
+        if self.session is None:
+            raise TransportClosed("Transport is not connected")
+
+        logger.debug(f">>> {payload.get('operationName')}")
+        post_args = {"json": payload}
+        if extra_args:
+            post_args.update(extra_args)
+        return post_args
+
+    async def post(self, payload, extra_args=None):
+        """Posts a graphql payload and returns the execution result"""
+        post_args = self.get_post_args(payload, extra_args)
+        async with self.session.post(self.url, ssl=self.ssl, **post_args) as resp:
+            return await self.read_result(resp)
+
+    async def post_stream(self, payload, path, extra_args=None):
+        """Posts a graphql payload and yields the items of the list at path"""
+        post_args = self.get_post_args(payload, extra_args)
+        async with self.session.post(self.url, ssl=self.ssl, **post_args) as resp:
+            if resp.status >= 400:
+                # error answers are small, so they are decoded in one go
+                result = await self.read_result(resp)
+                raise_query_errors(result.errors, result.data)
+                await self.raise_response_error(resp, "Unexpected status")
+
+            self.response_headers = resp.headers
+            stream = JsonArrayStream(resp.content.iter_any(), path)
+            try:
+                async for item in stream:
+                    yield item
+            except (JsonStreamError, json.JSONDecodeError) as e:
+                raise TransportProtocolError(
+                    f"Server did not return a GraphQL result: {e}"
+                ) from e
+
+        document = stream.document
+        if "errors" not in document and "data" not in document:
+            raise TransportProtocolError(
+                'Server did not return a GraphQL result: No "data" or "errors" keys'
+            )
+        raise_query_errors(document.get("errors"), document.get("data"))
+
+    async def read_result(self, resp):
+        try:
+            result = await resp.json(content_type=None)
+        except Exception:
+            await self.raise_response_error(resp, "Not a JSON answer")
+
+        if not isinstance(result, dict) or (
+            "errors" not in result and "data" not in result
+        ):
+            await self.raise_response_error(
+                resp, 'No "data" or "errors" keys in answer'
+            )
+
+        self.response_headers = resp.headers
+        return ExecutionResult(
+            errors=result.get("errors"),
+            data=result.get("data"),
+            extensions=result.get("extensions"),
+        )
+
+    @staticmethod
+    async def raise_response_error(resp, reason):
+        # a TransportServerError is raised for 4xx and 5xx responses, and
+        # a TransportProtocolError for any other response which isn't valid
+        try:
+            resp.raise_for_status()
+        except aiohttp.ClientResponseError as e:
+            raise TransportServerError(str(e), e.status) from e
+
+        result_text = await resp.text()
+        raise TransportProtocolError(
+            f"Server did not return a GraphQL result: {reason}: {result_text}"
+        )
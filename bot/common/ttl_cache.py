@@ -0,0 +1,249 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """A read-through cache for protocol api records
+
+    Records are kept in process for ttl seconds. When a redis client is
+    given, records are also written to redis with the same expiry so
+    that other processes can read them and so a restart doesn't start
+    from a cold cache. Missing records (None) are never cached, and
+    callers always receive their own copy of a record. At most
+    max_entries records are kept in process, dropping the least recently
+    used ones first.
+
+    With a stale_ttl, get_or_refresh keeps serving an expired record
+    from process for up to stale_ttl more seconds while a fresh copy is
+    loaded in the background, so slow reads of the protocol api don't
+    hold up callers.
+
+    Args:
+      namespace: prefix of every key, used to keep redis keys apart
+      ttl: seconds a record is kept before it is fetched again
+      redis: optional aioredis client used as a second tier
+      stale_ttl: seconds an expired record may still be served while
+        it is refreshed
+      max_entries: maximum records kept in process
+    """
+
+    def __init__(self, namespace, ttl, redis=None, stale_ttl=0, max_entries=10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.redis = redis
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._refreshing = {}
+        # loads in flight and the generation of their key, which delete
+        # bumps so a load that raced it isn't stored; kept only while loading
+        self._loads = {}
+        self._clears = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.evictions = 0
+
+    def build_key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _start_load(self, key):
+        load = self._loads.setdefault(self.build_key(key), [0, 0])
+        load[0] += 1
+        return self._clears, load[1]
+
+    def _finish_load(self, key, generation):
+        """Returns whether the record loaded since _start_load may be stored"""
+        key = self.build_key(key)
+        load = self._loads[key]
+        load[0] -= 1
+        if not load[0]:
+            del self._loads[key]
+        return generation == (self._clears, load[1])
+
+    async def get(self, key):
+        """Returns the cached record for key, or None on a miss"""
+        value, is_stale = await self._lookup(key)
+        if value is None or is_stale:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    async def _lookup(self, key):
+        """Returns a copy of the record for key, and whether it is stale"""
+        key = self.build_key(key)
+        stale = None
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            now = time.monotonic()
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                return copy.deepcopy(value), False
+            if expires_at + self.stale_ttl > now:
+                self._entries.move_to_end(key)
+                stale = value
+            else:
+                del self._entries[key]
+
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(key)
+            except Exception:
+                logger.exception(f"Failed to read {key} from redis")
+                cached = None
+            if cached is not None:
+                value = json.loads(cached)
+                self._store(key, value)
+                return copy.deepcopy(value), False
+
+        if stale is not None:
+            return copy.deepcopy(stale), True
+        return None, False
+
+    async def set(self, key, value):
+        if value is None:
+            return
+        key = self.build_key(key)
+        self._store(key, copy.deepcopy(value))
+        if self.redis is not None:
+            try:
+                await self.redis.set(key, json.dumps(value), ex=self.ttl)
+            except Exception:
+                logger.exception(f"Failed to write {key} to redis")
+
+    async def delete(self, *keys):
+        keys = [self.build_key(key) for key in keys]
+        for key in keys:
+            self._entries.pop(key, None)
+            if key in self._loads:
+                self._loads[key][1] += 1
+        if self.redis is not None and keys:
+            try:
+                await self.redis.delete(*keys)
+            except Exception:
+                logger.exception(f"Failed to delete {keys} from redis")
+
+    async def get_or_load(self, key, load):
+        """Returns the cached record for key, loading it on a miss
+
+        Args:
+          key: key of the record
+          load: coroutine function which fetches the record
+
+        Returns:
+          The record, or None if it doesn't exist
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+        generation = self._start_load(key)
+        try:
+            value = await load()
+        finally:
+            # the record was deleted while loading, so what was read may be stale
+            unchanged = self._finish_load(key, generation)
+        if unchanged:
+            await self.set(key, value)
+        return value
+
+    async def get_or_refresh(self, key, load, store=None, refresh=None):
+        """Returns the cached record for key, serving it stale while refreshed
+
+        A fresh record is returned straight away. An expired record still
+        within stale_ttl is returned too, and a single background task
+        loads a fresh copy. Otherwise the record is loaded and stored.
+
+        Args:
+          key: key of the record
+          load: coroutine function which fetches the record
+          store: coroutine function which caches a loaded record,
+            defaults to setting it under key
+          refresh: coroutine function used to fetch the record in the
+            background, defaults to load
+
+        Returns:
+          The record, or None if it doesn't exist
+        """
+        if store is None:
+
+            async def store(value):
+                await self.set(key, value)
+
+        value, is_stale = await self._lookup(key)
+        if value is not None and not is_stale:
+            self.hits += 1
+            return value
+        if value is not None:
+            self.stale_hits += 1
+            self._start_refresh(key, refresh or load, store)
+            return value
+
+        self.misses += 1
+        generation = self._start_load(key)
+        try:
+            value = await load()
+        finally:
+            unchanged = self._finish_load(key, generation)
+        if unchanged:
+            await store(value)
+        return value
+
+    def _start_refresh(self, key, load, store):
+        if key in self._refreshing:
+            return
+        # a reference to the task is kept until it is done
+        self._refreshing[key] = asyncio.create_task(self._refresh(key, load, store))
+
+    async def _refresh(self, key, load, store):
+        generation = self._start_load(key)
+        try:
+            value = await load()
+        except Exception:
+            self.refresh_failures += 1
+            logger.exception(f"Failed to refresh {self.build_key(key)}")
+            return
+        finally:
+            self._refreshing.pop(key, None)
+            unchanged = self._finish_load(key, generation)
+        self.refreshes += 1
+        if value is None:
+            # the record is gone, so it mustn't be served stale any longer
+            await self.delete(key)
+            return
+        if not unchanged:
+            # deleted while refreshing; the next read loads it again
+            return
+        await store(value)
+
+    def clear(self):
+        """Drops every in process record; redis entries expire on their own"""
+        self._entries = OrderedDict()
+        self._clears += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+        }
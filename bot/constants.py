@@ -217,6 +217,54 @@ class BotTasks(metaclass=YAMLGetter):
     weekly_report_enable: str
     weekly_report_weekday: str
     weekly_report_time: str
+    stats_log_minutes: str
+
+
+class BotEvents(metaclass=YAMLGetter):
+    section = "bot"
+    subsection = "events"
+
+    concurrency: str
+
+
+class BotCache(metaclass=YAMLGetter):
+    section = "bot"
+    subsection = "cache"
+
+    local_enable: str
+    local_max_entries: str
+    local_max_bytes: str
+    local_ttl_seconds: str
+    thread_state_idle_seconds: str
+    thread_state_sweep_minutes: str
+
+
+class Protocol(metaclass=YAMLGetter):
+    section = "bot"
+    subsection = "protocol"
+
+    pool_size: str
+    pool_size_per_host: str
+    keepalive_timeout_seconds: str
+    contributions_page_size: str
+    cache_redis_enable: str
+    guild_cache_ttl_seconds: str
+    user_cache_ttl_seconds: str
+    record_cache_max_entries: str
+    read_timeout_seconds: str
+    mutation_timeout_seconds: str
+    read_retry_attempts: str
+    retry_backoff_base_seconds: str
+    retry_backoff_max_seconds: str
+    breaker_failure_rate: str
+    breaker_window_size: str
+    breaker_min_requests: str
+    breaker_reset_timeout_seconds: str
+    interaction_deadline_seconds: str
+    persisted_queries_enable: str
+    interactive_concurrency: str
+    batch_concurrency: str
+    stale_while_revalidate_seconds: str
 
 
 class Tests(metaclass=YAMLGetter):
@@ -25,6 +25,14 @@ class UserWithTwitterHandleAlreadyExists(ThreadTerminatingException):
     pass
 
 
+class ProtocolUnavailableException(errors.ApplicationCommandError):
+    pass
+
+
+class DeadlineExceededException(ProtocolUnavailableException):
+    pass
+
+
 class ErrorHandler:
     def __init__(self, error):
         self.err = error
@@ -33,5 +41,7 @@ class ErrorHandler:
     def _handle_error(self):
         if isinstance(self.err, NotGuildException):
             return "Please run this command in a guild!"
+        if isinstance(self.err, ProtocolUnavailableException):
+            return "Govrn is having trouble right now, please try again in a bit!"
         logger.error("Uncaught error", exc_info=self.err)
         return "Bot Error"
@@ -0,0 +1,31 @@
+import timeit
+
+from gql import gql
+
+from bot.common.graphql import operations
+
+ITERATIONS = 2000
+
+
+def benchmark_gql_documents():
+    """Compares parsing an operation per call against the registry
+
+    Before the registry every query function joined its fragments to
+    the query and ran gql() on every call; now the parsed document is
+    reused after the first call.
+    """
+    operations.compile_all()
+    print(f"{'operation':<20}{'parse (us)':>14}{'registry (us)':>16}")
+    for name in operations.names():
+        source = operations.source(name)
+        parse = timeit.timeit(lambda: gql(source), number=ITERATIONS)
+        cached = timeit.timeit(lambda: operations.get(name), number=ITERATIONS)
+        print(
+            f"{name:<20}"
+            f"{parse / ITERATIONS * 1e6:>14.2f}"
+            f"{cached / ITERATIONS * 1e6:>16.2f}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_gql_documents()
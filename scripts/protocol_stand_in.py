@@ -0,0 +1,757 @@
+"""An offline stand-in for the protocol api
+
+Implements the subset of the protocol graphql schema used by
+bot.common.graphql over an in-memory dataset, so load tests,
+benchmarks and tests can run without the network. Latency and errors
+can be injected into every request.
+
+Run with:
+
+    PYTHONPATH=. python scripts/protocol_stand_in.py --latency-ms 50
+
+and point PROTOCOL_URL at http://localhost:4000/graphql
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from graphql import (
+    ExecutionResult,
+    GraphQLError,
+    build_schema,
+    execute,
+    get_operation_ast,
+    parse,
+    validate,
+)
+
+# Input types are declared as scalars; their values are passed through
+# untouched and interpreted by the resolvers below, which implement the
+# prisma filters the bot uses
+INPUT_TYPES = [
+    "ContributionOrderByWithRelationInput",
+    "ContributionWhereInput",
+    "ContributionWhereUniqueInput",
+    "GuildCreateInput",
+    "GuildOrderByWithRelationInput",
+    "GuildUpdateInput",
+    "GuildUserCreateInput",
+    "GuildUserWhereInput",
+    "GuildWhereInput",
+    "GuildWhereUniqueInput",
+    "UserCreateInput",
+    "UserOrderByWithRelationInput",
+    "UserUpdateInput",
+    "UserUpdateManyMutationInput",
+    "UserWhereInput",
+    "UserWhereUniqueInput",
+]
+
+SCHEMA = (
+    "\n".join(f"scalar {name}" for name in INPUT_TYPES)
+    + """
+scalar DateTime
+
+type ChainType {
+  id: Int!
+  name: String!
+  createdAt: DateTime!
+  updatedAt: DateTime!
+}
+
+type TwitterUser {
+  id: Int!
+  username: String!
+}
+
+type DiscordUser {
+  id: Int!
+  discord_id: String!
+  display_name: String
+}
+
+type Guild {
+  id: Int!
+  discord_id: String
+  name: String
+  logo: String
+  status: String
+  congrats_channel: String
+  contribution_reporting_channel: String
+  createdAt: DateTime!
+  updatedAt: DateTime!
+}
+
+type GuildUser {
+  id: Int!
+  guild_id: Int!
+  user_id: Int!
+  guild: Guild!
+  user: User!
+}
+
+type User {
+  id: Int!
+  address: String!
+  chain_type: ChainType!
+  display_name: String
+  full_name: String
+  name: String
+  createdAt: DateTime!
+  updatedAt: DateTime!
+  guild_users: [GuildUser!]!
+  discord_users: [DiscordUser!]!
+  twitter_user: TwitterUser
+}
+
+type ActivityType {
+  id: Int!
+  active: Boolean!
+  name: String!
+  createdAt: DateTime!
+  updatedAt: DateTime!
+}
+
+type ContributionStatus {
+  id: Int!
+  name: String!
+  createdAt: DateTime!
+  updatedAt: DateTime!
+}
+
+type GuildContribution {
+  id: Int!
+  guild_id: Int!
+  guild: Guild!
+}
+
+type Contribution {
+  id: Int!
+  name: String!
+  details: String
+  proof: String
+  date_of_engagement: DateTime!
+  date_of_submission: DateTime!
+  updatedAt: DateTime!
+  activity_type: ActivityType!
+  status: ContributionStatus!
+  user: User!
+  guilds: [GuildContribution!]!
+}
+
+type ContributionCountAggregate {
+  _all: Int!
+}
+
+type AggregateContribution {
+  _count: ContributionCountAggregate
+}
+
+type AffectedRowsOutput {
+  count: Int!
+}
+
+type Query {
+  users(
+    where: UserWhereInput
+    orderBy: [UserOrderByWithRelationInput!]
+    skip: Int
+    take: Int
+  ): [User!]!
+  guilds(
+    where: GuildWhereInput
+    orderBy: [GuildOrderByWithRelationInput!]
+    skip: Int
+    take: Int
+  ): [Guild!]!
+  guildUsers(where: GuildUserWhereInput, skip: Int, take: Int): [GuildUser!]!
+  contributions(
+    where: ContributionWhereInput
+    orderBy: [ContributionOrderByWithRelationInput!]
+    cursor: ContributionWhereUniqueInput
+    skip: Int
+    take: Int
+  ): [Contribution!]!
+  aggregateContribution(where: ContributionWhereInput): AggregateContribution!
+}
+
+type Mutation {
+  createOneUser(data: UserCreateInput!): User!
+  updateOneUser(data: UserUpdateInput!, where: UserWhereUniqueInput!): User
+  updateManyUser(
+    data: UserUpdateManyMutationInput!
+    where: UserWhereInput
+  ): AffectedRowsOutput!
+  createOneGuild(data: GuildCreateInput!): Guild!
+  updateOneGuild(data: GuildUpdateInput!, where: GuildWhereUniqueInput!): Guild
+  createOneGuildUser(data: GuildUserCreateInput!): GuildUser!
+}
+"""
+)
+
+schema = build_schema(SCHEMA)
+
+ACTIVITY_TYPES = ["Pull Request", "Meeting", "Design", "Writing", "Community"]
+STATUSES = ["staging", "pending", "minted"]
+
+
+def now():
+    return datetime.now().isoformat()
+
+
+def unique_constraint_failed(field):
+    return GraphQLError(f"Unique constraint failed on the fields: (`{field}`)")
+
+
+class Dataset:
+    """In-memory tables of protocol records
+
+    Records are stored as flat rows; the relations of a row are
+    resolved when it is read through one of the view methods.
+    """
+
+    TABLES = [
+        "chain_types",
+        "twitter_users",
+        "users",
+        "discord_users",
+        "guilds",
+        "guild_users",
+        "activity_types",
+        "statuses",
+        "contributions",
+        "guild_contributions",
+    ]
+
+    def __init__(self):
+        self.tables = {table: {} for table in Dataset.TABLES}
+        self._ids = {table: itertools.count(1) for table in Dataset.TABLES}
+        self.insert("chain_types", {"name": "ETH"})
+
+    def insert(self, table, row):
+        timestamp = now()
+        row = {"createdAt": timestamp, "updatedAt": timestamp, **row}
+        row["id"] = next(self._ids[table])
+        self.tables[table][row["id"]] = row
+        return row
+
+    def rows(self, table):
+        return list(self.tables[table].values())
+
+    def find(self, table, **fields):
+        for row in self.tables[table].values():
+            if all(row.get(key) == value for key, value in fields.items()):
+                return row
+        return None
+
+    # views resolve the relations of a row. Relations are callables so
+    # they are only resolved for the fields a query selects
+
+    def user_view(self, row):
+        return {
+            **row,
+            "chain_type": lambda *_: self.tables["chain_types"][row["chain_type_id"]],
+            "twitter_user": lambda *_: self.tables["twitter_users"].get(
+                row.get("twitter_user_id")
+            ),
+            "guild_users": lambda *_: [
+                self.guild_user_view(guild_user)
+                for guild_user in self.rows("guild_users")
+                if guild_user["user_id"] == row["id"]
+            ],
+            "discord_users": lambda *_: [
+                discord_user
+                for discord_user in self.rows("discord_users")
+                if discord_user["user_id"] == row["id"]
+            ],
+        }
+
+    def guild_user_view(self, row):
+        return {
+            **row,
+            "guild": lambda *_: self.tables["guilds"][row["guild_id"]],
+            "user": lambda *_: self.user_view(self.tables["users"][row["user_id"]]),
+        }
+
+    def contribution_view(self, row):
+        return {
+            **row,
+            "activity_type": lambda *_: self.tables["activity_types"][
+                row["activity_type_id"]
+            ],
+            "status": lambda *_: self.tables["statuses"][row["status_id"]],
+            "user": lambda *_: self.user_view(self.tables["users"][row["user_id"]]),
+            "guilds": lambda *_: [
+                {
+                    **guild_contribution,
+                    "guild": self.tables["guilds"][guild_contribution["guild_id"]],
+                }
+                for guild_contribution in self.rows("guild_contributions")
+                if guild_contribution["contribution_id"] == row["id"]
+            ],
+        }
+
+
+def generate_dataset(users=50, guilds=5, contributions=1000, seed=0):
+    """Generates a dataset of related users, guilds and contributions
+
+    Args:
+      users: number of users, each with a discord user
+      guilds: number of guilds
+      contributions: number of contributions, spread over the last year
+      seed: seed of the random generator, so datasets are repeatable
+
+    Returns:
+      The generated Dataset
+    """
+    rng = random.Random(seed)
+    dataset = Dataset()
+    for name in ACTIVITY_TYPES:
+        dataset.insert("activity_types", {"name": name, "active": True})
+    for name in STATUSES:
+        dataset.insert("statuses", {"name": name})
+
+    guild_rows = [
+        dataset.insert(
+            "guilds",
+            {
+                "discord_id": str(900000000000000000 + i),
+                "name": f"Guild {i}",
+                "logo": None,
+                "status": "ACTIVE",
+                "congrats_channel": None,
+                "contribution_reporting_channel": None,
+            },
+        )
+        for i in range(guilds)
+    ]
+    user_rows = []
+    for i in range(users):
+        user = dataset.insert(
+            "users",
+            {
+                "address": "0x%040x" % rng.getrandbits(160),
+                "chain_type_id": 1,
+                "display_name": f"user {i}",
+                "full_name": None,
+                "name": f"user {i}",
+                "twitter_user_id": None,
+            },
+        )
+        dataset.insert(
+            "discord_users",
+            {
+                "discord_id": str(100000000000000000 + i),
+                "display_name": f"user {i}",
+                "user_id": user["id"],
+            },
+        )
+        for guild in rng.sample(guild_rows, k=min(len(guild_rows), rng.randint(1, 2))):
+            dataset.insert(
+                "guild_users", {"guild_id": guild["id"], "user_id": user["id"]}
+            )
+        user_rows.append(user)
+
+    start = datetime.now() - timedelta(days=365)
+    for i in range(contributions):
+        user = rng.choice(user_rows)
+        engaged = start + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        contribution = dataset.insert(
+            "contributions",
+            {
+                "name": f"contribution {i}",
+                "details": f"details of contribution {i}",
+                "proof": None,
+                "date_of_engagement": engaged.isoformat(),
+                "date_of_submission": (engaged + timedelta(days=1)).isoformat(),
+                "activity_type_id": rng.randint(1, len(ACTIVITY_TYPES)),
+                "status_id": rng.randint(1, len(STATUSES)),
+                "user_id": user["id"],
+            },
+        )
+        memberships = [
+            guild_user
+            for guild_user in dataset.rows("guild_users")
+            if guild_user["user_id"] == user["id"]
+        ]
+        if memberships:
+            dataset.insert(
+                "guild_contributions",
+                {
+                    "guild_id": rng.choice(memberships)["guild_id"],
+                    "contribution_id": contribution["id"],
+                },
+            )
+    return dataset
+
+
+def resolve(value):
+    return value() if callable(value) else value
+
+
+def matches_filter(value, condition):
+    for operator, operand in condition.items():
+        if operator == "equals" and value != operand:
+            return False
+        if operator == "in" and value not in operand:
+            return False
+        if operator == "not" and value == operand:
+            return False
+        if operator == "contains" and operand not in (value or ""):
+            return False
+        if operator in ("gt", "gte", "lt", "lte"):
+            if value is None:
+                return False
+            comparisons = {
+                "gt": value > operand,
+                "gte": value >= operand,
+                "lt": value < operand,
+                "lte": value <= operand,
+            }
+            if not comparisons[operator]:
+                return False
+    return True
+
+
+def matches(record, where):
+    """Evaluates a prisma where input against a record view"""
+    for key, condition in (where or {}).items():
+        if key == "AND":
+            conditions = condition if isinstance(condition, list) else [condition]
+            if not all(matches(record, c) for c in conditions):
+                return False
+            continue
+        if key == "OR":
+            if not any(matches(record, c) for c in condition):
+                return False
+            continue
+        if key == "NOT":
+            if matches(record, condition):
+                return False
+            continue
+
+        value = resolve(record.get(key))
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif "some" in condition or "every" in condition or "none" in condition:
+            value = value or []
+            if "some" in condition and not any(
+                matches(v, condition["some"]) for v in value
+            ):
+                return False
+            if "every" in condition and not all(
+                matches(v, condition["every"]) for v in value
+            ):
+                return False
+            if "none" in condition and any(
+                matches(v, condition["none"]) for v in value
+            ):
+                return False
+        elif "is" in condition or "isNot" in condition:
+            if "is" in condition and (
+                value is None or not matches(value, condition["is"])
+            ):
+                return False
+            if "isNot" in condition and value is not None:
+                if matches(value, condition["isNot"]):
+                    return False
+        elif not matches_filter(value, condition):
+            return False
+    return True
+
+
+def order_and_page(records, order_by=None, cursor=None, skip=None, take=None):
+    for order in reversed(order_by or []):
+        for field, direction in order.items():
+            records = sorted(
+                records, key=lambda r: r[field], reverse=direction == "desc"
+            )
+    if cursor:
+        start = next(
+            (i for i, r in enumerate(records) if matches(r, cursor)), len(records)
+        )
+        records = records[start:]
+    records = records[skip or 0 :]
+    if take is not None:
+        records = records[:take]
+    return records
+
+
+def apply_update(row, data):
+    for field, value in data.items():
+        if isinstance(value, dict):
+            if "set" not in value:
+                continue
+            value = value["set"]
+        row[field] = value
+    row["updatedAt"] = now()
+
+
+class Resolvers:
+    """Root resolvers of the stand-in schema"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def _users(self, where=None):
+        return [
+            user
+            for user in map(self.dataset.user_view, self.dataset.rows("users"))
+            if matches(user, where)
+        ]
+
+    def _guild_where_unique(self, where):
+        guild = self.dataset.find("guilds", **where)
+        if guild is None:
+            raise GraphQLError("Record to update not found.")
+        return guild
+
+    # queries
+
+    def users(self, _info, where=None, orderBy=None, skip=None, take=None):
+        return order_and_page(self._users(where), orderBy, skip=skip, take=take)
+
+    def guilds(self, _info, where=None, orderBy=None, skip=None, take=None):
+        guilds = [g for g in self.dataset.rows("guilds") if matches(g, where)]
+        return order_and_page(guilds, orderBy, skip=skip, take=take)
+
+    def guildUsers(self, _info, where=None, skip=None, take=None):
+        guild_users = [
+            guild_user
+            for guild_user in map(
+                self.dataset.guild_user_view, self.dataset.rows("guild_users")
+            )
+            if matches(guild_user, where)
+        ]
+        return order_and_page(guild_users, skip=skip, take=take)
+
+    def contributions(
+        self, _info, where=None, orderBy=None, cursor=None, skip=None, take=None
+    ):
+        contributions = [
+            contribution
+            for contribution in map(
+                self.dataset.contribution_view, self.dataset.rows("contributions")
+            )
+            if matches(contribution, where)
+        ]
+        return order_and_page(contributions, orderBy, cursor, skip, take)
+
+    def aggregateContribution(self, info, where=None):
+        return {"_count": {"_all": len(self.contributions(info, where))}}
+
+    # mutations
+
+    def createOneUser(self, _info, data):
+        dataset = self.dataset
+        if dataset.find("users", address=data["address"]):
+            raise unique_constraint_failed("address")
+        chain_type = dataset.find("chain_types", **data["chain_type"]["connect"])
+        user = dataset.insert(
+            "users",
+            {
+                "address": data["address"],
+                "chain_type_id": chain_type["id"],
+                "display_name": data.get("display_name"),
+                "full_name": data.get("full_name"),
+                "name": data.get("name"),
+                "twitter_user_id": None,
+            },
+        )
+        discord_users = data.get("discord_users", {})
+        for connect_or_create in discord_users.get("connectOrCreate", []):
+            discord_user = dataset.find(
+                "discord_users", **connect_or_create["where"]
+            ) or dataset.insert("discord_users", connect_or_create["create"])
+            discord_user["user_id"] = user["id"]
+        for guild_user in data.get("guild_users", {}).get("create", []):
+            guild = dataset.find("guilds", **guild_user["guild"]["connect"])
+            if guild is None:
+                raise GraphQLError("No 'Guild' record was found for a nested connect")
+            dataset.insert(
+                "guild_users", {"guild_id": guild["id"], "user_id": user["id"]}
+            )
+        return dataset.user_view(user)
+
+    def updateOneUser(self, _info, data, where):
+        dataset = self.dataset
+        user = dataset.find("users", **where)
+        if user is None:
+            raise GraphQLError("Record to update not found.")
+        data = dict(data)
+        twitter_user = data.pop("twitter_user", None)
+        if twitter_user and "create" in twitter_user:
+            username = twitter_user["create"]["username"]
+            if dataset.find("twitter_users", username=username):
+                raise unique_constraint_failed("username")
+            user["twitter_user_id"] = dataset.insert(
+                "twitter_users", {"username": username}
+            )["id"]
+        address = data.get("address", {})
+        address = address.get("set") if isinstance(address, dict) else address
+        if address is not None:
+            holder = dataset.find("users", address=address)
+            if holder is not None and holder["id"] != user["id"]:
+                raise unique_constraint_failed("address")
+        apply_update(user, data)
+        return dataset.user_view(user)
+
+    def updateManyUser(self, _info, data, where=None):
+        users = self._users(where)
+        for user in users:
+            apply_update(self.dataset.tables["users"][user["id"]], data)
+        return {"count": len(users)}
+
+    def createOneGuild(self, _info, data):
+        if self.dataset.find("guilds", discord_id=data.get("discord_id")):
+            raise unique_constraint_failed("discord_id")
+        fields = {
+            "discord_id": None,
+            "name": None,
+            "logo": None,
+            "status": None,
+            "congrats_channel": None,
+            "contribution_reporting_channel": None,
+        }
+        return self.dataset.insert("guilds", {**fields, **data})
+
+    def updateOneGuild(self, _info, data, where):
+        guild = self._guild_where_unique(where)
+        apply_update(guild, data)
+        return guild
+
+    def createOneGuildUser(self, _info, data):
+        guild = self._guild_where_unique(data["guild"]["connect"])
+        user = self.dataset.find("users", **data["user"]["connect"])
+        if user is None:
+            raise GraphQLError("No 'User' record was found for a nested connect")
+        guild_user = self.dataset.insert(
+            "guild_users", {"guild_id": guild["id"], "user_id": user["id"]}
+        )
+        return self.dataset.guild_user_view(guild_user)
+
+
+def create_app(dataset=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+    """Creates the stand-in aiohttp application
+
+    Args:
+      dataset: the Dataset to serve, defaults to a generated dataset
+      latency: seconds added to every request
+      jitter: maximum seconds of random latency added on top
+      error_rate: share of requests which fail with a 503
+      seed: seed of the random generator used for latency and errors
+
+    Returns:
+      The aiohttp application, serving graphql at /graphql and request
+      counts per operation at /stats
+
+    Automatic persisted queries are supported: a request may carry only
+    the SHA-256 hash of a query sent before.
+    """
+    rng = random.Random(seed)
+    resolvers = Resolvers(dataset or generate_dataset())
+    stats = Counter()
+    persisted_queries = {}
+
+    def get_query(payload):
+        persisted = (payload.get("extensions") or {}).get("persistedQuery")
+        if persisted is None:
+            return payload.get("query"), None
+        query_hash = persisted.get("sha256Hash")
+        query = payload.get("query")
+        if query is None:
+            query = persisted_queries.get(query_hash)
+            if query is None:
+                stats["persisted_query_misses"] += 1
+                return None, {
+                    "message": "PersistedQueryNotFound",
+                    "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"},
+                }
+        elif hashlib.sha256(query.encode("utf-8")).hexdigest() != query_hash:
+            return None, {"message": "provided sha does not match query"}
+        persisted_queries[query_hash] = query
+        return query, None
+
+    async def handle_graphql(request):
+        delay = latency + rng.uniform(0, jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        payload = await request.json()
+        query, error = get_query(payload)
+        if error is not None:
+            return web.json_response({"data": None, "errors": [error]})
+        try:
+            document = parse(query)
+        except GraphQLError as e:
+            return web.json_response({"data": None, "errors": [e.formatted]})
+        operation_name = payload.get("operationName")
+        if operation_name is None:
+            operation = get_operation_ast(document)
+            operation_name = (
+                operation.name.value if operation and operation.name else None
+            )
+        stats[operation_name or "anonymous"] += 1
+        if rng.random() < error_rate:
+            stats["injected_errors"] += 1
+            raise web.HTTPServiceUnavailable(reason="Injected error")
+
+        errors = validate(schema, document)
+        if errors:
+            result = ExecutionResult(data=None, errors=errors)
+        else:
+            # the resolvers are synchronous, so the result isn't awaitable
+            result = execute(
+                schema,
+                document,
+                root_value=resolvers,
+                variable_values=payload.get("variables"),
+                operation_name=payload.get("operationName"),
+            )
+        response = web.json_response(result.formatted)
+        # compressed when the client accepts it
+        response.enable_compression()
+        return response
+
+    async def handle_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app["dataset"] = resolvers.dataset
+    app["stats"] = stats
+    app.router.add_post("/graphql", handle_graphql)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--contributions", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.users, args.guilds, args.contributions, args.seed)
+    app = create_app(
+        dataset,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
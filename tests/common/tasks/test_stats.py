@@ -0,0 +1,35 @@
+import logging
+
+import pytest
+
+from bot.common.commands import event_executor
+from bot.common.tasks.stats import log_stats
+from bot.common.tasks.tasks import get_stats_task
+
+
+def test_log_stats(caplog):
+    def failing():
+        raise Exception("unavailable")
+
+    sources = {"cache": lambda: {"hits": 1}, "broken": failing}
+    with caplog.at_level(logging.INFO, logger="bot.common.tasks.stats"):
+        stats = log_stats(sources)
+
+    # a failing source doesn't keep the others from being logged
+    assert stats == {"cache": {"hits": 1}}
+    assert "Stats: {'cache': {'hits': 1}}" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_stats_task_logs_cache_and_event_stats(mocker, caplog):
+    mocker.patch("bot.common.tasks.tasks.TaskConstants.stats_log_minutes", "0")
+    task = get_stats_task(mocker.MagicMock())
+
+    with caplog.at_level(logging.INFO, logger="bot.common.tasks.stats"):
+        await task.log()
+
+    stats = task.last_stats
+    assert set(stats["protocol_cache"]) == {"user", "guild"}
+    assert "hits" in stats["protocol_cache"]["user"]
+    assert stats["events"] == event_executor.stats()
+    assert "'events': {'active': " in caplog.text
@@ -0,0 +1,32 @@
+import pytest
+
+from bot.common.tasks.thread_states import sweep_thread_states
+
+
+@pytest.mark.asyncio
+async def test_sweep_thread_states(mocker):
+    redis = mocker.MagicMock()
+    redis.scan = mocker.AsyncMock(
+        side_effect=[(5, [b"1", b"1_cooldown"]), (0, [b"2", b"3", b"4"])]
+    )
+    pipe = mocker.MagicMock()
+    redis.pipeline.return_value.__aenter__.return_value = pipe
+    pipe.execute = mocker.AsyncMock(
+        side_effect=[
+            # 1 expires on its own
+            [100, 5],
+            [],
+            # 2 and 3 were written without an expiry: 2 has been idle for
+            # too long and the idle time of 3 isn't known. 4 is gone
+            [-1, 7200, -1, Exception("lfu"), -2, None],
+            [],
+        ]
+    )
+
+    report = await sweep_thread_states(redis, idle_seconds=3600)
+
+    assert report == {"scanned": 3, "active": 1, "expiry_added": 1, "expired": 1}
+    pipe.delete.assert_called_once_with(b"2")
+    pipe.expire.assert_called_once_with(b"3", 3600)
+    # only user ids are looked at
+    assert pipe.ttl.call_count == 4
@@ -0,0 +1,116 @@
+import pytest
+
+from bot.common.cache import RedisCache, WrongTypeError
+from tests.test_utils import MockCache
+
+
+@pytest.mark.asyncio
+async def test_cache_bulk_operations():
+    cache = MockCache()
+    await cache.set_many({"a": "1", "b": "2"}, ex=60)
+    assert await cache.get_many(["a", "missing", "b"]) == ["1", None, "2"]
+
+    await cache.delete_many(["a", "missing"])
+    assert cache.internal == {"b": "2"}
+
+
+@pytest.mark.asyncio
+async def test_cache_pipeline():
+    cache = MockCache()
+    await cache.hset("h", {"f": "1"})
+
+    async with cache.pipeline() as pipe:
+        pipe.set("a", "1").hset("h", {"g": "2"})
+        results = await pipe.get("a").hgetall("h").delete("a").execute()
+    assert results[2:4] == ["1", {"f": "1", "g": "2"}]
+    assert "a" not in cache.internal
+    assert pipe.commands == []
+
+    with pytest.raises(WrongTypeError):
+        await cache.pipeline().get("h").execute()
+
+
+@pytest.mark.asyncio
+async def test_cache_write_hash_if():
+    cache = MockCache()
+    assert await cache.write_hash_if("h", "step", None, {"step": "a", "f": "1"})
+    assert not await cache.write_hash_if("h", "step", None, {"step": "b"})
+
+    assert await cache.write_hash_if("h", "step", "a", {"step": "b"})
+    assert cache.internal["h"] == {"step": "b", "f": "1"}
+    assert not await cache.write_hash_if("h", "step", "a", {}, replace=True)
+    assert await cache.write_hash_if("h", "step", "b", {"step": "c"}, replace=True)
+    assert cache.internal["h"] == {"step": "c"}
+    assert await cache.write_hash_if("h", "step", "c", {}, replace=True)
+    assert "h" not in cache.internal
+
+
+@pytest.fixture
+def redis(mocker):
+    redis = mocker.patch("bot.common.cache.Redis", new_callable=mocker.MagicMock)
+    pipe = mocker.MagicMock()
+    pipe.execute = mocker.AsyncMock(return_value=[1, 1])
+    redis.pipeline.return_value.__aenter__.return_value = pipe
+    redis.mget = mocker.AsyncMock(return_value=[b"1", None])
+    redis.mset = mocker.AsyncMock()
+    redis.delete = mocker.AsyncMock()
+    return redis
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_bulk_operations(redis):
+    cache = RedisCache()
+
+    assert await cache.get_many(["a", "b"]) == [b"1", None]
+    redis.mget.assert_awaited_once_with(["a", "b"])
+
+    await cache.set_many({"a": "1"})
+    redis.mset.assert_awaited_once_with({"a": "1"})
+    # keys that expire are set in a single pipeline instead
+    await cache.set_many({"a": "1", "b": "2"}, ex=60)
+    redis.pipeline.assert_called_once_with(transaction=False)
+    pipe = redis.pipeline.return_value.__aenter__.return_value
+    assert pipe.set.call_count == 2
+    pipe.set.assert_called_with("b", "2", ex=60)
+
+    await cache.delete_many(["a", "b"])
+    redis.delete.assert_awaited_once_with("a", "b")
+    # nothing is sent for empty batches
+    assert await cache.get_many([]) == []
+    await cache.delete_many([])
+    assert redis.delete.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_set_hash_is_one_transaction(redis):
+    await RedisCache().set_hash("h", {"f": "1"}, ex=60)
+
+    redis.pipeline.assert_called_once_with(transaction=True)
+    pipe = redis.pipeline.return_value.__aenter__.return_value
+    pipe.delete.assert_called_once_with("h")
+    pipe.hset.assert_called_once_with("h", mapping={"f": "1"})
+    pipe.expire.assert_called_once_with("h", 60)
+    pipe.execute.assert_awaited_once()
+
+    # an expiring hset is sent in the same round trip
+    await RedisCache().hset("h", {"f": "2"}, ex=60)
+    pipe.hset.assert_called_with("h", mapping={"f": "2"})
+    assert pipe.expire.call_count == 2
+    assert pipe.execute.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_write_hash_if(mocker):
+    script = mocker.patch.object(
+        RedisCache, "write_hash_if_script", mocker.AsyncMock(return_value=0)
+    )
+    cache = RedisCache()
+
+    assert not await cache.write_hash_if("h", "step", b"a", {"step": "b"})
+    script.assert_awaited_once_with(
+        keys=["h"], args=["step", 0, b"a", 0, 0, "step", "b"]
+    )
+
+    script.return_value = 1
+    assert await cache.write_hash_if("h", "step", None, {}, replace=True, ex=60)
+    script.assert_awaited_with(keys=["h"], args=["step", 1, "", 1, 60])
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+
+from bot.common.dataloader import DataLoader
+
+
+@pytest.mark.asyncio
+async def test_loads_in_the_same_tick_are_batched():
+    batches = []
+
+    async def batch_load(keys):
+        batches.append(keys)
+        return [f"value_{key}" for key in keys]
+
+    loader = DataLoader(batch_load)
+    values = await asyncio.gather(
+        loader.load(1), loader.load(2), loader.load(1), loader.load(3)
+    )
+
+    assert values == ["value_1", "value_2", "value_1", "value_3"]
+    assert batches == [[1, 2, 3]]
+
+    # later loads are sent in a new batch
+    assert await loader.load_many([4, 5]) == ["value_4", "value_5"]
+    assert batches == [[1, 2, 3], [4, 5]]
+
+
+@pytest.mark.asyncio
+async def test_batch_errors_are_raised_to_every_caller():
+    async def batch_load(keys):
+        raise Exception("backend is down")
+
+    loader = DataLoader(batch_load)
+    results = await asyncio.gather(
+        loader.load(1), loader.load(2), return_exceptions=True
+    )
+    assert all(f"{result}" == "backend is down" for result in results)
+
+
+@pytest.mark.asyncio
+async def test_batch_length_mismatch():
+    async def batch_load(keys):
+        return []
+
+    loader = DataLoader(batch_load)
+    with pytest.raises(ValueError):
+        await loader.load(1)
+
+
+@pytest.mark.asyncio
+async def test_pending_batches_are_referenced():
+    released = asyncio.Event()
+
+    async def batch_load(keys):
+        await released.wait()
+        return keys
+
+    loader = DataLoader(batch_load)
+    value = loader.load(1)
+    await asyncio.sleep(0)
+    # the task of the batch is kept while it waits on the batch function
+    assert len(loader._batches) == 1
+
+    released.set()
+    assert await value == 1
+    await asyncio.sleep(0)
+    assert not loader._batches
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from bot.common.executor import UserEventExecutor
+
+
+@pytest.mark.asyncio
+async def test_events_of_a_user_run_in_order():
+    executor = UserEventExecutor(concurrency=10)
+    order = []
+    release = asyncio.Event()
+
+    async def handle(name, wait=False):
+        order.append(f"start {name}")
+        if wait:
+            await release.wait()
+        order.append(f"end {name}")
+        return name
+
+    first = asyncio.create_task(executor.run(1, handle, "a", True))
+    second = asyncio.create_task(executor.run(1, handle, "b"))
+    other = asyncio.create_task(executor.run(2, handle, "c"))
+    await asyncio.sleep(0)
+
+    # the other user isn't held up by the first user's slow event
+    assert await other == "c"
+    stats = executor.stats()
+    assert (stats["users"], stats["queued"], stats["max_depth"]) == (1, 1, 2)
+
+    release.set()
+    assert await asyncio.gather(first, second) == ["a", "b"]
+    assert order == ["start a", "start c", "end c", "end a", "start b", "end b"]
+    # idle queues are dropped
+    assert executor.queues == {}
+    assert executor.stats()["handled"] == 3
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_limited_across_users():
+    executor = UserEventExecutor(concurrency=2)
+    release = asyncio.Event()
+    running = []
+
+    async def handle(user_id):
+        running.append(user_id)
+        await release.wait()
+
+    tasks = [asyncio.create_task(executor.run(user, handle, user)) for user in range(3)]
+    await asyncio.sleep(0)
+    assert running == [0, 1]
+    assert executor.stats()["active"] == 2
+    assert executor.stats()["queued"] == 1
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert running == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_failed_event_releases_the_queue():
+    executor = UserEventExecutor(concurrency=1)
+
+    async def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        await executor.run(1, fail)
+    assert executor.queues == {}
+    assert executor.stats()["active"] == 0
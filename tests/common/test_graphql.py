@@ -0,0 +1,548 @@
+import asyncio
+import pytest
+
+from gql.transport.exceptions import TransportQueryError
+
+import bot.common.graphql as graphql
+from bot.common.graphql import GqlSessionManager, OperationRegistry
+from bot.common.resilience import (
+    CircuitBreaker,
+    remaining_budget,
+    reset_deadline,
+    set_deadline,
+)
+from bot.common.scheduler import BATCH, INTERACTIVE, get_lane
+from bot.exceptions import DeadlineExceededException, ProtocolUnavailableException
+
+
+@pytest.mark.asyncio
+async def test_session_manager_reuses_session(mocker):
+    mocker.patch("bot.common.graphql.get_async_transport")
+    client = mocker.patch("bot.common.graphql.Client")
+    manager = GqlSessionManager(url="http://localhost")
+
+    session = await manager.open()
+    assert manager.is_open
+    assert await manager.open() is session
+    await manager.execute("query", {"a": 1})
+    await manager.execute("query", {"a": 2})
+
+    # a single client is created for every query
+    client.assert_called_once()
+    assert session.execute.await_count == 2
+
+    await manager.close()
+    assert not manager.is_open
+    client.return_value.__aexit__.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_session_manager_context(mocker):
+    mocker.patch("bot.common.graphql.get_async_transport")
+    client = mocker.patch("bot.common.graphql.Client")
+
+    async with GqlSessionManager(url="http://localhost") as manager:
+        assert manager.is_open
+
+    assert not manager.is_open
+    client.return_value.__aexit__.assert_awaited_once()
+
+
+def test_operation_registry_parses_once(mocker):
+    registry = OperationRegistry()
+    registry.register(
+        "getThing",
+        "query getThing { thing { ...ThingFragment } }",
+        "fragment ThingFragment on Thing { id }",
+    )
+    parse = mocker.spy(graphql, "gql")
+
+    document = registry.get("getThing")
+    assert registry.get("getThing") is document
+    parse.assert_called_once()
+
+    with pytest.raises(KeyError):
+        registry.register("getThing", "query getThing { thing { id } }")
+
+
+def test_registered_operations_parse():
+    graphql.operations.compile_all()
+
+
+@pytest.mark.asyncio
+async def test_get_guilds_by_ids_orders_results(mocker):
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"result": [{"id": 2, "name": "b"}, {"id": 1, "name": "a"}]},
+    )
+    guilds = await graphql.get_guilds_by_ids([1, 3, 2])
+
+    assert [guild and guild["name"] for guild in guilds] == ["a", None, "b"]
+    execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_get_guild_by_discord_id_batches(mocker):
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={
+            "result": [{"id": 1, "discord_id": "10"}, {"id": 2, "discord_id": "20"}]
+        },
+    )
+    guilds = await asyncio.gather(
+        graphql.get_guild_by_discord_id(10),
+        graphql.get_guild_by_discord_id("20"),
+        graphql.get_guild_by_discord_id(30),
+    )
+
+    assert [guild and guild["id"] for guild in guilds] == [1, 2, None]
+    execute.assert_awaited_once()
+    variables = execute.await_args.args[1]
+    assert variables == {"where": {"discord_id": {"in": ["10", "20", "30"]}}}
+
+
+@pytest.mark.asyncio
+async def test_identical_reads_are_coalesced(mocker):
+    async def execute(query, values):
+        await asyncio.sleep(0)
+        return {"result": [{"id": 1, "guild_users": []}]}
+
+    session_execute = mocker.patch.object(
+        graphql.session_manager, "execute", side_effect=execute
+    )
+    hits = graphql.coalescer.hits
+    users = await asyncio.gather(
+        graphql.get_user_by_discord_id(1),
+        graphql.get_user_by_discord_id(1),
+        graphql.get_user_by_discord_id(2),
+    )
+
+    assert all(user["id"] == 1 for user in users)
+    # callers don't share the same result object
+    assert users[0] is not users[1]
+    assert session_execute.await_count == 2
+    assert graphql.coalescer.hits == hits + 1
+    assert graphql.coalescer.stats()["inflight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesced_callers_get_their_own_copy():
+    coalescer = graphql.RequestCoalescer()
+
+    async def fetch():
+        await asyncio.sleep(0)
+        return {"name": "a"}
+
+    async def fetch_and_rename():
+        # the caller which sent the request resumes first
+        result = await coalescer.do("key", fetch)
+        result["name"] = "b"
+        return result
+
+    renamed, result = await asyncio.gather(
+        fetch_and_rename(), coalescer.do("key", fetch)
+    )
+    assert renamed == {"name": "b"}
+    assert result == {"name": "a"}
+
+
+@pytest.mark.asyncio
+async def test_mutations_are_not_coalesced(mocker):
+    async def execute(query, values):
+        await asyncio.sleep(0)
+        return {"updateGuild": {"id": 1}}
+
+    session_execute = mocker.patch.object(
+        graphql.session_manager, "execute", side_effect=execute
+    )
+    await asyncio.gather(
+        graphql.update_guild_name(1, "name"), graphql.update_guild_name(1, "name")
+    )
+    assert session_execute.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_iter_contributions_pages(mocker):
+    pages = [
+        {"result": [{"id": 1}, {"id": 2}]},
+        {"result": [{"id": 3}, {"id": 4}]},
+        {"result": [{"id": 5}]},
+    ]
+    execute = mocker.patch("bot.common.graphql.execute_query", side_effect=pages)
+
+    contributions = [
+        contribution
+        async for contribution in graphql.iter_contributions(guild_id=1, page_size=2)
+    ]
+
+    assert [c["id"] for c in contributions] == [1, 2, 3, 4, 5]
+    assert execute.await_count == 3
+    first, second, third = [call.args[1] for call in execute.await_args_list]
+    assert first["take"] == 2 and "cursor" not in first
+    assert second["cursor"] == {"id": 2} and second["skip"] == 1
+    assert third["cursor"] == {"id": 4}
+
+
+@pytest.mark.asyncio
+async def test_get_contributions_empty(mocker):
+    mocker.patch("bot.common.graphql.execute_query", return_value={"result": []})
+    assert await graphql.get_contributions(1, None, None) is None
+
+
+@pytest.mark.asyncio
+async def test_count_contributions(mocker):
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"result": {"_count": {"_all": 3}}},
+    )
+    assert await graphql.count_contributions(1, 1234, "2022-09-21") == 3
+    variables = execute.await_args.args[1]
+    assert variables["where"] == graphql.build_contributions_where(
+        1, 1234, "2022-09-21"
+    )
+
+
+@pytest.mark.asyncio
+async def test_iter_contributions_projection(mocker):
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query", return_value={"result": []}
+    )
+    async for _ in graphql.iter_contributions(projection="history-row"):
+        pass
+
+    document = execute.await_args.args[0]
+    operation = graphql.get_operation_definition(document)
+    assert operation.name.value == "listContributionHistoryRows"
+
+
+@pytest.mark.asyncio
+async def test_guild_cache_read_through(mocker):
+    guild = {"id": 1, "discord_id": "10", "name": "a"}
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query", return_value={"result": [guild]}
+    )
+
+    assert await graphql.get_guild_by_discord_id(10) == guild
+    # cached under both the discord id and the db id
+    assert await graphql.get_guild_by_discord_id("10") == guild
+    assert await graphql.get_guild_by_id(1) == guild
+    execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_update_guild_name_invalidates_cache(mocker):
+    guild = {"id": 1, "discord_id": "10", "name": "a"}
+    mocker.patch("bot.common.graphql.execute_query", return_value={"result": [guild]})
+    await graphql.get_guild_by_discord_id(10)
+
+    mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"updateOneGuild": {"id": 1, "discord_id": "10"}},
+    )
+    assert await graphql.update_guild_name(10, "b") == {"id": 1, "discord_id": "10"}
+    assert await graphql.guild_cache.get("discord_id:10") is None
+    assert await graphql.guild_cache.get("id:1") is None
+
+
+@pytest.mark.asyncio
+async def test_stale_user_refreshed_in_background(mocker):
+    now = mocker.patch("bot.common.ttl_cache.time.monotonic", return_value=100)
+    mocker.patch.object(graphql.user_cache, "stale_ttl", 600)
+    fetches = []
+
+    async def fetch_user(discord_id):
+        fetches.append((get_lane(), remaining_budget()))
+        return {"id": len(fetches), "discord_users": [{"discord_id": "10"}]}
+
+    mocker.patch("bot.common.graphql.fetch_user_by_discord_id", fetch_user)
+    assert (await graphql.get_user_by_discord_id(10))["id"] == 1
+
+    now.return_value = 100 + graphql.user_cache.ttl + 1
+    token = set_deadline(5)
+    try:
+        assert (await graphql.get_user_by_discord_id(10))["id"] == 1
+    finally:
+        reset_deadline(token)
+    await asyncio.sleep(0)
+
+    assert (await graphql.get_user_by_discord_id(10))["id"] == 2
+    # the refresh ran outside of the interaction's deadline and lane
+    assert fetches == [(INTERACTIVE, None), (BATCH, None)]
+    assert graphql.get_cache_stats()["user"]["stale_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_user_cache_refreshed_by_mutations(mocker):
+    user = {"id": 1, "display_name": "a", "discord_users": [{"discord_id": "10"}]}
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query", return_value={"result": [user]}
+    )
+    assert await graphql.get_user_by_discord_id(10) == user
+    assert await graphql.get_user_by_discord_id(10) == user
+    execute.assert_awaited_once()
+
+    updated = {**user, "display_name": "b"}
+    mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"updateOneUser": updated},
+    )
+    assert await graphql.update_user_display_name(1, "b") == updated
+    assert await graphql.get_user_by_discord_id(10) == updated
+
+
+@pytest.mark.asyncio
+async def test_create_user_returns_created_user(mocker):
+    user = {"id": 1, "discord_users": [{"discord_id": "10"}]}
+    mocker.patch(
+        "bot.common.graphql.execute_query", return_value={"createOneUser": user}
+    )
+    assert await graphql.create_user(10, "a", "0x0") == user
+    assert await graphql.user_cache.get("10") == user
+
+
+@pytest.fixture
+def no_backoff(mocker):
+    mocker.patch.object(graphql.read_retry_policy, "backoff", return_value=0)
+    mocker.patch.object(graphql, "circuit_breaker", CircuitBreaker())
+
+
+@pytest.mark.asyncio
+async def test_reads_are_retried(mocker, no_backoff):
+    session_execute = mocker.patch.object(
+        graphql.session_manager,
+        "execute",
+        side_effect=[asyncio.TimeoutError(), {"result": [{"id": 1}]}],
+    )
+    assert await graphql.fetch_user_by_discord_id(1) == {"id": 1}
+    assert session_execute.await_count == 2
+
+
+def fake_stream(*outcomes):
+    calls = iter(outcomes)
+
+    async def stream(query, values, path, extra_args=None):
+        for item in next(calls):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    return stream
+
+
+@pytest.mark.asyncio
+async def test_streamed_reads_are_retried_before_the_first_item(mocker, no_backoff):
+    mocker.patch.object(
+        graphql.session_manager,
+        "stream",
+        fake_stream([asyncio.TimeoutError()], [{"id": 1}, {"id": 2}]),
+    )
+    query = graphql.operations.get("listContributionReportRows")
+    items = [item async for item in graphql.stream_query(query, {}, ("result",))]
+    assert items == [{"id": 1}, {"id": 2}]
+
+
+@pytest.mark.asyncio
+async def test_streamed_reads_are_not_retried_after_an_item(mocker, no_backoff):
+    mocker.patch.object(
+        graphql.session_manager,
+        "stream",
+        fake_stream([{"id": 1}, asyncio.TimeoutError()], [{"id": 1}]),
+    )
+    query = graphql.operations.get("listContributionReportRows")
+    items = []
+    with pytest.raises(asyncio.TimeoutError):
+        async for item in graphql.stream_query(query, {}, ("result",)):
+            items.append(item)
+    assert items == [{"id": 1}]
+
+
+@pytest.mark.asyncio
+async def test_mutations_are_not_retried(mocker, no_backoff):
+    session_execute = mocker.patch.object(
+        graphql.session_manager, "execute", side_effect=asyncio.TimeoutError()
+    )
+    with pytest.raises(asyncio.TimeoutError):
+        await graphql.update_guild_name(1, "name")
+    session_execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_expired_deadline_fails_fast(mocker, no_backoff):
+    session_execute = mocker.patch.object(graphql.session_manager, "execute")
+    token = set_deadline(0)
+    try:
+        with pytest.raises(DeadlineExceededException):
+            await graphql.fetch_user_by_discord_id(1)
+    finally:
+        reset_deadline(token)
+    session_execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_breaker_fails_fast(mocker):
+    breaker = CircuitBreaker(min_requests=1)
+    breaker.record_failure()
+    mocker.patch.object(graphql, "circuit_breaker", breaker)
+    session_execute = mocker.patch.object(graphql.session_manager, "execute")
+
+    with pytest.raises(ProtocolUnavailableException):
+        await graphql.update_guild_name(1, "name")
+    session_execute.assert_not_awaited()
+
+
+@pytest.fixture
+def half_open_breaker(mocker):
+    # only the breaker's clock is moved on, not the event loop's
+    clock = mocker.patch("bot.common.resilience.time")
+    clock.monotonic.return_value = 0
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.monotonic.return_value = 30
+    mocker.patch.object(graphql, "circuit_breaker", breaker)
+    return breaker
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_releases_circuit_breaker(mocker, half_open_breaker):
+    started = asyncio.Event()
+
+    async def execute(query, values):
+        started.set()
+        await asyncio.Event().wait()
+
+    mocker.patch.object(graphql.session_manager, "execute", execute)
+    trial = asyncio.create_task(graphql.update_guild_name(1, "name"))
+    await started.wait()
+    assert not half_open_breaker.allow_request()
+
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    assert half_open_breaker.allow_request()
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_releases_circuit_breaker(mocker, half_open_breaker):
+    mocker.patch.object(
+        graphql.session_manager, "stream", fake_stream([{"id": 1}, {"id": 2}])
+    )
+    query = graphql.operations.get("listContributionReportRows")
+    items = graphql.stream_query(query, {}, ("result",))
+    assert await items.__anext__() == {"id": 1}
+    await items.aclose()
+    assert half_open_breaker.allow_request()
+
+
+@pytest.mark.asyncio
+async def test_get_user_guild_membership(mocker):
+    user = {"id": 1, "guild_users": [], "discord_users": [{"discord_id": "10"}]}
+    guild = {"id": 2, "discord_id": "20"}
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"users": [user], "guilds": [guild], "membership": []},
+    )
+
+    assert await graphql.get_user_guild_membership(10, 20) == (user, guild, False)
+    # both records are cached, so the next lookup doesn't send a request
+    assert await graphql.get_user_guild_membership(10, 20) == (user, guild, False)
+    assert await graphql.get_guild_by_discord_id(20) == guild
+    execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_create_onboarded_user(mocker):
+    user = {"id": 1, "guild_users": [], "discord_users": [{"discord_id": "10"}]}
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"released": {"count": 0}, "user": user},
+    )
+
+    assert await graphql.create_onboarded_user(10, "a", "b", "0x0", 20, "x") == user
+    execute.assert_awaited_once()
+    variables = execute.await_args.args[1]
+    assert variables["wallet"] == "0x0"
+    assert variables["releasedWallet"] == "x"
+    assert variables["data"]["guild_users"] == {
+        "create": [{"guild": {"connect": {"discord_id": "20"}}}]
+    }
+    assert await graphql.user_cache.get("10") == user
+
+
+@pytest.mark.asyncio
+async def test_create_onboarded_user_invalidates_released_users(mocker):
+    user = {"id": 1, "guild_users": [], "discord_users": [{"discord_id": "10"}]}
+    previous = {"id": 2, "address": "0x0", "discord_users": [{"discord_id": "30"}]}
+    await graphql.user_cache.set("30", previous)
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        side_effect=[
+            {"released": {"count": 1}, "user": user},
+            {"result": [{**previous, "address": "x"}]},
+        ],
+    )
+
+    await graphql.create_onboarded_user(10, "a", "b", "0x0", 20, "x")
+    # the users who held the wallet are found by the address they were given
+    variables = execute.await_args.args[1]
+    assert variables == {"where": {"address": {"equals": "x"}}}
+    assert await graphql.user_cache.get("30") is None
+
+
+@pytest.mark.asyncio
+async def test_operation_batch_merges_operations(mocker):
+    execute = mocker.patch(
+        "bot.common.graphql.execute_query",
+        return_value={"b0_updateOneGuild": {"id": 1}, "b1_updateOneGuild": {"id": 2}},
+    )
+    batch = graphql.OperationBatch()
+    batch.add("updateGuild", {"data": {}, "where": {"discord_id": "10"}})
+    batch.add("updateGuild", {"data": {}, "where": {"discord_id": "20"}})
+
+    results = await batch.execute()
+
+    assert results == [{"updateOneGuild": {"id": 1}}, {"updateOneGuild": {"id": 2}}]
+    execute.assert_awaited_once()
+    document, variables = execute.await_args.args
+    assert document is batch.build_document()
+    assert variables["b1_where"] == {"discord_id": "20"}
+    operation = graphql.get_operation_definition(document)
+    assert [field.alias.value for field in operation.selection_set.selections] == [
+        "b0_updateOneGuild",
+        "b1_updateOneGuild",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_operation_batch_maps_errors(mocker):
+    error = TransportQueryError(
+        "failed",
+        errors=[{"message": "failed", "path": ["b1_updateOneGuild"]}],
+        data={"b0_updateOneGuild": {"id": 1}, "b1_updateOneGuild": None},
+    )
+    mocker.patch("bot.common.graphql.execute_query", side_effect=error)
+
+    results = await graphql.execute_batch(
+        [
+            ("updateGuild", {"data": {}, "where": {"discord_id": "10"}}),
+            ("updateGuild", {"data": {}, "where": {"discord_id": "20"}}),
+        ],
+        return_exceptions=True,
+    )
+
+    assert results[0] == {"updateOneGuild": {"id": 1}}
+    assert isinstance(results[1], TransportQueryError)
+
+    # errors without a path fail every operation
+    error.errors = [{"message": "failed"}]
+    with pytest.raises(TransportQueryError):
+        await graphql.execute_batch(
+            [("updateGuild", {"data": {}, "where": {"discord_id": "20"}})]
+        )
+
+
+def test_operation_batch_rejects_mixed_operations():
+    batch = graphql.OperationBatch()
+    batch.add("getUser", {"where": {}})
+    batch.add("updateGuild", {"data": {}, "where": {}})
+    with pytest.raises(ValueError):
+        batch.build_document()
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from bot.common.json_stream import JsonArrayStream, JsonStreamError
+
+
+async def iter_chunks(data, size):
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+async def decode(document, path, size=1):
+    data = json.dumps(document, ensure_ascii=False).encode("utf-8")
+    stream = JsonArrayStream(iter_chunks(data, size), path)
+    items = [item async for item in stream]
+    return items, stream
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [1, 3, 4096])
+async def test_json_array_stream_items(size):
+    items = [{"id": i, "name": "contribution ✓", "score": 10.5 * i} for i in range(5)]
+    document = {
+        "extensions": {"cost": 12},
+        "data": {"other": [1, 2], "result": items},
+        "errors": [{"message": "partial"}],
+    }
+
+    decoded, stream = await decode(document, ("data", "result"), size)
+
+    assert decoded == items
+    assert stream.found
+    assert stream.document == {**document, "data": {"other": [1, 2], "result": []}}
+
+
+@pytest.mark.asyncio
+async def test_json_array_stream_numbers_across_chunks():
+    decoded, _ = await decode({"data": {"result": [12345, 6789]}}, ("data", "result"))
+    assert decoded == [12345, 6789]
+
+
+@pytest.mark.asyncio
+async def test_json_array_stream_missing_array():
+    decoded, stream = await decode({"data": None, "errors": []}, ("data", "result"))
+
+    assert decoded == []
+    assert not stream.found
+    assert stream.document == {"data": None, "errors": []}
+
+
+@pytest.mark.asyncio
+async def test_json_array_stream_truncated_document():
+    data = b'{"data": {"result": [{"id": 1}, {"id"'
+    stream = JsonArrayStream(iter_chunks(data, 5), ("data", "result"))
+    decoded = []
+
+    with pytest.raises((JsonStreamError, json.JSONDecodeError)):
+        async for item in stream:
+            decoded.append(item)
+    assert decoded == [{"id": 1}]
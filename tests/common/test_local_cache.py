@@ -0,0 +1,190 @@
+import asyncio
+import json
+
+import pytest
+
+from bot.common.local_cache import LocalCache
+from tests.test_utils import MockCache
+
+
+@pytest.mark.asyncio
+async def test_local_cache_serves_reads_until_written(mocker):
+    cache = MockCache()
+    await cache.hset("1", {"step": "a"})
+    local = LocalCache(cache)
+    hgetall = mocker.spy(cache, "hgetall")
+
+    assert await local.hgetall("1") == {"step": "a"}
+    assert await local.hgetall("1") == {"step": "a"}
+    assert await local.hget("1", "step") == "a"
+    assert hgetall.await_count == 1
+
+    await local.hset("1", {"step": "b"})
+    assert await local.hgetall("1") == {"step": "b"}
+    assert await local.get("missing") is None
+    assert await local.get("missing") is None
+
+    stats = local.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (3, 3, 2)
+
+    # writes sent through a pipeline drop the local values too
+    async with local.pipeline() as pipe:
+        await pipe.set("missing", "1").hgetall("1").execute()
+    assert await local.get("missing") == "1"
+
+
+@pytest.mark.asyncio
+async def test_local_cache_bounds(mocker):
+    now = mocker.patch("bot.common.local_cache.time.monotonic", return_value=100)
+    cache = MockCache()
+    await cache.set_many({"a": "1" * 10, "b": "2" * 10, "c": "3" * 15, "d": "4" * 50})
+    local = LocalCache(cache, max_entries=2, max_bytes=30, ttl=10)
+
+    await local.get("a")
+    await local.get("b")
+    await local.get("a")
+    # the least recently used value is dropped first
+    await local.get("c")
+    assert list(local.entries) == ["a", "c"]
+    assert local.bytes == 27
+    # values larger than the whole budget aren't kept
+    await local.get("d")
+    assert list(local.entries) == ["a", "c"]
+    assert local.stats()["evictions"] == 1
+
+    now.return_value = 111
+    await local.get("a")
+    assert local.stats()["hits"] == 1
+
+
+class SlowCache(MockCache):
+    async def get(self, key):
+        value = await super().get(key)
+        await asyncio.sleep(0)
+        return value
+
+
+@pytest.mark.asyncio
+async def test_local_cache_drops_reads_racing_a_write():
+    cache = SlowCache()
+    await cache.set("a", "1")
+    local = LocalCache(cache)
+
+    read = asyncio.create_task(local.get("a"))
+    await asyncio.sleep(0)
+    await local.set("a", "2")
+    # the value read before the write isn't kept
+    assert await read == "1"
+    assert "a" not in local.entries
+    assert await local.get("a") == "2"
+
+
+class MockPubSub:
+    def __init__(self, messages):
+        self.messages = messages
+        self.channels = []
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def listen(self):
+        while True:
+            yield await self.messages.get()
+
+    async def reset(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_local_cache_invalidation_channel(mocker):
+    messages = asyncio.Queue()
+    redis = mocker.MagicMock()
+    redis.pubsub.return_value = MockPubSub(messages)
+    redis.publish = mocker.AsyncMock()
+    cache = MockCache()
+    await cache.set("a", "1")
+    local = LocalCache(cache, redis=redis)
+
+    # nothing is kept before the subscription is made
+    assert await local.get("a") == "1"
+    assert local.entries == {}
+    await asyncio.sleep(0)
+    assert await local.get("a") == "1"
+    assert "a" in local.entries
+
+    # a write is published for the other replicas
+    await local.delete("b")
+    redis.publish.assert_awaited_once_with(local.channel, json.dumps(["b"]))
+
+    # and their writes drop the value here
+    await messages.put({"type": "message", "data": json.dumps(["a"]).encode()})
+    await asyncio.sleep(0)
+    assert "a" not in local.entries
+
+    await local.get("a")
+    local._listener.cancel()
+    await asyncio.sleep(0)
+    # values may be stale once the subscription is lost
+    assert local.entries == {}
+    assert not local.subscribed
+
+
+class BytesCache(MockCache):
+    """Returns field names as bytes, as the redis client does"""
+
+    async def hgetall(self, key):
+        fields = await super().hgetall(key)
+        return {name.encode("utf-8"): value for name, value in fields.items()}
+
+
+@pytest.mark.asyncio
+async def test_local_cache_hget_of_bytes_field_names():
+    cache = BytesCache()
+    await cache.hset("1", {"metadata:a": "1"})
+    local = LocalCache(cache)
+
+    assert await local.hget("1", "metadata:a") == "1"
+    assert await local.hgetall("1") == {b"metadata:a": "1"}
+    # now served from the cached hash
+    assert await local.hget("1", "metadata:a") == "1"
+    assert await local.hget("1", "missing") is None
+    assert local.stats()["hits"] == 2
+
+
+class FailingPubSub:
+    async def subscribe(self, channel):
+        raise ConnectionError("redis is down")
+
+    async def reset(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_local_cache_resubscribes_with_backoff(mocker):
+    clock = mocker.patch("bot.common.local_cache.time")
+    clock.monotonic.return_value = 100
+    redis = mocker.MagicMock()
+    redis.pubsub.side_effect = lambda: FailingPubSub()
+    local = LocalCache(MockCache(), redis=redis, retry_seconds=4)
+
+    async def read_and_settle():
+        await local.get("a")
+        await asyncio.sleep(0)
+
+    await read_and_settle()
+    # no new subscription is attempted until the backoff has passed
+    for _ in range(3):
+        await read_and_settle()
+    assert redis.pubsub.call_count == 1
+
+    clock.monotonic.return_value = 101
+    await read_and_settle()
+    assert redis.pubsub.call_count == 2
+    # the wait doubles after every failure, up to retry_seconds
+    clock.monotonic.return_value = 102
+    await read_and_settle()
+    assert redis.pubsub.call_count == 2
+    clock.monotonic.return_value = 103
+    await read_and_settle()
+    assert redis.pubsub.call_count == 3
+    assert local._retry_delay == 4
@@ -0,0 +1,85 @@
+import pytest
+
+from bot.common.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    remaining_budget,
+    reset_deadline,
+    set_deadline,
+)
+
+
+def test_circuit_breaker_opens_and_recovers(mocker):
+    now = mocker.patch("bot.common.resilience.time.monotonic", return_value=0)
+    breaker = CircuitBreaker(
+        failure_rate=0.5, window_size=4, min_requests=4, reset_timeout=30
+    )
+
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+
+    # a single trial request is let through once the reset timeout passes
+    now.return_value = 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now.return_value = 60
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_circuit_breaker_trial_is_released(mocker):
+    now = mocker.patch("bot.common.resilience.time.monotonic", return_value=0)
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=30)
+    breaker.record_failure()
+
+    now.return_value = 30
+    breaker.record_abandoned(breaker.allow_request())
+    # the trial ended without an outcome, so another one is let through
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+    # a trial that never reports back is given up on
+    now.return_value = 60
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_circuit_breaker_trial_is_only_released_by_its_request(mocker):
+    now = mocker.patch("bot.common.resilience.time.monotonic", return_value=0)
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=30)
+    # admitted while closed, and abandoned once the breaker is half open
+    permit = breaker.allow_request()
+    breaker.record_failure()
+
+    now.return_value = 30
+    assert breaker.allow_request()
+    breaker.record_abandoned(permit)
+    assert not breaker.allow_request()
+
+
+def test_retry_policy_backoff_is_capped():
+    policy = RetryPolicy(attempts=5, base=0.1, cap=0.3)
+    for attempt in range(5):
+        assert 0 <= policy.backoff(attempt) <= 0.3
+
+
+@pytest.mark.parametrize("seconds", [1, 10])
+def test_deadline_budget(mocker, seconds):
+    mocker.patch("bot.common.resilience.time.monotonic", return_value=100)
+    assert remaining_budget() is None
+
+    token = set_deadline(seconds)
+    assert remaining_budget() == seconds
+    reset_deadline(token)
+    assert remaining_budget() is None
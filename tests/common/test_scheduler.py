@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from bot.common.scheduler import (
+    BATCH,
+    INTERACTIVE,
+    PriorityScheduler,
+    get_lane,
+    use_lane,
+)
+
+
+def test_use_lane():
+    assert get_lane() == INTERACTIVE
+    with use_lane(BATCH):
+        assert get_lane() == BATCH
+    assert get_lane() == INTERACTIVE
+
+
+@pytest.mark.asyncio
+async def test_lane_limits():
+    scheduler = PriorityScheduler({INTERACTIVE: 2, BATCH: 1})
+    await scheduler.acquire(BATCH)
+    batch = asyncio.create_task(scheduler.acquire(BATCH))
+    await scheduler.acquire(INTERACTIVE)
+    await scheduler.acquire(INTERACTIVE)
+    await asyncio.sleep(0)
+
+    assert not batch.done()
+    assert scheduler.stats()[BATCH]["waiting"] == 1
+
+    scheduler.release(BATCH)
+    await batch
+    assert scheduler.active == {INTERACTIVE: 2, BATCH: 1}
+
+
+@pytest.mark.asyncio
+async def test_interactive_jumps_the_queue():
+    scheduler = PriorityScheduler({INTERACTIVE: 2, BATCH: 2}, total=1)
+    order = []
+
+    async def request(lane, name):
+        async with scheduler.slot(lane):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    await scheduler.acquire(BATCH)
+    tasks = [
+        asyncio.create_task(request(BATCH, "batch")),
+        asyncio.create_task(request(INTERACTIVE, "interactive 1")),
+        asyncio.create_task(request(INTERACTIVE, "interactive 2")),
+    ]
+    await asyncio.sleep(0)
+    scheduler.release(BATCH)
+    await asyncio.gather(*tasks)
+
+    assert order == ["interactive 1", "interactive 2", "batch"]
+    assert scheduler.stats()[BATCH]["waited"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_frees_the_queue():
+    scheduler = PriorityScheduler({INTERACTIVE: 1, BATCH: 1}, total=1)
+    await scheduler.acquire(BATCH)
+    interactive = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+    batch = asyncio.create_task(scheduler.acquire(BATCH))
+    await asyncio.sleep(0)
+
+    interactive.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await interactive
+    scheduler.release(BATCH)
+    await batch
+
+    assert scheduler.active == {INTERACTIVE: 0, BATCH: 1}
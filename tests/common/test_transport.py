@@ -0,0 +1,78 @@
+import hashlib
+
+import pytest
+from gql import gql
+from graphql import ExecutionResult
+
+from bot.common.transport import (
+    PERSISTED_QUERY_NOT_FOUND,
+    PERSISTED_QUERY_NOT_SUPPORTED,
+    ProtocolTransport,
+)
+
+QUERY = gql("query getGuild { guilds { id } }")
+
+
+def get_error(code):
+    return ExecutionResult(errors=[{"message": code, "extensions": {"code": code}}])
+
+
+def test_get_query_is_cached():
+    transport = ProtocolTransport(url="http://localhost/graphql")
+    query_str, query_hash = transport.get_query(QUERY)
+
+    assert query_str.startswith("query getGuild")
+    assert query_hash == hashlib.sha256(query_str.encode("utf-8")).hexdigest()
+    assert transport.get_query(QUERY)[0] is query_str
+
+
+@pytest.mark.asyncio
+async def test_execute_sends_full_query_by_default(mocker):
+    transport = ProtocolTransport(url="http://localhost/graphql")
+    post = mocker.patch.object(transport, "post", return_value=ExecutionResult())
+
+    await transport.execute(QUERY, {"id": 1}, "getGuild")
+
+    payload = post.call_args.args[0]
+    assert payload["query"] == transport.get_query(QUERY)[0]
+    assert payload["variables"] == {"id": 1}
+    assert "extensions" not in payload
+
+
+@pytest.mark.asyncio
+async def test_execute_disables_unsupported_persisted_queries(mocker):
+    transport = ProtocolTransport(
+        persisted_queries=True, url="http://localhost/graphql"
+    )
+    post = mocker.patch.object(
+        transport,
+        "post",
+        side_effect=[get_error(PERSISTED_QUERY_NOT_SUPPORTED), ExecutionResult()],
+    )
+
+    await transport.execute(QUERY, operation_name="getGuild")
+
+    assert not transport.persisted_queries
+    retry = post.call_args.args[0]
+    assert "query" in retry and "extensions" not in retry
+
+
+@pytest.mark.asyncio
+async def test_execute_resends_unknown_persisted_query(mocker):
+    transport = ProtocolTransport(
+        persisted_queries=True, url="http://localhost/graphql"
+    )
+    post = mocker.patch.object(
+        transport,
+        "post",
+        side_effect=[get_error(PERSISTED_QUERY_NOT_FOUND), ExecutionResult(data={})],
+    )
+
+    result = await transport.execute(QUERY, operation_name="getGuild")
+
+    assert result.data == {}
+    assert transport.persisted_queries
+    first, retry = [call.args[0] for call in post.call_args_list]
+    assert "query" not in first
+    assert retry["extensions"] == first["extensions"]
+    assert retry["query"] == transport.get_query(QUERY)[0]
@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from bot.common.ttl_cache import TTLCache
+from tests.test_utils import MockCache
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_expires(mocker):
+    now = mocker.patch("bot.common.ttl_cache.time.monotonic", return_value=100)
+    cache = TTLCache("test", ttl=10)
+
+    await cache.set("a", {"id": 1})
+    await cache.set("missing", None)
+    assert await cache.get("a") == {"id": 1}
+    assert await cache.get("missing") is None
+
+    now.return_value = 111
+    assert await cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 2, 0)
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_max_entries():
+    cache = TTLCache("test", ttl=10, max_entries=2)
+    await cache.set("a", {"id": 1})
+    await cache.set("b", {"id": 2})
+    await cache.get("a")
+
+    # the least recently used record is dropped first
+    await cache.set("c", {"id": 3})
+    assert await cache.get("b") is None
+    assert await cache.get("a") == {"id": 1}
+    stats = cache.stats()
+    assert (stats["size"], stats["evictions"]) == (2, 1)
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_redis_tier():
+    redis = MockCache()
+    await TTLCache("test", ttl=10, redis=redis).set("a", {"id": 1})
+    assert await redis.get("test:a") == '{"id": 1}'
+
+    # a second process reads the record through redis
+    cache = TTLCache("test", ttl=10, redis=redis)
+    assert await cache.get("a") == {"id": 1}
+
+    await cache.delete("a")
+    assert await redis.get("test:a") is None
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_get_or_load(mocker):
+    cache = TTLCache("test", ttl=10)
+    load = mocker.AsyncMock(return_value={"id": 1})
+
+    assert await cache.get_or_load("a", load) == {"id": 1}
+    assert await cache.get_or_load("a", load) == {"id": 1}
+    load.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_get_or_load_racing_a_delete():
+    cache = TTLCache("test", ttl=10)
+
+    async def load():
+        # the record is changed and invalidated while it is being read
+        await cache.delete("a")
+        return {"id": 1}
+
+    assert await cache.get_or_load("a", load) == {"id": 1}
+    assert await cache.get("a") is None
+
+    async def load_and_clear():
+        cache.clear()
+        return {"id": 1}
+
+    assert await cache.get_or_load("a", load_and_clear) == {"id": 1}
+    assert await cache.get("a") is None
+    # nothing is kept about the key once no load of it is in flight
+    await cache.delete("a")
+    assert cache._loads == {}
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_serves_stale_while_refreshing(mocker):
+    now = mocker.patch("bot.common.ttl_cache.time.monotonic", return_value=100)
+    cache = TTLCache("test", ttl=10, stale_ttl=60)
+    load = mocker.AsyncMock(side_effect=[{"id": 1}, {"id": 2}])
+
+    assert await cache.get_or_refresh("a", load) == {"id": 1}
+
+    now.return_value = 120
+    assert await cache.get("a") is None
+    # the expired record is served while it is refreshed in the background
+    assert await cache.get_or_refresh("a", load) == {"id": 1}
+    assert await cache.get_or_refresh("a", load) == {"id": 1}
+    await asyncio.sleep(0)
+    assert await cache.get_or_refresh("a", load) == {"id": 2}
+    assert load.await_count == 2
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["stale_hits"], stats["refreshes"]) == (1, 2, 1)
+
+    # past the stale window the record is loaded again
+    now.return_value = 300
+    load.side_effect = [{"id": 3}]
+    assert await cache.get_or_refresh("a", load) == {"id": 3}
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_failed_refresh_keeps_stale_record(mocker):
+    now = mocker.patch("bot.common.ttl_cache.time.monotonic", return_value=100)
+    cache = TTLCache("test", ttl=10, stale_ttl=60)
+    await cache.set("a", {"id": 1})
+    load = mocker.AsyncMock(side_effect=Exception("timed out"))
+
+    now.return_value = 120
+    assert await cache.get_or_refresh("a", load) == {"id": 1}
+    await asyncio.sleep(0)
+    assert await cache.get_or_refresh("a", load) == {"id": 1}
+    await asyncio.sleep(0)
+    assert cache.stats()["refresh_failures"] == 2
+    assert not cache._loads
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_refresh_racing_a_delete(mocker):
+    now = mocker.patch("bot.common.ttl_cache.time.monotonic", return_value=100)
+    cache = TTLCache("test", ttl=10, stale_ttl=60)
+    loaded = asyncio.Event()
+
+    async def load():
+        await loaded.wait()
+        return {"id": 1}
+
+    # a miss which loads the record before it was deleted
+    read = asyncio.create_task(cache.get_or_refresh("a", load))
+    await asyncio.sleep(0)
+    await cache.delete("a")
+    loaded.set()
+    assert await read == {"id": 1}
+    assert await cache.get("a") is None
+
+    # and a background refresh of the same
+    await cache.set("a", {"id": 0})
+    now.return_value = 120
+    loaded.clear()
+    assert await cache.get_or_refresh("a", load) == {"id": 0}
+    await asyncio.sleep(0)
+    await cache.delete("a")
+    loaded.set()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert not cache._refreshing
+    assert not cache._loads
+    assert await cache.get("a") is None
+    assert cache.stats()["refreshes"] == 1
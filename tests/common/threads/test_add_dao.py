@@ -4,7 +4,8 @@ from bot.common.threads.thread_builder import (
     ThreadKeys,
     StepKeys,
     get_cache_metadata,
-    build_cache_value,
+    build_thread_state,
+    write_thread_state,
     write_cache_metadata,
 )
 from bot.common.threads.add_dao import (
@@ -87,8 +88,7 @@ async def test_add_dao_get_or_create_hook_previously_added(mocker, thread_depend
     message.content = dao_id
     user = {"guild_users": [{"guild_id": "1"}]}
     guild = {"id": "1", "name": guild_name}
-    mock_gql_query(mocker, "get_guild_by_discord_id", guild)
-    mock_gql_query(mocker, "get_user_by_discord_id", user)
+    mock_gql_query(mocker, "get_user_guild_membership", (user, guild, True))
     try:
         step = await step.control_hook(message, user_id)
         assert False
@@ -115,10 +115,9 @@ async def test_add_dao_get_or_create_hook_create_user(mocker, thread_dependencie
         "guild_users": [{"guild_id": "2"}]
     }
     guild = {"id": "1", "name": guild_name}
-    mock_gql_query(mocker, "get_guild_by_discord_id", guild)
-    mock_gql_query(mocker, "get_user_by_discord_id", user)
+    mock_gql_query(mocker, "get_user_guild_membership", (user, guild, False))
     # cache entry expected from previous interaction
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     next_step = await step.control_hook(message, user_id)
     assert next_step == StepKeys.ADD_DAO_PREVIOUSLY_ADDED_PROMPT.value
     actual_metadata = await get_cache_metadata(user_id, cache)
@@ -139,11 +138,10 @@ async def test_add_dao_get_or_create_hook_create_dao(mocker, thread_dependencies
         # user is not in test guild
         "guild_users": [{"guild_id": "2"}]
     }
-    mock_gql_query(mocker, "get_user_by_discord_id", user)
-    mock_gql_query(mocker, "get_guild_by_discord_id", None)
+    mock_gql_query(mocker, "get_user_guild_membership", (user, None, False))
     create_guild = mock_gql_query(mocker, "create_guild", None)
     # cache entry expected from previous interaction
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     next_step = await step.control_hook(message, user_id)
     assert next_step == StepKeys.ADD_DAO_PROMPT_NAME.value
     actual_metadata = await get_cache_metadata(user_id, cache)
@@ -169,7 +167,7 @@ async def test_add_dao_prompt_name_save(mocker, thread_dependencies):
     dao_name = "test dao"
     mock_message = MockMessage()
     mock_message.content = dao_name
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, "guild_id", dao_id)
     update_guild_name = mock_gql_query(mocker, "update_guild_name", None)
 
@@ -189,7 +187,7 @@ async def test_add_dao_previously_added_send(mocker, thread_dependencies):
     user_id = "1234"
     dao_id = "12345"
     dao_name = "test dao"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, "guild_name", dao_name)
     await write_cache_metadata(user_id, cache, "guild_id", dao_id)
 
@@ -209,7 +207,7 @@ async def test_add_dao_success(mocker, thread_dependencies):
     user_id = "1234"
     dao_name = "test dao"
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, "guild_name", dao_name)
     success_step = AddDaoSuccess(cache)
     (sent_message, metadata) = await success_step.send(message, user_id)
@@ -225,7 +223,7 @@ async def test_add_dao_join_override(mocker, thread_dependencies):
     user_id = "1234"
     dao_id = "12345"
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, "guild_id", dao_id)
 
     # need to mock get_thread since other thread steps are not mocked
@@ -17,7 +17,7 @@ from bot.common.threads.history import (
     GetContributionsCsvPromptStepEmoji,
 )
 
-from bot.common.threads.thread_builder import StepKeys
+from bot.common.threads.thread_builder import StepKeys, get_thread_state
 
 
 @pytest.mark.asyncio
@@ -63,8 +63,8 @@ async def test_display_history_step(mocker, thread_dependencies):
     )
     (sent_message, tmp) = await history_step.send(message, user_id)
     assert sent_message is not None, "expected contributions to be sent"
-    cache_values = await cache.get("1")
-    cache_values = json.loads(cache_values)
+    # the json thread state was migrated to a hash
+    cache_values = await get_thread_state("1", cache)
     assert (
         cache_values["metadata"]["contribution_rows"] is not None
     ), "contributions are expected to be stored in cached metadata"
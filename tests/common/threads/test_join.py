@@ -3,7 +3,8 @@ import web3.auto
 import eth_account.messages
 from bot.common.threads.thread_builder import (
     StepKeys,
-    build_cache_value,
+    build_thread_state,
+    write_thread_state,
     get_cache_metadata_key,
     write_cache_metadata,
 )
@@ -45,13 +46,13 @@ async def test_check_if_user_exists(mocker, thread_dependencies):
     mock_user = {"id": "01", "display_name": test_display_name, "address": address}
     (cache, context, message, bot) = thread_dependencies
 
-    step = CheckIfUserExists(cache)
+    step = CheckIfUserExists(cache, "12345")
     (msg, metadata) = await step.send(None, None)
     assert msg is None
     assert metadata is None
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
-    mock_gql_query(mocker, "get_user_by_discord_id", mock_user)
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
+    mock_gql_query(mocker, "get_user_guild_membership", (mock_user, None, False))
     next_step_key = await step.control_hook(None, user_id)
     await assert_cache_metadata_content(
         user_id, cache, "display_name", test_display_name
@@ -65,8 +66,8 @@ async def test_check_if_user_exists_dne(mocker, thread_dependencies):
     user_id = "1234"
     (cache, context, message, bot) = thread_dependencies
 
-    step = CheckIfUserExists(cache)
-    mock_gql_query(mocker, "get_user_by_discord_id", None)
+    step = CheckIfUserExists(cache, "12345")
+    mock_gql_query(mocker, "get_user_guild_membership", (None, None, False))
     next_step_key = await step.control_hook(None, user_id)
     assert len(cache.internal) == 0
     assert next_step_key == StepKeys.USER_DISPLAY_CONFIRM.value
@@ -87,7 +88,7 @@ async def test_associate_existing_user(mocker, thread_dependencies):
     next_step = await step.control_hook(message, user_id)
     assert next_step == StepKeys.END.value
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     mock_gql_query(mocker, "get_guild_by_discord_id", mock_guild)
     await write_cache_metadata(user_id, cache, "user_db_id", mock_user["id"])
@@ -122,7 +123,7 @@ async def test_user_display_confirmation(mocker, thread_dependencies):
     assert NO_EMOJI in emojis
     assert len(emojis) == 2
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     (sent_message, metadata) = await step.send(message, user_id)
 
@@ -149,7 +150,7 @@ async def test_user_display_confirmation_emoji_step(mocker, thread_dependencies)
     assert NO_EMOJI in emojis
     assert len(emojis) == 2
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, DISCORD_DISPLAY_NAME_CACHE_KEY, user_id)
 
     reaction = MockReaction(user_id, step.emojis[0])
@@ -185,7 +186,7 @@ async def test_user_display_submit_step(mocker, thread_dependencies):
     assert_message_content(sent_message, UserDisplaySubmitStep.display_name_prompt)
     assert metadata is None
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     message.content = user_id
     await step.save(message, guild_id, user_id)
     await assert_cache_metadata_content(user_id, cache, "display_name", user_id)
@@ -214,7 +215,7 @@ async def test_create_user_wallet_address_step(mocker, thread_dependencies):
         )
 
     message.content = wallet
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await step.save(message, guild_id, user_id)
     await assert_cache_metadata_content(user_id, cache, WALLET_CACHE_KEY, wallet)
 
@@ -224,7 +225,7 @@ async def test_add_user_twitter_step(mocker, thread_dependencies):
     (cache, context, message, bot) = thread_dependencies
     user_id = "1234"
     guild_id = "12345"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     step = AddUserTwitterStep(guild_id, cache)
 
@@ -257,7 +258,7 @@ async def test_verify_user_twitter_step(mocker, thread_dependencies):
     (cache, context, message, bot) = thread_dependencies
     user_id = "1234"
     guild_id = "12345"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     step = VerifyUserTwitterStep(user_id, guild_id, cache)
 
@@ -270,7 +271,7 @@ async def test_verify_user_twitter_step(mocker, thread_dependencies):
 async def test_verify_user_wallet_send(mocker, thread_dependencies):
     (cache, context, message, bot) = thread_dependencies
     user_id = "1234"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     step = VerifyUserWalletStep(cache, False)
 
@@ -299,24 +300,17 @@ async def test_verify_user_wallet_step(mocker, thread_dependencies):
     wallet = "0x63FaC9201494f0bd17B9892B9fae4d52fe3BD377"
     private_k = "8da4ef21b864d2cc526dbdb2a120bd2874c36c9d0a1fb7f8c63d7f7a8b41de8f"
     test_display_name = "test_display_name"
-    mock_guild = {"id": "1", "name": "test_guild_name"}
     mock_user = {"id": "01", "display_name": test_display_name, "address": wallet}
 
     message.content = wallet
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     await write_cache_metadata(user_id, cache, "display_name", test_display_name)
     await write_cache_metadata(
         user_id, cache, DISCORD_DISPLAY_NAME_CACHE_KEY, test_display_name
     )
     await write_cache_metadata(user_id, cache, WALLET_CACHE_KEY, wallet)
 
-    mock_gql_query(mocker, "get_guild_by_discord_id", mock_guild)
-    mock_gql_query(mocker, "get_user_by_discord_id", mock_user)
-    mock_gql_query(mocker, "get_user_by_wallet", None)
-    mock_gql_query(mocker, "update_user_wallet", None)
-    create_user = mock_gql_query(mocker, "create_user", mock_user)
-    create_guild_user = mock_gql_query(mocker, "create_guild_user", None)
-    update_display = mock_gql_query(mocker, "update_user_display_name", None)
+    create_user = mock_gql_query(mocker, "create_onboarded_user", mock_user)
 
     step = VerifyUserWalletStep(cache, update=False)
     msg = MockMessage(message.channel)
@@ -350,7 +344,12 @@ async def test_verify_user_wallet_step(mocker, thread_dependencies):
     msg.content = signed_message.signature.hex()[2:]
     await step.save(msg, guild_id, user_id)
 
-    create_user.assert_called_once_with(user_id, test_display_name, wallet)
-    create_guild_user.assert_called_once_with(mock_user["id"], mock_guild["id"])
-    update_display.assert_called_once_with(mock_user["id"], test_display_name)
+    create_user.assert_called_once_with(
+        user_id,
+        test_display_name,
+        test_display_name,
+        wallet,
+        guild_id,
+        VerifyUserWalletStep.unverified_address_fmt % user_id,
+    )
     await assert_cache_metadata_content(user_id, cache, "user_db_id", mock_user["id"])
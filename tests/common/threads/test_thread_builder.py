@@ -2,7 +2,20 @@ import pytest
 import hashlib
 import json
 
-from bot.common.threads.thread_builder import BaseThread, Step, BaseStep, StepKeys
+from bot.common.cache import ConflictError, UnitOfWork
+from bot.common.threads.thread_builder import (
+    STEP_FIELD,
+    THREAD_STATE_IDLE_SECONDS,
+    BaseThread,
+    Step,
+    BaseStep,
+    StepKeys,
+    build_thread_state,
+    get_cache_metadata_key,
+    get_thread_state,
+    write_cache_metadata,
+    write_thread_state,
+)
 from tests.test_utils import MockCache
 from unittest.mock import MagicMock, AsyncMock
 
@@ -421,7 +434,7 @@ async def test_thread_metadata_none(mocker):
         cache=cache,
     )
     await t2.send(AsyncMock(message_id="", id="1"))
-    assert json.loads(await cache.get("1")).get("metadata") == {"example": 0}
+    assert (await get_thread_state("1", cache))["metadata"] == {"example": 0}
 
 
 @pytest.mark.asyncio
@@ -481,7 +494,7 @@ async def test_thread_metadata_set(mocker):
         cache=cache,
     )
     await t2.send(AsyncMock(message_id="", id="1"))
-    assert json.loads(await cache.get("1")).get("metadata") == {"example": 2}
+    assert (await get_thread_state("1", cache))["metadata"] == {"example": 2}
 
 
 @pytest.mark.asyncio
@@ -533,7 +546,7 @@ async def test_thread_control_hook_end(mocker):
         cache=cache,
     )
     await thread.send(AsyncMock(message_id="", id="1"))
-    assert json.loads(await cache.get("1")) is not None
+    assert await get_thread_state("1", cache) is not None
 
     hash_ = thread.step.get_next_step("send").hash_
     t2 = await MockThread(
@@ -680,3 +693,211 @@ async def test_thread_trigger(mocker):
     )
     await t2.send(AsyncMock(message_id="", id="1"))
     assert third_step is True
+
+
+@pytest.mark.asyncio
+async def test_thread_state_metadata_fields():
+    cache = MockCache()
+    state = build_thread_state("t", "s", 1, 2, metadata={"a": [1], "b": None})
+    await write_thread_state("1", cache, state)
+    await write_cache_metadata("1", cache, "c", {"d": "e"})
+
+    # each metadata key is stored in its own field
+    assert set(cache.internal["1"]) == {
+        "thread",
+        "step",
+        "guild_id",
+        "message_id",
+        "metadata:a",
+        "metadata:b",
+        "metadata:c",
+    }
+    assert await get_cache_metadata_key("1", cache, "c") == {"d": "e"}
+    assert await get_cache_metadata_key("1", cache, "missing") is None
+    assert (await get_thread_state("1", cache))["metadata"] == {
+        "a": [1],
+        "b": None,
+        "c": {"d": "e"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_json_thread_state_is_migrated():
+    cache = MockCache()
+    state = build_thread_state("t", "s", 1, 2, metadata={"a": 1})
+    await cache.set("1", json.dumps(state))
+
+    assert await get_cache_metadata_key("1", cache, "a") == 1
+    assert isinstance(cache.internal["1"], dict)
+    assert await get_thread_state("1", cache) == state
+
+    await cache.set("2", json.dumps({**state, "metadata": None}))
+    await write_cache_metadata("2", cache, "b", 2)
+    assert (await get_thread_state("2", cache))["metadata"] == {"b": 2}
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_batches_thread_state(mocker):
+    class WriteLogic(BaseStep):
+        name = "write"
+        trigger = True
+
+        async def send(self, message, user_id):
+            await write_cache_metadata(user_id, self.cache, "a", 1)
+            await write_cache_metadata(user_id, self.cache, "b", 2)
+            return message, None
+
+    class ReadLogic(BaseStep):
+        name = "read"
+
+        async def send(self, message, user_id):
+            a = await get_cache_metadata_key(user_id, self.cache, "a")
+            b = await get_cache_metadata_key(user_id, self.cache, "b")
+            await write_cache_metadata(user_id, self.cache, "c", a + b)
+            return message, None
+
+    class MockThread(BaseThread):
+        name = "thread"
+
+        async def get_steps(self):
+            write, read = WriteLogic(), ReadLogic()
+            write.cache = read.cache = self.cache
+            return (
+                Step(current=write)
+                .add_next_step(read)
+                .add_next_step(MockLogic())
+                .build()
+            )
+
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("thread", "", "", ""))
+    for name in ["hget", "hgetall", "hset", "set_hash", "delete"]:
+        mocker.spy(cache, name)
+
+    async with UnitOfWork(cache, "1") as unit:
+        thread = await MockThread(
+            user_id="1",
+            current_step=get_root_hash(WriteLogic),
+            message_id="",
+            guild_id="",
+            discord_bot=AsyncMock(),
+            cache=unit,
+        )
+        await thread.send(AsyncMock(message_id="", id="1"))
+        # nothing is written until the unit of work is committed
+        cache.hset.assert_not_called()
+
+    # one read when the event starts and one write when it ends
+    cache.hgetall.assert_awaited_once()
+    cache.hset.assert_awaited_once()
+    cache.hget.assert_not_called()
+    cache.set_hash.assert_not_called()
+    state = await get_thread_state("1", cache)
+    assert state["metadata"] == {"a": 1, "b": 2, "c": 3}
+    assert state["step"] == thread.step.get_next_step("mock_logic").hash_
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_replaces_and_deletes_thread_state():
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("t", "s", "", ""))
+
+    async with UnitOfWork(cache, "1") as unit:
+        await unit.delete("1")
+        assert await get_thread_state("1", unit) is None
+    assert "1" not in cache.internal
+
+    state = build_thread_state("t", "s", "", "", metadata={"a": 1})
+    async with UnitOfWork(cache, "1", load=False) as unit:
+        await write_thread_state("1", unit, state)
+        await write_cache_metadata("1", unit, "b", 2)
+        assert "1" not in cache.internal
+    assert await get_thread_state("1", cache) == {
+        **state,
+        "metadata": {"a": 1, "b": 2},
+    }
+
+    # keys other than the thread state are written straight through
+    async with UnitOfWork(cache, "1") as unit:
+        await unit.set("1-congrats", "True")
+        assert cache.internal["1-congrats"] == "True"
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_migrates_json_thread_state():
+    cache = MockCache()
+    state = build_thread_state("t", "s", 1, 2, metadata={"a": 1})
+    await cache.set("1", json.dumps(state))
+
+    async with UnitOfWork(cache, "1") as unit:
+        assert await get_thread_state("1", unit) == state
+        await write_cache_metadata("1", unit, "b", 2)
+    assert (await get_thread_state("1", cache))["metadata"] == {"a": 1, "b": 2}
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_rejects_conflicting_step_transition():
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("t", "a", "", ""))
+
+    # a message and a reaction start from the same step
+    message = UnitOfWork(cache, "1", check_field=STEP_FIELD)
+    reaction = UnitOfWork(cache, "1", check_field=STEP_FIELD)
+    await message.__aenter__()
+    await reaction.__aenter__()
+
+    await write_thread_state("1", message, build_thread_state("t", "b", "", ""))
+    await message.__aexit__(None, None, None)
+
+    await write_cache_metadata("1", reaction, "a", 1)
+    with pytest.raises(ConflictError):
+        await reaction.__aexit__(None, None, None)
+
+    state = await get_thread_state("1", cache)
+    assert (state["step"], state["metadata"]) == ("b", {})
+
+    # an event that doesn't move the thread on writes nothing to check
+    async with UnitOfWork(cache, "1", check_field=STEP_FIELD) as unit:
+        await get_thread_state("1", unit)
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_check_before_side_effects():
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("t", "a", "", ""))
+
+    async with UnitOfWork(cache, "1", check_field=STEP_FIELD) as unit:
+        await unit.check()
+
+    unit = UnitOfWork(cache, "1", check_field=STEP_FIELD)
+    await unit.__aenter__()
+    await write_thread_state("1", cache, build_thread_state("t", "b", "", ""))
+    # the event can be dropped before it has replied to the user
+    with pytest.raises(ConflictError):
+        await unit.check()
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_conflict_doesnt_hide_failure():
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("t", "a", "", ""))
+
+    with pytest.raises(ValueError):
+        async with UnitOfWork(cache, "1", check_field=STEP_FIELD) as unit:
+            await write_cache_metadata("1", unit, "a", 1)
+            await write_thread_state("1", cache, build_thread_state("t", "b", "", ""))
+            raise ValueError("the step failed")
+    assert (await get_thread_state("1", cache))["step"] == "b"
+
+
+@pytest.mark.asyncio
+async def test_thread_state_expires_when_idle():
+    cache = MockCache()
+    await write_thread_state("1", cache, build_thread_state("t", "a", "", ""))
+    assert cache.expiries["1"] == THREAD_STATE_IDLE_SECONDS
+
+    # every step transition restarts the countdown
+    del cache.expiries["1"]
+    async with UnitOfWork(cache, "1", check_field=STEP_FIELD) as unit:
+        await write_cache_metadata("1", unit, "a", 1)
+    assert cache.expiries["1"] == THREAD_STATE_IDLE_SECONDS
@@ -22,7 +22,8 @@ from tests.test_utils import (
 )
 from bot.common.threads.thread_builder import (
     StepKeys,
-    build_cache_value,
+    build_thread_state,
+    write_thread_state,
     get_cache_metadata_key,
     write_cache_metadata,
 )
@@ -72,7 +73,7 @@ async def test_update_profile_field(mocker, thread_dependencies):
         emojis[1]: "twitter",
         emojis[2]: "wallet",
     }
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     for key in metadata:
         await write_cache_metadata(user_id, cache, key, metadata[key])
 
@@ -82,7 +83,7 @@ async def test_update_profile_field(mocker, thread_dependencies):
     assert skip is None
     await assert_cache_metadata_content(user_id, cache, "field", "display_name")
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     for key in metadata:
         await write_cache_metadata(user_id, cache, key, metadata[key])
 
@@ -92,7 +93,7 @@ async def test_update_profile_field(mocker, thread_dependencies):
     assert skip is None
     await assert_cache_metadata_content(user_id, cache, "field", "twitter")
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     for key in metadata:
         await write_cache_metadata(user_id, cache, key, metadata[key])
 
@@ -123,7 +124,7 @@ async def test_update_field_step_save(mocker, thread_dependencies):
     mocked_twitter = mock_gql_query(mocker, "update_user_twitter_handle", mock_user)
     mocked_wallet = mock_gql_query(mocker, "update_user_wallet", mock_user)
 
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     await write_cache_metadata(user_id, cache, "field", "display_name")
     message.content = "test_display_name"
@@ -154,7 +155,7 @@ async def test_update_field_step_save(mocker, thread_dependencies):
 async def test_update_field_control_hook(mocker, thread_dependencies):
     (cache, context, message, bot) = thread_dependencies
     user_id = "1234"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
     step = UpdateFieldStep(cache)
 
     await write_cache_metadata(user_id, cache, "field", "twitter")
@@ -175,7 +176,7 @@ async def test_verify_user_twitter_step(mocker, thread_dependencies):
     mock_twitter_profile = "test_profile"
     mock_status_id = "5350301918403100841"
     tweet_url = f"https://twitter.com/{mock_twitter_profile}/status/{mock_status_id}"
-    await cache.set(user_id, build_cache_value("t", "s", "1", "1"))
+    await write_thread_state(user_id, cache, build_thread_state("t", "s", "1", "1"))
 
     step = VerifyUserTwitterStep(user_id, guild_id, cache)
     (sent_message, metadata) = await step.send(message, user_id)
@@ -0,0 +1,104 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot.common.graphql as graphql
+from bot.common.graphql import GqlSessionManager
+from scripts.protocol_stand_in import create_app, generate_dataset
+
+
+@pytest.fixture
+async def stand_in(mocker):
+    dataset = generate_dataset(users=5, guilds=2, contributions=30, seed=1)
+    app = create_app(dataset)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    manager = GqlSessionManager(url=f"http://127.0.0.1:{port}/graphql")
+    mocker.patch.object(graphql, "session_manager", manager)
+    yield app
+    await manager.close()
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_stand_in_reads(stand_in):
+    guild = await graphql.get_guild_by_discord_id("900000000000000000")
+    assert guild["name"] == "Guild 0"
+
+    user = await graphql.get_user_by_discord_id("100000000000000000")
+    assert user["display_name"] == "user 0"
+
+    contributions = [
+        contribution async for contribution in graphql.iter_contributions(page_size=7)
+    ]
+    assert [c["id"] for c in contributions] == list(range(1, 31))
+    assert await graphql.count_contributions(None, None, None) == 30
+    assert stand_in["stats"]["listContributions"] == 5
+
+
+@pytest.mark.asyncio
+async def test_stand_in_mutations(stand_in):
+    await graphql.create_guild("42")
+    guild = await graphql.update_guild_name("42", "new guild")
+    assert guild["discord_id"] == "42"
+
+    user = await graphql.create_onboarded_user(
+        "7", "discord name", "display name", "0xabc", "42", "released"
+    )
+    assert user["display_name"] == "display name"
+    assert [g["guild_id"] for g in user["guild_users"]] == [guild["id"]]
+
+    _, _, is_member = await graphql.get_user_guild_membership("7", "42")
+    assert is_member
+
+    with pytest.raises(graphql.UserWithAddressAlreadyExists):
+        await graphql.create_user("8", "other", "0xabc")
+
+
+@pytest.mark.asyncio
+async def test_stand_in_injected_errors():
+    app = create_app(generate_dataset(users=1, guilds=1, contributions=0), error_rate=1)
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post(
+            "/graphql", json={"query": "query listGuilds { guilds { id } }"}
+        )
+        assert response.status == 503
+        stats = await (await client.get("/stats")).json()
+    assert stats == {"listGuilds": 1, "injected_errors": 1}
+
+
+@pytest.mark.asyncio
+async def test_stand_in_persisted_queries(mocker, stand_in):
+    mocker.patch.object(graphql.constants.Protocol, "persisted_queries_enable", "true")
+    queries = mocker.spy(graphql.ProtocolTransport, "post")
+
+    for _ in range(2):
+        guild = await graphql.get_guild_by_discord_id("900000000000000000")
+        graphql.guild_cache.clear()
+    assert guild["name"] == "Guild 0"
+
+    # the first request misses and is retried with the query, the second
+    # one is answered from the hash alone
+    assert stand_in["stats"]["persisted_query_misses"] == 1
+    payloads = [call.args[1] for call in queries.call_args_list]
+    assert ["query" in payload for payload in payloads] == [False, True, False]
+    assert all("persistedQuery" in payload["extensions"] for payload in payloads)
+
+
+@pytest.mark.asyncio
+async def test_stand_in_streamed_contributions(stand_in):
+    contributions = [
+        contribution
+        async for contribution in graphql.iter_contributions(
+            page_size=7, projection="report-row", stream=True
+        )
+    ]
+
+    assert [c["id"] for c in contributions] == list(range(1, 31))
+    assert stand_in["stats"]["listContributionReportRows"] == 5
+    session = await graphql.session_manager.open()
+    assert session.transport.response_headers["Content-Encoding"] in ("gzip", "deflate")
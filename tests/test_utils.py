@@ -2,11 +2,12 @@ from datetime import timedelta, time, datetime
 from unittest.mock import AsyncMock
 from deepdiff import DeepDiff
 from pytest_mock.plugin import MockerFixture
-import json
 import discord
 import pytest
 
-from bot.common.cache import Cache
+import bot.common.graphql as graphql
+from bot.common.cache import Cache, WrongTypeError
+from bot.common.threads.thread_builder import get_thread_state
 from bot.common.tasks.tasks import Cadence
 
 
@@ -17,13 +18,27 @@ def thread_dependencies():
     return (MockCache(), MockContext(), MockMessage(), mock_bot)
 
 
+# records cached by the graphql module must not leak between tests
+@pytest.fixture(autouse=True)
+def clear_graphql_caches():
+    graphql.guild_cache.clear()
+    graphql.user_cache.clear()
+    yield
+    graphql.guild_cache.clear()
+    graphql.user_cache.clear()
+
+
 # Add in memory implementation
 class MockCache(Cache):
     def __init__(self):
         self.internal = {}
+        self.expiries = {}
 
     async def get(self, key):
-        return self.internal.get(key)
+        value = self.internal.get(key)
+        if isinstance(value, dict):
+            raise WrongTypeError(f"{key} holds a hash")
+        return value
 
     # expiry accepted but not mocked
     async def set(self, key, value, ex=None):
@@ -33,6 +48,35 @@ class MockCache(Cache):
         if self.internal.get(key):
             del self.internal[key]
 
+    def _get_hash(self, key):
+        value = self.internal.get(key)
+        if value is not None and not isinstance(value, dict):
+            raise WrongTypeError(f"{key} doesn't hold a hash")
+        return value or {}
+
+    async def hget(self, key, field):
+        return self._get_hash(key).get(field)
+
+    async def hgetall(self, key):
+        return dict(self._get_hash(key))
+
+    # expiry recorded but not mocked
+    async def hset(self, key, mapping, ex=None):
+        self.internal[key] = {**self._get_hash(key), **mapping}
+        if ex is not None:
+            await self.expire(key, ex)
+
+    async def set_hash(self, key, mapping, ex=None):
+        self.internal[key] = dict(mapping)
+        if ex is not None:
+            await self.expire(key, ex)
+
+    async def expire(self, key, seconds):
+        if key not in self.internal:
+            return False
+        self.expiries[key] = seconds
+        return True
+
 
 # This is a continual cadence; it's always running
 class MockCadence(Cadence):
@@ -186,6 +230,7 @@ def mock_default_contributions(mocker: MockerFixture):
         },
     ]
     mock_gql_query(mocker, "get_contributions", returns=default_contributions)
+    mock_gql_query(mocker, "count_contributions", returns=len(default_contributions))
     return default_contributions
 
 
@@ -220,8 +265,7 @@ def assert_dicts_equal(d1, d2):
 async def assert_cache_metadata_content(
     user_id: str, cache: MockCache, key: str, expected_value: str = None
 ):
-    cache_values = await cache.get(user_id)
-    cache_values = json.loads(cache_values)
+    cache_values = await get_thread_state(user_id, cache)
 
     assert (
         cache_values["metadata"][key] is not None